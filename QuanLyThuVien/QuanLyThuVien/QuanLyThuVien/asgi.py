@@ -5,6 +5,9 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
+
+Chạy bằng uvicorn, vd. ``uvicorn QuanLyThuVien.asgi:application --workers 4``; các endpoint
+chờ I/O có bản async dưới /async/ (xem ThuVien/views_async.py, đo bằng ``manage.py benchmark_asgi``).
 """
 
 import os
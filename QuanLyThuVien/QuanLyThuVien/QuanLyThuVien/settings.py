@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'ThuVien.giamsat.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +84,64 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'thuvien',
+    }
+}
+
+# Alias trong CACHES dùng cho cache catalog; khai báo thêm một backend khác (Redis, Memcached...)
+# rồi trỏ alias này sang để dùng chung cache giữa các worker.
+THUVIEN_CACHE_ALIAS = 'default'
+THUVIEN_CACHE_TIMEOUT = 300
+
+# Gợi ý tìm kiếm (ThuVien/goiy.py): khoảng cách tối thiểu giữa hai lần xây dựng lại ở luồng nền
+# khi catalog thay đổi, và tuổi tối đa của chỉ mục (để cập nhật lượt thích).
+THUVIEN_AUTOCOMPLETE_REFRESH = 30
+THUVIEN_AUTOCOMPLETE_MAX_AGE = 600
+
+# Bảng xếp hạng top-N trong bộ nhớ (ThuVien/bangxephang.py) được nạp lại từ CSDL sau khoảng này (giây)
+THUVIEN_LEADERBOARD_TTL = 300
+
+# Thời gian cache kết quả gộp của /sach/dashboard/ (giây)
+THUVIEN_DASHBOARD_TTL = 30
+
+# Cổng thanh toán (ThuVien/thanhtoan.py): thông tin sandbox MoMo / ZaloPay, thời gian chờ kết nối / phản hồi
+# (giây), số lần thử lại khi lỗi kết nối hoặc 502/503/504 và kích thước pool kết nối keep-alive dùng chung.
+THUVIEN_PAYMENT = {
+    'MOMO': {
+        'endpoint': 'https://test-payment.momo.vn/v2/gateway/api/create',
+        'partner_code': 'MOMO',
+        'access_key': 'F8BBA842ECF85',
+        'secret_key': 'K951B6PE1waDMi640xX08PD3vg6EkVlz',
+        'redirect_url': 'https://momo.vn/return',
+        'ipn_url': 'https://callback.url/notify',
+    },
+    'ZALOPAY': {
+        'endpoint': 'https://sb-openapi.zalopay.vn/v2/create',
+        'app_id': 2553,
+        'key1': 'PcY4iZIKFCIdgZvA6ueMcMHHUbRLYjPL',
+        'key2': 'kLtgPl8HHhfvMuDHPwKfgfsY4Ydm9eIz',
+    },
+    'CONNECT_TIMEOUT': 2,
+    'TIMEOUT': 5,
+    'RETRIES': 2,
+    'BACKOFF': 0.2,
+    # Tổng thời gian tối đa (giây) cho một lần tạo đơn, kể cả các lần thử lại
+    'DEADLINE': 8,
+    'MAX_CONNECTIONS': 20,
+    'MAX_KEEPALIVE': 10,
+}
+
+# Số ngày giữ sách cho lượt đặt trước đến lượt (DatTruoc 'ready') trước khi chuyển cho người kế tiếp
+THUVIEN_HOLD_PICKUP_DAYS = 3
+
+# Đo số truy vấn / thời gian theo endpoint (ThuVien/giamsat.py, xem /metrics/); header X-Query-Count... chỉ
+# gửi khi DEBUG. Một câu SQL lặp từ THUVIEN_METRICS_N_PLUS_ONE lần trong một request bị đánh dấu N+1.
+THUVIEN_METRICS = True
+THUVIEN_METRICS_N_PLUS_ONE = 5
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
@@ -129,6 +188,7 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'ThuVien.paginators.IdCursorPagination',
 }
 
 CLIENT_ID = 'N0mM3SSvaoWPwqvsDox8q6vDzcigFVIBEwQbXShE'
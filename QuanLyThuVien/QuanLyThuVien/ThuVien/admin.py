@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import DanhMuc, Sach, NguoiDung, Thich, BinhLuan, ChiaSe, PhieuMuon, ChiTietPhieuMuon
+from .models import DanhMuc, Sach, NguoiDung, Thich, BinhLuan, ChiaSe, PhieuMuon, ChiTietPhieuMuon, ThongKeLuuThong, TuKhoa, \
+    DatTruoc, ThanhToan
 
 
 class MyApartAdminSite(admin.AdminSite):
@@ -15,3 +16,7 @@ admin_site.register(ChiTietPhieuMuon)
 admin_site.register(Thich)
 admin_site.register(BinhLuan)
 admin_site.register(ChiaSe)
+admin_site.register(ThongKeLuuThong)
+admin_site.register(TuKhoa)
+admin_site.register(DatTruoc)
+admin_site.register(ThanhToan)
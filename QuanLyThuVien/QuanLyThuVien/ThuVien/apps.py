@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ThuvienConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ThuVien'
+
+    def ready(self):
+        from . import signals  # noqa: F401
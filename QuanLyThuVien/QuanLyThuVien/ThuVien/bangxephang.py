@@ -0,0 +1,163 @@
+import threading
+import time
+from datetime import date
+
+from django.conf import settings
+
+# Bảng xếp hạng top-N trong bộ nhớ tiến trình, mỗi (chỉ số, cửa sổ thời gian) một bảng.
+# Mỗi bảng giữ CAPACITY sách đứng đầu (nhiều hơn N được đọc) và được cập nhật bằng các thay đổi
+# gửi từ model sau khi transaction commit. Sách ngoài bảng chỉ được biết cận trên của điểm
+# (floor + tổng thay đổi từ lúc nạp); khi cận trên có thể vượt thành viên cuối, hoặc một thành
+# viên tụt xuống dưới cận trên đó, bảng được đánh dấu cần nạp lại từ CSDL ở lần đọc kế tiếp.
+CAPACITY = 50
+
+# Chỉ số lấy từ cột bộ đếm của Sach (chỉ có cửa sổ 'all')
+COT_SACH = {'liked': 'soLuotThich', 'commented': 'soBinhLuan'}
+# Chỉ số lấy từ bảng tổng hợp ThongKeLuuThong, có thêm cửa sổ theo tháng 'YYYY-MM'
+LUU_THONG = ('issued', 'borrowed', 'returned', 'late')
+
+
+def ttl():
+    # Các tiến trình khác không nhận được thay đổi của tiến trình này nên vẫn nạp lại định kỳ
+    return getattr(settings, 'THUVIEN_LEADERBOARD_TTL', 300)
+
+
+def month_window(ngay):
+    return f'{ngay.year:04d}-{ngay.month:02d}'
+
+
+def _month_range(window):
+    year, month = (int(part) for part in window.split('-'))
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+class Leaderboard:
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.scores = {}
+        self.extra = {}
+        self.floor = 0
+        self.outside_max = 0
+        self.dirty = True
+        self.loaded_at = 0
+
+    def load(self, rows):
+        # rows: [(sach_id, điểm)] giảm dần, tối đa capacity + 1 dòng
+        rows = list(rows)
+        self.scores = dict(rows[:self.capacity])
+        self.floor = rows[self.capacity][1] if len(rows) > self.capacity else 0
+        self.outside_max = self.floor
+        self.extra = {}
+        self.dirty = False
+        self.loaded_at = time.monotonic()
+
+    def expired(self):
+        return self.dirty or time.monotonic() - self.loaded_at >= ttl()
+
+    def apply(self, sach_id, delta):
+        if self.dirty:
+            return
+        if sach_id in self.scores:
+            self.scores[sach_id] += delta
+            if self.scores[sach_id] < self.outside_max:
+                self.dirty = True
+            return
+
+        extra = self.extra.get(sach_id, 0) + delta
+        if self.floor == 0:
+            # Mọi sách có điểm dương đều đã ở trong bảng nên biết chính xác điểm của sách mới
+            if extra > 0:
+                self.extra.pop(sach_id, None)
+                self.scores[sach_id] = extra
+                if len(self.scores) > self.capacity:
+                    self._loai_cuoi()
+            else:
+                self.extra[sach_id] = extra
+            return
+        self.extra[sach_id] = extra
+        bound = self.floor + extra
+        self.outside_max = max(self.outside_max, bound)
+        if bound > min(self.scores.values()):
+            self.dirty = True
+
+    def _loai_cuoi(self):
+        # Bảng đã đầy: đẩy sách cuối bảng (điểm thấp nhất, id lớn nhất khi bằng điểm) ra ngoài; điểm của nó
+        # thành floor, cận trên của mọi sách ngoài bảng
+        sach_id, score = min(self.scores.items(), key=lambda item: (item[1], -item[0]))
+        del self.scores[sach_id]
+        self.floor = score
+        self.outside_max = max(self.outside_max, score)
+
+    def top(self, n):
+        ranked = sorted(self.scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(sach_id, score) for sach_id, score in ranked[:n] if score > 0]
+
+
+_lock = threading.Lock()
+_boards = {}
+# Số thay đổi đã gửi tới mỗi (chỉ số, cửa sổ), kể cả khi bảng chưa được nạp
+_phien = {}
+
+
+def _warm(metric, window):
+    # Import muộn: models gọi vào module này nên không import models ở mức module
+    from . import thongke
+    from .models import Sach
+
+    if metric in COT_SACH:
+        field = COT_SACH[metric]
+        return Sach.objects.filter(**{f'{field}__gt': 0}).order_by(f'-{field}', 'id') \
+            .values_list('id', field)[:CAPACITY + 1]
+    start, end = _month_range(window) if window != 'all' else (None, None)
+    return thongke.top_books(metric, start, end).order_by('-total', 'sach') \
+        .values_list('sach', 'total')[:CAPACITY + 1]
+
+
+def top(metric, n=10, window='all'):
+    if metric not in COT_SACH and metric not in LUU_THONG:
+        raise ValueError(f'Unknown metric: {metric}')
+    if metric in COT_SACH and window != 'all':
+        raise ValueError(f'Metric {metric} only supports the "all" window')
+    key = (metric, window)
+    with _lock:
+        board = _boards.get(key)
+        if board is not None and not board.expired():
+            return board.top(min(n, CAPACITY))
+        phien = _phien.get(key, 0)
+
+    # Truy vấn nạp bảng chạy ngoài khóa để không chặn các lượt đọc / ghi bảng khác
+    rows = list(_warm(metric, window))
+    with _lock:
+        board = _boards.get(key)
+        if board is None or board.expired():
+            board = _boards[key] = Leaderboard()
+            board.load(rows)
+            # Có thay đổi gửi tới trong lúc truy vấn: chưa chắc rows đã gồm thay đổi đó nên lần đọc sau nạp lại
+            board.dirty = _phien.get(key, 0) != phien
+        return board.top(min(n, CAPACITY))
+
+
+def ghi_nhan(metric, sach_id, delta, ngay=None):
+    windows = ['all'] if ngay is None else ['all', month_window(ngay)]
+    with _lock:
+        for window in windows:
+            _phien[(metric, window)] = _phien.get((metric, window), 0) + 1
+            board = _boards.get((metric, window))
+            if board is not None:
+                board.apply(sach_id, delta)
+
+
+def ghi_nhan_luu_thong(thay_doi):
+    # thay_doi có dạng của ThongKeLuuThong.cap_nhat: {(ngay, sach_id, tinhTrang): (so_luong, tien_phat)}
+    for (ngay, sach_id, tinh_trang), (so_luong, _) in thay_doi.items():
+        if so_luong:
+            ghi_nhan(tinh_trang, sach_id, so_luong, ngay)
+
+
+def reset(*metrics):
+    with _lock:
+        for key in list(_boards):
+            if not metrics or key[0] in metrics:
+                del _boards[key]
@@ -0,0 +1,166 @@
+import hashlib
+import time
+from functools import partial, wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.response import Response
+
+VERSION_KEY = 'thuvien:catalog:version'
+# Phiên bản riêng cho số lượng / bộ đếm (mượn, trả, giữ chỗ, tương tác): đổi liên tục khi thư viện đông
+# nên không làm mất cache của nội dung catalog (tên, tác giả, danh mục) và bản gợi ý (goiy)
+STOCK_VERSION_KEY = 'thuvien:stock:version'
+STATS_KEY = 'thuvien:stats:{name}:{kind}'
+
+# Tên các endpoint đang được cache, dùng cho cache_stats()
+CACHED_ENDPOINTS = []
+
+
+def get_cache():
+    return caches[getattr(settings, 'THUVIEN_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'THUVIEN_CACHE_TIMEOUT', 300)
+
+
+# Khóa cache mang số phiên bản của catalog: tăng phiên bản là vô hiệu toàn bộ khóa cũ
+# mà không cần xóa từng khóa. Phiên bản khởi tạo theo thời gian để nếu khóa phiên bản
+# bị đẩy ra khỏi cache thì cũng không quay lại một phiên bản cũ.
+def _version(key):
+    cache = get_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def catalog_version():
+    return _version(VERSION_KEY)
+
+
+def stock_version():
+    return _version(STOCK_VERSION_KEY)
+
+
+def _bump_version(key=VERSION_KEY):
+    cache = get_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def invalidate_catalog():
+    # Chờ transaction commit để không lưu lại dữ liệu cũ dưới phiên bản mới
+    transaction.on_commit(_bump_version)
+
+
+def invalidate_stock():
+    transaction.on_commit(partial(_bump_version, STOCK_VERSION_KEY))
+
+
+def _count(name, kind):
+    cache = get_cache()
+    key = STATS_KEY.format(name=name, kind=kind)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+# Response không chứa số lượng / bộ đếm chỉ phụ thuộc phiên bản catalog. Với response có các cột đó:
+# theo_kho (bool hoặc hàm của request) đưa cả phiên bản kho vào khóa; lam_moi(data) thay vào đó đọc lại các
+# cột kho của dữ liệu lấy từ cache (một truy vấn theo khóa chính), nên cache vẫn trúng khi có người mượn / trả.
+def cached_response(name, theo_kho=False, lam_moi=None):
+    CACHED_ENDPOINTS.append(name)
+
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            cache = get_cache()
+            version = catalog_version()
+            if theo_kho(request) if callable(theo_kho) else theo_kho:
+                version = f'{version}.{stock_version()}'
+            # Dữ liệu có URL tuyệt đối (build_absolute_uri) nên khóa gồm cả scheme và host. Cache lưu
+            # response.data trước khi render nên định dạng trả về (Accept) không cần nằm trong khóa.
+            key = (f'thuvien:{name}:{version}:'
+                   f'{request.scheme}://{request.get_host()}{request.get_full_path()}')
+            data = cache.get(key)
+            if data is not None:
+                _count(name, 'hits')
+                if lam_moi is not None:
+                    data = lam_moi(data)
+                return Response(data, status=status.HTTP_200_OK)
+
+            _count(name, 'misses')
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, get_timeout())
+            return response
+        return wrapper
+    return decorator
+
+
+def cache_stats():
+    cache = get_cache()
+    endpoints = {}
+    total_hits = total_misses = 0
+    for name in CACHED_ENDPOINTS:
+        hits = cache.get(STATS_KEY.format(name=name, kind='hits'), 0)
+        misses = cache.get(STATS_KEY.format(name=name, kind='misses'), 0)
+        total_hits += hits
+        total_misses += misses
+        endpoints[name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+        }
+    return {
+        'backend': type(cache).__name__,
+        'version': catalog_version(),
+        'stock_version': stock_version(),
+        'hits': total_hits,
+        'misses': total_misses,
+        'hit_ratio': round(total_hits / (total_hits + total_misses), 4) if total_hits + total_misses else None,
+        'endpoints': endpoints,
+    }
+
+
+# ETag / Last-Modified lấy từ một câu aggregate (số dòng, id lớn nhất, updated_at lớn nhất)
+# trên đúng queryset của endpoint, nên không cần serialize dữ liệu mới biết có thay đổi hay không.
+# get_queryset(view, request, *args, **kwargs) trả về queryset đó; timestamps là các cột
+# thời gian cần theo dõi (vd. cả danhMuc__updated_at vì SachSerializer trả tenDanhMuc).
+def conditional_response(get_queryset, timestamps=('updated_at',)):
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            queryset = get_queryset(self, request, *args, **kwargs).order_by()
+            aggregates = {f'max_{i}': Max(field) for i, field in enumerate(timestamps)}
+            validator = queryset.aggregate(count=Count('pk'), max_id=Max('pk'), **aggregates)
+            modified = [validator[f'max_{i}'] for i in range(len(timestamps))]
+            modified = [value for value in modified if value is not None]
+            last_modified = int(max(modified).timestamp()) if modified else None
+
+            raw = '|'.join([request.get_full_path(), str(validator['count']), str(validator['max_id'])]
+                           + [value.isoformat() for value in modified])
+            etag = quote_etag(hashlib.md5(raw.encode()).hexdigest())
+
+            response = get_conditional_response(request._request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view_method(self, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,130 @@
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from .thanhtoan import MOMO_PATH, MOMO_TRUNG_DON, ZALOPAY_PATH, ZALOPAY_TRUNG_DON, cau_hinh, ky_momo, ky_zalopay
+
+# Cổng thanh toán giả lập chạy cục bộ để kiểm thử / load test không cần mạng: kiểm tra chữ ký như
+# MoMo / ZaloPay sandbox rồi trả về link thanh toán giả. delay làm chậm mỗi phản hồi, fail_rate là
+# tỉ lệ phản hồi 503 ngẫu nhiên (để thử cơ chế thử lại), lost_responses là số đơn kế tiếp được tạo nhưng
+# trả về 504 (như proxy mất phản hồi). Gửi lại một mã đơn đã tạo nhận lỗi trùng đơn như cổng thật.
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 để client giữ kết nối keep-alive giữa các request
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.dem('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _tra_ve(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.dem('requests')
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if random.random() < self.server.fail_rate:
+            return self._tra_ve(503, {'error': 'stub gateway unavailable'})
+
+        if self.path == MOMO_PATH:
+            data = json.loads(body or b'{}')
+            if data.get('signature') != ky_momo(data, cau_hinh()['MOMO']['secret_key']):
+                return self._tra_ve(200, {'resultCode': 11007, 'message': 'Invalid signature'})
+            if not self.server.ghi_don(data['orderId']):
+                return self._tra_ve(200, {'resultCode': MOMO_TRUNG_DON, 'message': 'Duplicated orderId.'})
+            if self.server.mat_phan_hoi():
+                return self._tra_ve(504, {'error': 'stub gateway timeout'})
+            return self._tra_ve(200, {
+                'partnerCode': data['partnerCode'], 'orderId': data['orderId'], 'requestId': data['requestId'],
+                'amount': data['amount'], 'resultCode': 0, 'message': 'Successful.',
+                'payUrl': f"{self.server.url}/pay/{data['orderId']}",
+            })
+        if self.path == ZALOPAY_PATH:
+            order = dict(parse_qsl(body.decode()))
+            if order.get('mac') != ky_zalopay(order, cau_hinh()['ZALOPAY']['key1']):
+                return self._tra_ve(200, {'return_code': 2, 'return_message': 'Invalid mac'})
+            if not self.server.ghi_don(order['app_trans_id']):
+                return self._tra_ve(200, {'return_code': 2, 'return_message': 'Giao dịch thất bại',
+                                          'sub_return_code': ZALOPAY_TRUNG_DON})
+            if self.server.mat_phan_hoi():
+                return self._tra_ve(504, {'error': 'stub gateway timeout'})
+            return self._tra_ve(200, {
+                'return_code': 1, 'return_message': 'Giao dịch thành công',
+                'order_url': f"{self.server.url}/pay/{order['app_trans_id']}",
+                'zp_trans_token': order['app_trans_id'],
+            })
+        return self._tra_ve(404, {'error': 'not found'})
+
+
+class GatewayStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0, fail_rate=0):
+        super().__init__((host, port), _Handler)
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.lost_responses = 0
+        self.orders = set()
+        self.stats = {'connections': 0, 'requests': 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handle_error(self, request, client_address):
+        # Client bỏ kết nối giữa chừng (vd. hết thời gian chờ) là tình huống được giả lập, không in traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def dem(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def ghi_don(self, ma_don):
+        # False khi mã đơn đã được tạo trước đó
+        with self._stats_lock:
+            if ma_don in self.orders:
+                return False
+            self.orders.add(ma_don)
+            return True
+
+    def mat_phan_hoi(self):
+        with self._stats_lock:
+            if self.lost_responses > 0:
+                self.lost_responses -= 1
+                return True
+            return False
+
+    def payment_settings(self):
+        # THUVIEN_PAYMENT trỏ các endpoint về cổng giả lập này
+        config = {**cau_hinh()}
+        config['MOMO'] = {**config['MOMO'], 'endpoint': self.url + MOMO_PATH}
+        config['ZALOPAY'] = {**config['ZALOPAY'], 'endpoint': self.url + ZALOPAY_PATH}
+        return config
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import deque, Counter
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# Đo từng request theo endpoint (viewset.action hoặc hàm view): số truy vấn, thời gian SQL, thời gian
+# render (Response đã có .data, chỉ còn ghi ra JSON; serializer.data chạy trong view nên nằm ở phần
+# total_ms - sql_ms - render_ms), kích thước phản hồi, và số truy vấn lặp lại cùng câu SQL (dấu hiệu
+# N+1). Mỗi kết nối CSDL được gắn sẵn một execute_wrapper (khi kết nối được tạo) ghi vào bộ đo của request
+# hiện tại qua ContextVar; nhờ vậy đo được cả truy vấn chạy trong sync_to_async của view async (kết nối
+# CSDL là theo thread). Mỗi truy vấn chỉ tốn một lần gọi hàm bọc và một lần cộng vào dict.
+# Số liệu gộp giữ trong bộ nhớ tiến trình: mỗi endpoint giữ SAMPLES mẫu gần nhất để tính phân vị khi
+# đọc; mỗi worker có số liệu riêng (giống bangxephang).
+SAMPLES = 1000
+CHI_SO = ('total_ms', 'sql_ms', 'render_ms', 'queries', 'duplicate_queries', 'size_bytes')
+PHAN_VI = (50, 95, 99)
+
+
+def bat():
+    return getattr(settings, 'THUVIEN_METRICS', True)
+
+
+def nguong_n_cong_1():
+    # Một câu SQL chạy từ ngần này lần trở lên trong cùng request thì bị đánh dấu N+1
+    return getattr(settings, 'THUVIEN_METRICS_N_PLUS_ONE', 5)
+
+
+class _DoLuong:
+    __slots__ = ('queries', 'sql_time', 'sql', 'started', 'rendered_at')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.sql = Counter()
+        self.started = time.perf_counter()
+        self.rendered_at = None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.queries += 1
+            self.sql[sql] += 1
+
+
+class _Endpoint:
+    def __init__(self):
+        self.requests = 0
+        self.samples = deque(maxlen=SAMPLES)
+        self.n_plus_one = 0
+        self.n_plus_one_sql = None
+        self.n_plus_one_repeats = 0
+
+
+_lock = threading.Lock()
+_endpoints = {}
+_hien_tai = ContextVar('thuvien_do_luong', default=None)
+
+
+def _boc_truy_van(execute, sql, params, many, context):
+    do_luong = _hien_tai.get()
+    if do_luong is None:
+        return execute(sql, params, many, context)
+    return do_luong(execute, sql, params, many, context)
+
+
+def gan_vao(connection):
+    # Gọi từ signal connection_created; kết nối lại trên cùng DatabaseWrapper không gắn thêm lần nữa
+    if _boc_truy_van not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_boc_truy_van)
+
+
+def ten_endpoint(request):
+    # Viewset của DRF: "<ViewSet>.<action>" (vd. SachViewSet.most_borrowed); view thường: module.hàm
+    match = request.resolver_match
+    if match is None:
+        return None
+    view = match.func
+    cls = getattr(view, 'cls', None)
+    if cls is not None:
+        action = (getattr(view, 'actions', None) or {}).get(request.method.lower(), request.method.lower())
+        return f'{cls.__name__}.{action}'
+    return f'{view.__module__}.{view.__name__}'
+
+
+def ghi_nhan(endpoint, sample, lap_lai):
+    # lap_lai: (sql, số lần) của câu SQL lặp nhiều nhất nếu vượt ngưỡng N+1
+    with _lock:
+        data = _endpoints.get(endpoint)
+        if data is None:
+            data = _endpoints[endpoint] = _Endpoint()
+        data.requests += 1
+        data.samples.append(sample)
+        if lap_lai is not None:
+            data.n_plus_one += 1
+            if lap_lai[1] >= data.n_plus_one_repeats:
+                data.n_plus_one_sql, data.n_plus_one_repeats = lap_lai
+
+
+def _phan_vi(values):
+    values = sorted(values)
+    result = {f'p{p}': values[min(len(values) - 1, len(values) * p // 100)] for p in PHAN_VI}
+    result['max'] = values[-1]
+    result['avg'] = round(sum(values) / len(values), 2)
+    return result
+
+
+def tong_hop(sort='sql_ms'):
+    # Mỗi endpoint một dòng, xếp theo tổng của chỉ số sort trên các mẫu đang giữ (mặc định tổng thời gian SQL)
+    with _lock:
+        snapshot = [(name, data.requests, list(data.samples), data.n_plus_one, data.n_plus_one_sql,
+                     data.n_plus_one_repeats) for name, data in _endpoints.items()]
+    rows = []
+    for name, requests, samples, n_plus_one, sql, repeats in snapshot:
+        row = {'endpoint': name, 'requests': requests, 'samples': len(samples)}
+        for i, chi_so in enumerate(CHI_SO):
+            row[chi_so] = _phan_vi([sample[i] for sample in samples])
+        row['n_plus_one'] = {'requests': n_plus_one, 'max_repeats': repeats, 'sql': sql}
+        rows.append((sum(sample[CHI_SO.index(sort)] for sample in samples), row))
+    rows.sort(key=lambda item: -item[0])
+    return [row for _, row in rows]
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
+
+
+class QueryMetricsMiddleware:
+    # Đặt đầu MIDDLEWARE để total_ms gồm cả các middleware khác. Chạy được cả dưới WSGI lẫn ASGI.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            self.process_template_response = self._amoc_render
+        else:
+            self.process_template_response = self._moc_render
+
+    # Response của DRF được render (ghi .data ra JSON) ngay sau hook này
+    def _moc_render(self, request, response):
+        do_luong = getattr(request, '_do_luong', None)
+        if do_luong is not None:
+            do_luong.rendered_at = time.perf_counter()
+        return response
+
+    async def _amoc_render(self, request, response):
+        return self._moc_render(request, response)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not bat():
+            return self.get_response(request)
+        do_luong = request._do_luong = _DoLuong()
+        token = _hien_tai.set(do_luong)
+        try:
+            response = self.get_response(request)
+        finally:
+            _hien_tai.reset(token)
+        return self._ket_thuc(request, response, do_luong)
+
+    async def __acall__(self, request):
+        if not bat():
+            return await self.get_response(request)
+        do_luong = request._do_luong = _DoLuong()
+        token = _hien_tai.set(do_luong)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _hien_tai.reset(token)
+        return self._ket_thuc(request, response, do_luong)
+
+    def _ket_thuc(self, request, response, do_luong):
+        endpoint = ten_endpoint(request)
+        if endpoint is None:
+            # Không ghi các URL không khớp route (404) để số endpoint không tăng vô hạn
+            return response
+        ended = time.perf_counter()
+        total_ms = round((ended - do_luong.started) * 1000, 2)
+        sql_ms = round(do_luong.sql_time * 1000, 2)
+        render_ms = round((ended - do_luong.rendered_at) * 1000, 2) if do_luong.rendered_at else 0.0
+        size = len(response.content) if not response.streaming else 0
+        duplicates = do_luong.queries - len(do_luong.sql)
+        lap_lai = None
+        if duplicates:
+            sql, repeats = do_luong.sql.most_common(1)[0]
+            if repeats >= nguong_n_cong_1():
+                lap_lai = (sql, repeats)
+        ghi_nhan(endpoint, (total_ms, sql_ms, render_ms, do_luong.queries, duplicates, size), lap_lai)
+
+        if settings.DEBUG:
+            response['X-Endpoint'] = endpoint
+            response['X-Query-Count'] = str(do_luong.queries)
+            response['X-Duplicate-Queries'] = str(duplicates)
+            response['X-SQL-Time-Ms'] = str(sql_ms)
+            response['X-Render-Time-Ms'] = str(render_ms)
+            response['X-Response-Size'] = str(size)
+            response['X-Total-Time-Ms'] = str(total_ms)
+            if lap_lai is not None:
+                response['X-N-Plus-One'] = str(lap_lai[1])
+        return response
@@ -0,0 +1,140 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+from .cache import catalog_version
+from .models import Sach
+from .timkiem import tach_tu
+
+# Gợi ý theo tiền tố (typeahead) phục vụ hoàn toàn trong bộ nhớ tiến trình: mảng khóa đã sắp xếp
+# + tìm nhị phân. Top-k của các tiền tố ngắn (nhiều kết quả nhất) được tính sẵn khi xây dựng.
+MAX_K = 20
+TIEN_TO_TINH_SAN = 3
+
+
+def refresh_interval():
+    return getattr(settings, 'THUVIEN_AUTOCOMPLETE_REFRESH', 30)
+
+
+def max_age():
+    # Làm mới định kỳ kể cả khi phiên bản catalog không đổi (an toàn khi cache bị xóa / khác tiến trình)
+    return getattr(settings, 'THUVIEN_AUTOCOMPLETE_MAX_AGE', 600)
+
+
+def chuan_hoa(text):
+    return ' '.join(tach_tu(text))
+
+
+class PrefixIndex:
+    def __init__(self, entries):
+        # entries: [(khóa đã chuẩn hóa, trọng số, giá trị)]
+        entries.sort(key=lambda entry: entry[0])
+        self.keys = [entry[0] for entry in entries]
+        self.weights = [entry[1] for entry in entries]
+        self.values = [entry[2] for entry in entries]
+
+        self.top = {}
+        for n in range(1, TIEN_TO_TINH_SAN + 1):
+            for prefix in {key[:n] for key in self.keys if len(key) >= n}:
+                self.top[prefix] = self._top_k(prefix, MAX_K)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _top_k(self, prefix, k):
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + '￿')
+        return heapq.nlargest(k, range(lo, hi), key=self.weights.__getitem__)
+
+    def search(self, prefix, k=10):
+        if not prefix:
+            return []
+        if len(prefix) <= TIEN_TO_TINH_SAN:
+            top = self.top.get(prefix, [])[:k]
+        else:
+            top = self._top_k(prefix, k)
+        return [(self.values[i], self.weights[i]) for i in top]
+
+
+class Snapshot:
+    def __init__(self, version, titles, authors):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.titles = titles
+        self.authors = authors
+
+
+def build():
+    # Trọng số = totalBorrowCount + số lượt thích; tác giả cộng trọng số của mọi sách của họ.
+    titles = []
+    authors = defaultdict(lambda: [0, None])
+    rows = Sach.objects.filter(is_active=True).values_list('id', 'tenSach', 'tenTacGia', 'totalBorrowCount',
+                                                           'soLuotThich')
+    for sach_id, ten_sach, ten_tac_gia, total_borrow, so_thich in rows.iterator(chunk_size=5000):
+        weight = total_borrow + so_thich
+        key = chuan_hoa(ten_sach)
+        if key:
+            titles.append((key, weight, (sach_id, ten_sach)))
+        key = chuan_hoa(ten_tac_gia)
+        if key:
+            authors[key][0] += weight
+            authors[key][1] = authors[key][1] or ten_tac_gia
+    return (PrefixIndex(titles),
+            PrefixIndex([(key, weight, ten) for key, (weight, ten) in authors.items()]))
+
+
+_lock = threading.Lock()
+_snapshot = None
+_refreshing = False
+
+
+def refresh():
+    global _snapshot
+    version = catalog_version()
+    titles, authors = build()
+    _snapshot = Snapshot(version, titles, authors)
+    return _snapshot
+
+
+def _refresh_background():
+    global _refreshing
+    try:
+        refresh()
+    finally:
+        _refreshing = False
+        connection.close()
+
+
+def get_index():
+    # Lần đầu xây dựng đồng bộ; sau đó khi catalog đổi phiên bản (hoặc quá cũ) thì xây dựng lại
+    # ở luồng nền và vẫn trả về bản cũ cho đến khi bản mới sẵn sàng.
+    global _refreshing
+    snapshot = _snapshot
+    if snapshot is None:
+        with _lock:
+            return _snapshot or refresh()
+
+    age = time.monotonic() - snapshot.built_at
+    stale = snapshot.version != catalog_version() or age >= max_age()
+    if stale and age >= refresh_interval() and not _refreshing:
+        with _lock:
+            if not _refreshing:
+                _refreshing = True
+                threading.Thread(target=_refresh_background, daemon=True).start()
+    return snapshot
+
+
+def autocomplete(query, k=10):
+    prefix = chuan_hoa(query)
+    snapshot = get_index()
+    return {
+        'titles': [{'id': sach_id, 'tenSach': ten_sach, 'weight': weight}
+                   for (sach_id, ten_sach), weight in snapshot.titles.search(prefix, k)],
+        'authors': [{'tenTacGia': ten_tac_gia, 'weight': weight}
+                    for ten_tac_gia, weight in snapshot.authors.search(prefix, k)],
+    }
@@ -0,0 +1,208 @@
+import asyncio
+import multiprocessing
+import os
+import secrets
+import socket
+import statistics
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import httpx
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from ThuVien import synthetic
+from ThuVien.gia_lap_thanh_toan import GatewayStub
+from ThuVien.models import NguoiDung, BinhLuan
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _PoolWSGIServer(WSGIServer):
+    # Số thread phục vụ cố định như một worker gunicorn --threads N (runserver thì mỗi request một thread)
+    def __init__(self, address, threads):
+        super().__init__(address, _QuietHandler)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._xu_ly, request, client_address)
+
+    def _xu_ly(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Command(BaseCommand):
+    help = ('So sánh số request/giây của các endpoint chờ I/O (thanh toán, thống kê, feed bình luận) giữa đường '
+            'WSGI hiện tại (viewset đồng bộ, số thread cố định) và đường ASGI (views_async chạy trên uvicorn), '
+            'cùng mức đồng thời, trên CSDL thử nghiệm chứa dữ liệu giả lập và cổng thanh toán giả lập.')
+
+    ENDPOINTS = ('payment', 'statistics', 'feed')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=self.ENDPOINTS, action='append',
+                            help='Endpoint cần đo (lặp lại được); mặc định đo tất cả.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Số request đồng thời.')
+        parser.add_argument('--requests', type=int, default=500, help='Số request mỗi lần đo.')
+        parser.add_argument('--threads', type=int, default=8, help='Số thread của server WSGI.')
+        parser.add_argument('--gateway-delay', type=float, default=0.3,
+                            help='Độ trễ của cổng thanh toán giả lập (giây).')
+        parser.add_argument('--books', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--loans', type=int, default=20000)
+        parser.add_argument('--comments', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if uvicorn is None:
+            raise CommandError('Cần cài uvicorn (pip install uvicorn) để chạy đường ASGI.')
+
+        # Chạy trên CSDL thử nghiệm riêng (giống test runner) để không đụng dữ liệu thật. Hai server và cổng
+        # giả lập chạy ở các tiến trình riêng (không tranh GIL với nhau và với bên tạo tải) nên SQLite phải
+        # dùng file thay cho CSDL trong bộ nhớ.
+        old_name = connection.settings_dict['NAME']
+        test_settings = connection.settings_dict['TEST']
+        if connection.vendor == 'sqlite' and connection.creation.is_in_memory_db(test_settings.get('NAME') or ':memory:'):
+            test_settings['NAME'] = os.path.join(tempfile.gettempdir(), 'thuvien_benchmark_asgi.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        stub = GatewayStub(delay=options['gateway_delay'])
+        overrides = override_settings(THUVIEN_PAYMENT=stub.payment_settings(), ALLOWED_HOSTS=['127.0.0.1'])
+        overrides.enable()
+        processes = []
+        try:
+            self.stdout.write('Sinh dữ liệu giả lập...')
+            synthetic.generate(books=options['books'], users=options['users'],
+                               loans=options['loans'], comments=options['comments'])
+            synthetic.cap_nhat_du_lieu_dan_xuat(search_index=False)
+            token = self._access_token()
+            sach_id = BinhLuan.objects.values_list('sach', flat=True).order_by('-created_at').first()
+
+            connections.close_all()
+            processes.append(self._fork(stub.serve_forever))
+            stub.server_close()
+            wsgi = _PoolWSGIServer(('127.0.0.1', 0), options['threads'])
+            wsgi.set_app(get_wsgi_application())
+            processes.append(self._fork(wsgi.serve_forever))
+            wsgi.server_close()
+            sock = socket.create_server(('127.0.0.1', 0))
+            asgi = uvicorn.Server(uvicorn.Config(get_asgi_application(), lifespan='off', log_level='warning',
+                                                 access_log=False))
+            processes.append(self._fork(asgi.run, sockets=[sock]))
+            urls = (('WSGI', 'http://127.0.0.1:%d' % wsgi.server_address[1]),
+                    ('ASGI', 'http://127.0.0.1:%d/async' % sock.getsockname()[1]))
+            sock.close()
+
+            rows = []
+            for endpoint in options['endpoint'] or self.ENDPOINTS:
+                for ten, base in urls:
+                    build = self._request(endpoint, base, token, sach_id)
+                    # Lượt làm nóng nhỏ (kết nối CSDL, cache, pool tới cổng) không tính vào kết quả
+                    asyncio.run(self._tai(build, min(options['concurrency'], 5), 10, retry=True))
+                    row = asyncio.run(self._tai(build, options['concurrency'], options['requests']))
+                    if row[-1] == options['requests']:
+                        raise CommandError(f'{endpoint} ({ten}): mọi request đều lỗi, kết quả đo không có ý nghĩa.')
+                    rows.append((endpoint, ten, *row))
+            self._report(rows, options)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+            overrides.disable()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _fork(self, target, **kwargs):
+        # fork để tiến trình con thừa hưởng CSDL thử nghiệm và các setting đã ghi đè
+        process = multiprocessing.get_context('fork').Process(target=target, kwargs=kwargs, daemon=True)
+        process.start()
+        return process
+
+    def _access_token(self):
+        # Token OAuth2 như ứng dụng client thật dùng cho các endpoint cần đăng nhập
+        from oauth2_provider.models import get_access_token_model
+
+        user = NguoiDung.objects.create_user(username=f'bench-{uuid.uuid4().hex[:8]}', password=secrets.token_hex())
+        token = get_access_token_model().objects.create(
+            user=user, token=secrets.token_urlsafe(32), scope='read write',
+            expires=timezone.now() + timedelta(hours=1),
+        )
+        return token.token
+
+    def _request(self, endpoint, base, token, sach_id):
+        # Trả về hàm tạo (method, url, kwargs) cho mỗi request. Đơn thanh toán gửi ẩn danh và không kèm
+        # Idempotency-Key (người gọi ẩn danh gửi khóa bị từ chối 400) nên mỗi request tạo một đơn mới.
+        auth = {'Authorization': f'Bearer {token}'}
+        if endpoint == 'payment':
+            return lambda: ('POST', f'{base}/payment/', {'headers': {'amount': '10000'}})
+        if endpoint == 'statistics':
+            return lambda: ('GET', f'{base}/sach/borrow-return-late-statistics/?granularity=day&window=90',
+                            {'headers': auth})
+        return lambda: ('GET', f'{base}/binhluan/feed/?sach_id={sach_id}', {})
+
+    async def _tai(self, build, concurrency, total, retry=False):
+        # concurrency task gửi lần lượt đến khi đủ total request. Không giữ keep-alive với cả hai server
+        # (server WSGI của Django luôn đóng kết nối khi không dùng ThreadingMixIn) để so sánh công bằng.
+        latencies, errors = [], 0
+        remaining = total
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            async def worker():
+                nonlocal remaining, errors
+                while remaining > 0:
+                    remaining -= 1
+                    method, url, kwargs = build()
+                    started = time.perf_counter()
+                    try:
+                        response = await client.request(method, url, **kwargs)
+                        while retry and response.status_code >= 500:
+                            # Server có thể chưa sẵn sàng ở lượt làm nóng
+                            await asyncio.sleep(0.1)
+                            response = await client.request(method, url, **kwargs)
+                        if response.status_code >= 400:
+                            errors += 1
+                    except httpx.HTTPError:
+                        errors += 1
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return (total / elapsed, statistics.median(latencies),
+                latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], errors)
+
+    def _report(self, rows, options):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\n{options['concurrency']} request đồng thời, {options['requests']} request mỗi lần đo, "
+            f"WSGI {options['threads']} thread, cổng thanh toán trễ {options['gateway_delay']}s"))
+        self.stdout.write(f"{'endpoint':<12}{'server':<8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'lỗi':>6}")
+        by_endpoint = {}
+        for endpoint, ten, rps, p50, p95, errors in rows:
+            by_endpoint.setdefault(endpoint, {})[ten] = rps
+            self.stdout.write(f'{endpoint:<12}{ten:<8}{rps:>10.1f}{p50:>10.1f}{p95:>10.1f}{errors:>6}')
+        for endpoint, rps in by_endpoint.items():
+            self.stdout.write(self.style.SUCCESS(f"{endpoint}: ASGI / WSGI = x{rps['ASGI'] / rps['WSGI']:.2f}"))
@@ -0,0 +1,273 @@
+import json
+import secrets
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from ThuVien import synthetic, giamsat, thanhtoan
+from ThuVien.cache import get_cache
+from ThuVien.gia_lap_thanh_toan import GatewayStub
+from ThuVien.management.commands.sinh_du_lieu import MAC_DINH
+from ThuVien.models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, DatTruoc, Thich, BinhLuan, \
+    ChiaSe
+from ThuVien.urls import router
+
+# Mẫu cho các route chi tiết không có kịch bản riêng: dòng mới nhất của bảng
+MODELS = {
+    'danhmuc': DanhMuc,
+    'sach': Sach,
+    'nguoidung': NguoiDung,
+    'phieumuon': PhieuMuon,
+    'chitietphieumuon': ChiTietPhieuMuon,
+    'dattruoc': DatTruoc,
+    'thich': Thich,
+    'binhluan': BinhLuan,
+    'chiase': ChiaSe,
+}
+
+# p50 chậm hơn baseline dưới ngưỡng này (ms) được coi là nhiễu đo
+NGUONG_MS = 1.0
+
+
+class Command(BaseCommand):
+    help = ('Gọi lần lượt mọi endpoint của router trong tiến trình (test client, token OAuth2 của một nhân viên) '
+            'và báo cáo phân vị độ trễ, số truy vấn, truy vấn lặp (N+1) của từng endpoint qua QueryMetricsMiddleware. '
+            'Endpoint ghi chạy theo kịch bản trong savepoint được rollback; endpoint ghi không có kịch bản được liệt '
+            'kê là bỏ qua. --save / --baseline lưu và so kết quả để bắt hồi quy (số truy vấn tăng, p50 chậm hơn).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--existing', action='store_true',
+                            help='Đo trên CSDL đang cấu hình (vd. sau sinh_du_lieu) thay vì CSDL thử nghiệm mới; '
+                                 'mọi thay đổi được rollback.')
+        parser.add_argument('--scale', type=float, default=0.2,
+                            help='Quy mô dữ liệu giả lập như sinh_du_lieu --scale (khi không dùng --existing).')
+        parser.add_argument('--repeat', type=int, default=20, help='Số request đo cho mỗi endpoint.')
+        parser.add_argument('--cold', action='store_true', help='Xóa cache trước mỗi request.')
+        parser.add_argument('--endpoint', action='append',
+                            help='Chỉ đo các endpoint có tên chứa chuỗi này (lặp lại được).')
+        parser.add_argument('--save', help='Ghi kết quả ra file JSON (dùng làm baseline).')
+        parser.add_argument('--baseline', help='So với file JSON đã lưu; lỗi nếu có hồi quy.')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='p50 được phép chậm hơn baseline theo tỉ lệ này (mặc định 0.5 = 50%%).')
+
+    def handle(self, *args, **options):
+        # Mặc định chạy trên CSDL thử nghiệm riêng (giống test runner) để không đụng dữ liệu thật
+        old_name = None
+        if not options['existing']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        stub = GatewayStub().start()
+        overrides = override_settings(THUVIEN_METRICS=True, THUVIEN_PAYMENT=stub.payment_settings(),
+                                      ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'])
+        overrides.enable()
+        thanhtoan.reset()
+        try:
+            if old_name is not None:
+                self.stdout.write('Sinh dữ liệu giả lập...')
+                synthetic.generate(skew=1.5, **{name: max(int(value * options['scale']), 1)
+                                                for name, value in MAC_DINH.items()})
+                synthetic.cap_nhat_du_lieu_dan_xuat()
+            # Cả lượt đo nằm trong một transaction được rollback nên --existing không để lại dữ liệu
+            with transaction.atomic():
+                ket_qua, bo_qua = self._run(options)
+                transaction.set_rollback(True)
+        finally:
+            overrides.disable()
+            thanhtoan.reset()
+            stub.stop()
+            giamsat.reset()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self._report(ket_qua, bo_qua, options)
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as f:
+                json.dump(ket_qua, f, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                self._so_sanh(ket_qua, json.load(f), options['tolerance'])
+
+    def _endpoints(self):
+        # (tên endpoint như giamsat, method, tên route, route có pk) cho mọi route của router;
+        # bỏ các route có hậu tố định dạng (.json) vì trùng view với route gốc
+        for pattern in router.urls:
+            view = pattern.callback
+            groups = pattern.pattern.regex.groupindex
+            if not getattr(view, 'actions', None) or 'format' in groups:
+                continue
+            for method, action in view.actions.items():
+                yield f'{view.cls.__name__}.{action}', method, pattern.name, 'pk' in groups
+
+    def _access_token(self):
+        from oauth2_provider.models import get_access_token_model
+
+        user = NguoiDung.objects.create_user(username=f'bench-{uuid.uuid4().hex[:8]}', password=secrets.token_hex(),
+                                             chucVu='nhan_vien')
+        token = get_access_token_model().objects.create(
+            user=user, token=secrets.token_urlsafe(32), scope='read write',
+            expires=timezone.now() + timedelta(hours=1),
+        )
+        return user, token.token
+
+    def _mau(self, user):
+        # Sách "nóng" nhất (nhiều lượt mượn, bình luận nhất với dữ liệu lệch) làm mẫu cho các route theo sách;
+        # trả về tham số query, pk mẫu và kịch bản cho từng endpoint
+        hot = Sach.objects.filter(is_active=True).order_by('-totalBorrowCount', 'pk').first()
+        if hot is None:
+            raise CommandError('CSDL chưa có sách; chạy sinh_du_lieu trước hoặc bỏ --existing.')
+        thang_truoc = timezone.localdate().replace(day=1) - timedelta(days=1)
+        theo_thang = {'month': thang_truoc.month, 'year': thang_truoc.year}
+        tham_so = {
+            'SachViewSet.search': {'q': hot.tenSach},
+            'SachViewSet.autocomplete': {'q': hot.tenSach[:3]},
+            'SachViewSet.most_borrowed': theo_thang,
+            'SachViewSet.filter_books': {**theo_thang, 'tinhTrang': 'late'},
+            'BinhLuanViewSet.list': {'sach_id': hot.pk},
+            'BinhLuanViewSet.feed': {'sach_id': hot.pk},
+            'ThichViewSet.feed': {'sach_id': hot.pk},
+            'ChiaSeViewSet.feed': {'sach_id': hot.pk},
+        }
+        pk = {
+            'SachViewSet': hot.pk,
+            'SachViewSet.by_danhmuc': hot.danhMuc_id,
+            'DanhMucViewSet': hot.danhMuc_id,
+            'NguoiDungViewSet': NguoiDung.objects.order_by('-soLuongMuon', 'pk').values_list('pk', flat=True).first(),
+        }
+
+        con_sach = list(Sach.objects.filter(is_active=True, soLuong__gt=0).order_by('-totalBorrowCount', 'pk')
+                        .values_list('pk', flat=True)[:3])
+        het_sach = Sach.objects.filter(is_active=True, soLuong=0).values_list('pk', flat=True).first()
+        tien_phat = ChiTietPhieuMuon.objects.filter(tinhTrang='late', tienPhat__gt=0, daThanhToan=False) \
+            .values_list('pk', flat=True).first()
+
+        def dang_muon():
+            ChiTietPhieuMuon.borrow_many(user, list(Sach.objects.filter(pk__in=con_sach)))
+            return list(ChiTietPhieuMuon.objects.filter(phieuMuon__docGia=user, tinhTrang='borrowed')
+                        .values_list('pk', flat=True))
+
+        # Kịch bản endpoint ghi: chuẩn bị dữ liệu (không tính vào số đo) rồi trả về (pk, body)
+        kich_ban = {
+            'SachViewSet.partial_update': lambda: (hot.pk, {'tenSach': hot.tenSach}),
+            'ThichViewSet.toggle_like': lambda: (hot.pk, {}),
+            'BinhLuanViewSet.create_comment': lambda: (hot.pk, {'content': 'Benchmark'}),
+            'ChiaSeViewSet.share': lambda: (hot.pk, {'message': 'Benchmark'}),
+            'PaymentViewSet.zalopay_create_order': lambda: (None, {'amount': 50000}),
+        }
+        if con_sach:
+            kich_ban['SachViewSet.bulk_borrow'] = lambda: (None, {'books': con_sach})
+            kich_ban['SachViewSet.bulk_return'] = lambda: (None, {'chi_tiet_ids': dang_muon()})
+            kich_ban['ChiTietPhieuMuonViewSet.return_book'] = lambda: (dang_muon()[0], {})
+        if het_sach is not None:
+            kich_ban['DatTruocViewSet.create'] = lambda: (None, {'sach': het_sach})
+            kich_ban['DatTruocViewSet.cancel'] = lambda: (DatTruoc.dat(user, het_sach).pk, {})
+        if tien_phat is not None:
+            kich_ban['PaymentViewSet.fine'] = lambda: (None, {'chi_tiet_id': tien_phat, 'gateway': 'momo'})
+        return tham_so, pk, kich_ban
+
+    def _run(self, options):
+        user, token = self._access_token()
+        # Lỗi 500 của một endpoint được ghi vào kết quả (cột status) thay vì dừng cả lượt đo
+        client = APIClient(raise_request_exception=False)
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        tham_so, pk_mau, kich_ban = self._mau(user)
+
+        cac_lan_goi, bo_qua = [], []
+        for name, method, route, co_pk in self._endpoints():
+            if options['endpoint'] and not any(part in name for part in options['endpoint']):
+                continue
+            if method != 'get' and name not in kich_ban:
+                bo_qua.append((name, method.upper(), 'không có kịch bản'))
+                continue
+            if co_pk and method == 'get':
+                cls_name = name.split('.')[0]
+                pk = pk_mau.get(name, pk_mau.get(cls_name))
+                if pk is None:
+                    pk = MODELS[route.split('-')[0]].objects.order_by('-pk').values_list('pk', flat=True).first()
+                if pk is None:
+                    bo_qua.append((name, method.upper(), 'bảng rỗng'))
+                    continue
+                cac_lan_goi.append((name, method, route, pk, tham_so.get(name, {})))
+            else:
+                cac_lan_goi.append((name, method, route, None, tham_so.get(name, {})))
+
+        def goi(name, method, route, pk, params):
+            if method == 'get':
+                url = reverse(route, kwargs={'pk': pk} if pk is not None else None)
+                return client.get(url, params)
+            # Endpoint ghi: chuẩn bị và gọi trong một savepoint rồi rollback để lần gọi sau bắt đầu như cũ
+            with transaction.atomic():
+                pk, body = kich_ban[name]()
+                url = reverse(route, kwargs={'pk': pk} if pk is not None else None)
+                response = getattr(client, method)(url, body, format='json')
+                transaction.set_rollback(True)
+            return response
+
+        # Một lượt làm nóng (cache, bảng xếp hạng, pool tới cổng thanh toán) không tính vào kết quả
+        for lan_goi in cac_lan_goi:
+            goi(*lan_goi)
+        giamsat.reset()
+
+        trang_thai = {}
+        for lan_goi in cac_lan_goi:
+            codes = trang_thai.setdefault(lan_goi[0], Counter())
+            for _ in range(options['repeat']):
+                if options['cold']:
+                    get_cache().clear()
+                codes[goi(*lan_goi).status_code] += 1
+
+        ket_qua = {}
+        for row in giamsat.tong_hop(sort='total_ms'):
+            if row['endpoint'] in trang_thai:
+                ket_qua[row['endpoint']] = {
+                    'status': sorted(trang_thai[row['endpoint']]),
+                    **{chi_so: row[chi_so] for chi_so in giamsat.CHI_SO},
+                    'n_plus_one': row['n_plus_one']['requests'],
+                }
+        # Giữ thứ tự của router để dễ so giữa các lần chạy
+        return {name: ket_qua[name] for name in trang_thai if name in ket_qua}, bo_qua
+
+    def _report(self, ket_qua, bo_qua, options):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"\n{options['repeat']} request mỗi endpoint, cache {'xóa trước mỗi request' if options['cold'] else 'nóng'}"))
+        self.stdout.write(f"{'endpoint':<48}{'status':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql ms':>9}"
+                          f"{'queries':>9}{'lặp':>6}{'N+1':>5}")
+        for name, row in ket_qua.items():
+            status = ','.join(str(code) for code in row['status'])
+            line = (f"{name:<48}{status:>8}{row['total_ms']['p50']:>9.1f}{row['total_ms']['p95']:>9.1f}"
+                    f"{row['total_ms']['p99']:>9.1f}{row['sql_ms']['p50']:>9.1f}{row['queries']['max']:>9}"
+                    f"{row['duplicate_queries']['max']:>6}{row['n_plus_one']:>5}")
+            if row['n_plus_one'] or any(code >= 400 for code in row['status']):
+                line = self.style.WARNING(line)
+            self.stdout.write(line)
+        theo_ly_do = {}
+        for name, method, ly_do in bo_qua:
+            theo_ly_do.setdefault(ly_do, []).append(f'{method} {name}')
+        for ly_do, names in theo_ly_do.items():
+            self.stdout.write(f"Bỏ qua {len(names)} endpoint ({ly_do}): {', '.join(names)}")
+
+    def _so_sanh(self, ket_qua, baseline, tolerance):
+        # Số truy vấn và mã trạng thái phải giữ nguyên; p50 được chậm hơn trong giới hạn tolerance
+        hoi_quy, so_sanh = [], 0
+        for name, cu in baseline.items():
+            moi = ket_qua.get(name)
+            if moi is None:
+                continue
+            so_sanh += 1
+            if moi['status'] != cu['status']:
+                hoi_quy.append(f"{name}: status {cu['status']} -> {moi['status']}")
+            if moi['queries']['max'] > cu['queries']['max']:
+                hoi_quy.append(f"{name}: số truy vấn {cu['queries']['max']} -> {moi['queries']['max']}")
+            p50_cu, p50_moi = cu['total_ms']['p50'], moi['total_ms']['p50']
+            if p50_moi > p50_cu * (1 + tolerance) + NGUONG_MS:
+                hoi_quy.append(f'{name}: p50 {p50_cu}ms -> {p50_moi}ms')
+        if hoi_quy:
+            raise CommandError('Hồi quy so với baseline:\n' + '\n'.join(hoi_quy))
+        self.stdout.write(self.style.SUCCESS(f'Không có hồi quy so với baseline ({so_sanh} endpoint).'))
@@ -0,0 +1,102 @@
+import statistics
+import time
+from datetime import date, timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ThuVien import synthetic
+from ThuVien.models import Sach, ChiTietPhieuMuon, BinhLuan
+
+
+class Command(BaseCommand):
+    help = ('Đo kế hoạch truy vấn (EXPLAIN) và thời gian của các truy vấn lọc "nóng" '
+            'trước và sau khi có chỉ mục, trên một CSDL thử nghiệm chứa dữ liệu giả lập.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--loans', type=int, default=200000)
+        parser.add_argument('--comments', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        # Chạy trên CSDL thử nghiệm riêng (giống test runner) để không đụng dữ liệu thật.
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write('Sinh dữ liệu giả lập...')
+            synthetic.generate(books=options['books'], users=options['users'],
+                               loans=options['loans'], comments=options['comments'])
+            self._analyze()
+
+            indexes = [(model, index) for model in apps.get_app_config('ThuVien').get_models()
+                       for index in model._meta.indexes]
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    editor.remove_index(model, index)
+            self._analyze()
+            before = self._run(options['repeat'])
+
+            with connection.schema_editor() as editor:
+                for model, index in indexes:
+                    editor.add_index(model, index)
+            self._analyze()
+            after = self._run(options['repeat'])
+
+            self._report(before, after)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _queries(self):
+        # Cửa sổ một tháng (tháng trước), đúng như các endpoint thống kê theo tháng
+        month_end = date.today().replace(day=1)
+        month_start = (month_end - timedelta(days=1)).replace(day=1)
+        sach_id = Sach.objects.order_by('id').values_list('id', flat=True).first()
+        return {
+            'sach list (is_active, -id)': lambda: Sach.objects.filter(is_active=True).order_by('-id')[:20],
+            'high_borrow_count': lambda: Sach.objects.filter(totalBorrowCount__gte=95).order_by('-id')[:20],
+            'binhluan theo sach': lambda: BinhLuan.objects.filter(sach_id=sach_id).order_by('-created_at')[:20],
+            'đang mượn theo ngayMuon': lambda: ChiTietPhieuMuon.objects.filter(
+                tinhTrang='borrowed', phieuMuon__ngayMuon__gte=month_start, phieuMuon__ngayMuon__lt=month_end),
+            'đã trả theo ngayTraThucTe': lambda: ChiTietPhieuMuon.objects.filter(
+                tinhTrang='returned', ngayTraThucTe__gte=month_start, ngayTraThucTe__lt=month_end),
+            'trễ hạn theo ngayTraThucTe': lambda: ChiTietPhieuMuon.objects.filter(
+                tinhTrang='late', ngayTraThucTe__gte=month_start, ngayTraThucTe__lt=month_end),
+        }
+
+    def _run(self, repeat):
+        results = {}
+        for name, build in self._queries().items():
+            queryset = build()
+            plan = queryset.explain()
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                if queryset.query.is_sliced:
+                    list(build())
+                else:
+                    build().count()
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = (plan, statistics.median(timings))
+        return results
+
+    def _analyze(self):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+            elif connection.vendor == 'mysql':
+                tables = [model._meta.db_table for model in apps.get_app_config('ThuVien').get_models()]
+                cursor.execute('ANALYZE TABLE ' + ', '.join(tables))
+                cursor.fetchall()
+
+    def _report(self, before, after):
+        for name in before:
+            plan_before, ms_before = before[name]
+            plan_after, ms_after = after[name]
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n== {name}'))
+            self.stdout.write(f'Trước: {ms_before:9.2f} ms\n{plan_before}')
+            self.stdout.write(f'Sau:   {ms_after:9.2f} ms\n{plan_after}')
+            speedup = ms_before / ms_after if ms_after else float('inf')
+            self.stdout.write(self.style.SUCCESS(f'Tăng tốc: x{speedup:.1f}'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien.models import NguoiDung
+
+
+class Command(BaseCommand):
+    help = ('Tính lại soLuongMuon / soLuongTra / soLuongQuaHan của NguoiDung từ lịch sử ChiTietPhieuMuon '
+            'và sửa chỗ lệch. Dùng để khởi tạo bộ đếm cho dữ liệu cũ.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        da_sua = NguoiDung.doi_soat_bo_dem(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Đã sửa bộ đếm của {da_sua} độc giả.'))
@@ -0,0 +1,29 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ThuVien.models import ThanhToan
+
+THANH_CONG = {'paid', 'success', 'succeeded', '1'}
+
+
+class Command(BaseCommand):
+    help = ('Đối soát sổ thanh toán với sao kê CSV của cổng (cột order_id, trans_id, amount, status; '
+            'status = paid / success là thành công, còn lại là thất bại) và ghi nhận các đơn còn chờ.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Đường dẫn file CSV sao kê.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['statement'], newline='', encoding='utf-8-sig') as f:
+                rows = [(row['order_id'], row.get('trans_id', ''), row['amount'],
+                         row.get('status', '').strip().lower() in THANH_CONG)
+                        for row in csv.DictReader(f)]
+        except (OSError, KeyError) as e:
+            raise CommandError(f'Không đọc được sao kê: {e}')
+        thong_ke = ThanhToan.doi_soat(rows, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f'{key}={thong_ke.get(key, 0)}' for key in
+                      ('paid', 'failed', 'matched', 'conflict', 'mismatch', 'unknown'))))
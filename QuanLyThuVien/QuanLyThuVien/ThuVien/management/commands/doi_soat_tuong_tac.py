@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien.models import Sach
+
+
+class Command(BaseCommand):
+    help = 'Đối soát bộ đếm soLuotThich / soBinhLuan / soChiaSe của Sach với các bảng tương tác và sửa chỗ lệch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        da_sua = Sach.doi_soat_tuong_tac(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Đã sửa bộ đếm của {da_sua} sách.'))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien.gia_lap_thanh_toan import GatewayStub
+
+
+class Command(BaseCommand):
+    help = ('Chạy cổng thanh toán MoMo / ZaloPay giả lập cục bộ để kiểm thử và load test không cần mạng. '
+            'Trỏ THUVIEN_PAYMENT["MOMO"/"ZALOPAY"]["endpoint"] về các địa chỉ được in ra.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--delay', type=float, default=0, help='Độ trễ mỗi phản hồi (giây).')
+        parser.add_argument('--fail-rate', type=float, default=0, help='Tỉ lệ phản hồi 503 ngẫu nhiên (0-1).')
+
+    def handle(self, *args, **options):
+        stub = GatewayStub(options['host'], options['port'], options['delay'], options['fail_rate'])
+        config = stub.payment_settings()
+        self.stdout.write(f"MoMo endpoint:    {config['MOMO']['endpoint']}")
+        self.stdout.write(f"ZaloPay endpoint: {config['ZALOPAY']['endpoint']}")
+        try:
+            stub.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server_close()
+            self.stdout.write(f"Đã nhận {stub.stats['requests']} request trên {stub.stats['connections']} kết nối.")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien.models import DatTruoc
+
+
+class Command(BaseCommand):
+    help = ('Hủy các lượt đặt trước đã đến lượt nhưng quá hạn nhận sách và chuyển bản đang giữ cho lượt chờ '
+            'kế tiếp. Chạy định kỳ (vd. mỗi giờ).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        def tien_do(thong_ke):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"... hết hạn {thong_ke['expired']}, chuyển tiếp {thong_ke['reassigned']}")
+
+        thong_ke = DatTruoc.het_han(batch_size=options['batch_size'], on_batch=tien_do)
+        self.stdout.write(self.style.SUCCESS(
+            f"Đã hủy {thong_ke['expired']} lượt đặt trước quá hạn nhận, "
+            f"chuyển {thong_ke['reassigned']} bản cho lượt chờ kế tiếp."))
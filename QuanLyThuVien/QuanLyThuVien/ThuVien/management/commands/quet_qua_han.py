@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from ThuVien.models import ChiTietPhieuMuon
+
+
+class Command(BaseCommand):
+    help = ('Quét các phiếu đang mượn đã quá ngày trả dự kiến: đánh dấu quá hạn, tính tiền phạt tạm tính '
+            'và cập nhật soLuongQuaHan của độc giả. Chạy lại an toàn; dùng --after-date để chạy tiếp khi bị dừng.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, default=None,
+                            help='Ngày tính quá hạn (YYYY-MM-DD), mặc định là hôm nay.')
+        parser.add_argument('--after-date', type=date.fromisoformat, default=None,
+                            help='Bỏ qua các ngày trả dự kiến <= ngày này (ngày cuối của lần chạy trước).')
+
+    def handle(self, *args, **options):
+        def tien_do(thong_ke):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"... đã xử lý ngày trả dự kiến {thong_ke['last_date']}, "
+                                  f"cập nhật {thong_ke['updated']} phiếu")
+
+        thong_ke = ChiTietPhieuMuon.quet_qua_han(
+            today=options['date'],
+            after_date=options['after_date'],
+            on_batch=tien_do,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Đã quét {thong_ke['dates']} ngày trả dự kiến, cập nhật {thong_ke['updated']} phiếu, "
+            f"bỏ đánh dấu {thong_ke['cleared']} phiếu đã gia hạn (ngày cuối {thong_ke['last_date']})."))
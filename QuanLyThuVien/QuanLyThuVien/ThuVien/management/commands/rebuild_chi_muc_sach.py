@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien import timkiem
+
+
+class Command(BaseCommand):
+    help = 'Xây dựng lại toàn bộ chỉ mục tìm kiếm sách (TuKhoa, TuKhoaTrigram, ChiMucSach).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        so_tu = timkiem.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Đã chỉ mục {so_tu} từ khóa.'))
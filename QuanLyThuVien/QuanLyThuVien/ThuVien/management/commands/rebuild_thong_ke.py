@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ThuVien.models import ThongKeLuuThong
+
+
+class Command(BaseCommand):
+    help = 'Xây dựng lại bảng tổng hợp lưu thông theo ngày (ThongKeLuuThong) từ lịch sử ChiTietPhieuMuon.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        ThongKeLuuThong.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Đã tổng hợp {ThongKeLuuThong.objects.count()} dòng thống kê lưu thông.'))
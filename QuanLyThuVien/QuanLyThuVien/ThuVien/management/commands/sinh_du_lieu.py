@@ -0,0 +1,69 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ThuVien import synthetic
+
+# Số dòng mặc định với --scale 1; --scale 20 cho khoảng 1 triệu phiếu mượn
+MAC_DINH = {
+    'categories': 20,
+    'books': 10000,
+    'users': 2000,
+    'loans': 50000,
+    'comments': 20000,
+    'likes': 20000,
+    'shares': 5000,
+}
+
+
+class Command(BaseCommand):
+    help = ('Sinh dữ liệu giả lập (danh mục, sách, người dùng, phiếu mượn, bình luận / thích / chia sẻ) vào CSDL '
+            'đang cấu hình bằng bulk insert theo lô, chạy được trên SQLite và MySQL. Sau đó tính lại bộ đếm, '
+            'bảng tổng hợp lưu thông và chỉ mục tìm kiếm để dữ liệu nhất quán như khi đi qua các view.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1,
+                            help='Nhân mọi số lượng mặc định (vd. 20 cho khoảng 1 triệu phiếu mượn).')
+        for name, value in MAC_DINH.items():
+            parser.add_argument(f'--{name}', type=int, default=None, help=f'Mặc định {value} x scale.')
+        parser.add_argument('--days', type=int, default=730, help='Phiếu mượn rải trong ngần này ngày gần nhất.')
+        parser.add_argument('--skew', type=float, default=1.5,
+                            help='Độ lệch độ phổ biến của sách / người dùng (1 là đều).')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--no-derived', action='store_true',
+                            help='Không tính lại bộ đếm / bảng tổng hợp / chỉ mục (nhanh hơn, dữ liệu không nhất quán).')
+        parser.add_argument('--no-search-index', action='store_true', help='Không xây dựng lại chỉ mục tìm kiếm.')
+
+    def handle(self, *args, **options):
+        counts = {name: options[name] if options[name] is not None else max(int(value * options['scale']), 1)
+                  for name, value in MAC_DINH.items()}
+        self.stdout.write(f"Sinh dữ liệu vào {connection.vendor} '{connection.settings_dict['NAME']}': "
+                          + ', '.join(f'{name}={value}' for name, value in counts.items()))
+
+        started = last = time.perf_counter()
+
+        def tien_do(name, so_dong):
+            nonlocal last
+            now = time.perf_counter()
+            if options['verbosity'] > 1 or (so_dong is None and options['verbosity'] > 0):
+                self.stdout.write(f'... {name}' + (f': {so_dong} dòng' if so_dong is not None else '')
+                                  + f' ({now - last:.1f}s)')
+            last = now
+
+        ket_qua = synthetic.generate(
+            days=options['days'], batch_size=options['batch_size'], seed=options['seed'], skew=options['skew'],
+            on_batch=tien_do, **counts,
+        )
+        inserted = time.perf_counter() - started
+        so_dong = ket_qua['loans'] * 2 + sum(value for name, value in ket_qua.items() if name != 'loans')
+        self.stdout.write(f'Đã chèn {so_dong} dòng trong {inserted:.1f}s ({so_dong / max(inserted, 1e-9):.0f} dòng/s).')
+
+        if not options['no_derived']:
+            started = last = time.perf_counter()
+            synthetic.cap_nhat_du_lieu_dan_xuat(options['batch_size'], search_index=not options['no_search_index'],
+                                                on_batch=tien_do)
+            self.stdout.write(f'Đã tính lại dữ liệu dẫn xuất trong {time.perf_counter() - started:.1f}s.')
+        self.stdout.write(self.style.SUCCESS(
+            'Xong: ' + ', '.join(f'{name}={value}' for name, value in ket_qua.items())))
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='binhluan',
+            index=models.Index(fields=['sach', '-created_at'], name='binhluan_sach_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='binhluan',
+            index=models.Index(fields=['-created_at'], name='binhluan_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chitietphieumuon',
+            index=models.Index(fields=['tinhTrang', 'ngayTraThucTe'], name='ctpm_tinhtrang_ngaytra_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chitietphieumuon',
+            index=models.Index(fields=['phieuMuon', 'tinhTrang'], name='ctpm_phieumuon_tt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phieumuon',
+            index=models.Index(fields=['ngayMuon'], name='phieumuon_ngaymuon_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sach',
+            index=models.Index(fields=['is_active', 'id'], name='sach_active_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sach',
+            index=models.Index(fields=['totalBorrowCount'], name='sach_borrow_count_idx'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F, Count, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce
+
+
+def tong_hop_lich_su(apps, schema_editor):
+    ChiTietPhieuMuon = apps.get_model('ThuVien', 'ChiTietPhieuMuon')
+    ThongKeLuuThong = apps.get_model('ThuVien', 'ThongKeLuuThong')
+
+    co_sach = ChiTietPhieuMuon.objects.filter(phieuMuon__sach__isnull=False)
+    nguon = [
+        co_sach.annotate(ngay=F('phieuMuon__ngayMuon'), tinh_trang=Value('issued')),
+        co_sach.filter(tinhTrang='borrowed').annotate(ngay=F('phieuMuon__ngayMuon'), tinh_trang=Value('borrowed')),
+        co_sach.filter(tinhTrang__in=['returned', 'late'], ngayTraThucTe__isnull=False)
+        .annotate(ngay=F('ngayTraThucTe'), tinh_trang=F('tinhTrang')),
+    ]
+    for queryset in nguon:
+        rows = queryset.values('ngay', 'phieuMuon__sach', 'tinh_trang').annotate(
+            so_luong=Count('id'),
+            tien_phat=Coalesce(Sum('tienPhat'), Value(0), output_field=DecimalField()),
+        ).order_by()
+        ThongKeLuuThong.objects.bulk_create([
+            ThongKeLuuThong(
+                ngay=row['ngay'],
+                sach_id=row['phieuMuon__sach'],
+                tinhTrang=row['tinh_trang'],
+                soLuong=row['so_luong'],
+                tienPhat=row['tien_phat'] if row['tinh_trang'] in ('returned', 'late') else 0,
+            )
+            for row in rows
+        ], batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0002_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThongKeLuuThong',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ngay', models.DateField()),
+                ('tinhTrang', models.CharField(choices=[('issued', 'Phát sinh mượn'), ('borrowed', 'Đang mượn'), ('returned', 'Đã trả'), ('late', 'Trễ hạn')], max_length=10)),
+                ('soLuong', models.IntegerField(default=0)),
+                ('tienPhat', models.DecimalField(decimal_places=0, default=0, max_digits=14)),
+                ('sach', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thong_ke_luu_thong', to='ThuVien.sach')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tinhTrang', 'ngay'], name='tkl_tinhtrang_ngay_idx')],
+                'unique_together': {('ngay', 'sach', 'tinhTrang')},
+            },
+        ),
+        migrations.RunPython(tong_hop_lich_su, migrations.RunPython.noop),
+    ]
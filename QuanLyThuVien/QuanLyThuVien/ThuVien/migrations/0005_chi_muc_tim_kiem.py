@@ -0,0 +1,45 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0004_sach_danhmuc_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TuKhoa',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tu', models.CharField(max_length=64, unique=True)),
+                ('soTrigram', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChiMucSach',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trongSo', models.IntegerField()),
+                ('sach', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chi_muc', to='ThuVien.sach')),
+                ('tuKhoa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chi_muc', to='ThuVien.tukhoa')),
+            ],
+            options={
+                'unique_together': {('tuKhoa', 'sach')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TuKhoaTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('tuKhoa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='ThuVien.tukhoa')),
+            ],
+            options={
+                'unique_together': {('trigram', 'tuKhoa')},
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def tinh_bo_dem(apps, schema_editor):
+    Sach = apps.get_model('ThuVien', 'Sach')
+    nguon = {
+        'soLuotThich': apps.get_model('ThuVien', 'Thich'),
+        'soBinhLuan': apps.get_model('ThuVien', 'BinhLuan'),
+        'soChiaSe': apps.get_model('ThuVien', 'ChiaSe'),
+    }
+    Sach.objects.update(**{
+        field: Coalesce(Subquery(
+            model.objects.filter(sach=OuterRef('pk')).order_by().values('sach').annotate(total=Count('id')).values('total')
+        ), Value(0))
+        for field, model in nguon.items()
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0005_chi_muc_tim_kiem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sach',
+            name='soBinhLuan',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sach',
+            name='soChiaSe',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sach',
+            name='soLuotThich',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='sach',
+            index=models.Index(fields=['soLuotThich'], name='sach_so_luot_thich_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sach',
+            index=models.Index(fields=['soBinhLuan'], name='sach_so_binh_luan_idx'),
+        ),
+        migrations.RunPython(tinh_bo_dem, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0006_sach_bo_dem_tuong_tac'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chitietphieumuon',
+            name='quaHan',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='chitietphieumuon',
+            index=models.Index(fields=['quaHan'], name='ctpm_quahan_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='phieumuon',
+            index=models.Index(fields=['ngayTraDuKien'], name='phieumuon_ngaytradukien_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0007_chi_tiet_qua_han'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sach',
+            name='soSachGiuCho',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='DatTruoc',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trangThai', models.CharField(choices=[('waiting', 'Đang chờ'), ('ready', 'Sẵn sàng nhận'), ('fulfilled', 'Đã mượn'), ('cancelled', 'Đã hủy'), ('expired', 'Hết hạn')], default='waiting', max_length=10)),
+                ('ngayDat', models.DateTimeField(auto_now_add=True)),
+                ('ngayGiu', models.DateTimeField(blank=True, null=True)),
+                ('hanNhan', models.DateTimeField(blank=True, null=True)),
+                ('docGia', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dat_truoc', to=settings.AUTH_USER_MODEL)),
+                ('sach', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dat_truoc', to='ThuVien.sach')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sach', 'trangThai', 'id'], name='dattruoc_hang_doi_idx'), models.Index(fields=['trangThai', 'hanNhan'], name='dattruoc_het_han_idx'), models.Index(fields=['docGia', 'trangThai'], name='dattruoc_doc_gia_idx')],
+            },
+        ),
+    ]
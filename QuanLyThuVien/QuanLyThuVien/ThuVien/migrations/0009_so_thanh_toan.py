@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:14
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0008_dat_truoc'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chitietphieumuon',
+            name='daThanhToan',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ThanhToan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('maDonHang', models.CharField(max_length=50, unique=True)),
+                ('idempotencyKey', models.CharField(max_length=150, unique=True)),
+                ('cong', models.CharField(choices=[('momo', 'MoMo'), ('zalopay', 'ZaloPay')], max_length=10)),
+                ('soTien', models.DecimalField(decimal_places=0, max_digits=12)),
+                ('trangThai', models.CharField(choices=[('pending', 'Chờ thanh toán'), ('paid', 'Đã thanh toán'), ('failed', 'Thất bại')], default='pending', max_length=10)),
+                ('payUrl', models.CharField(blank=True, max_length=500)),
+                ('maGiaoDich', models.CharField(blank=True, max_length=64)),
+                ('phanHoi', models.JSONField(blank=True, null=True)),
+                ('chiTiet', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thanh_toan', to='ThuVien.chitietphieumuon')),
+                ('docGia', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thanh_toan', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trangThai', 'created_at'], name='thanhtoan_trangthai_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ThuVien', '0009_so_thanh_toan'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chimucsach',
+            index=models.Index(fields=['tuKhoa', 'trongSo', 'sach'], name='chimuc_tukhoa_trongso_idx'),
+        ),
+    ]
@@ -1,8 +1,43 @@
-from django.db import models
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction, connection
+from django.conf import settings
+from django.db.models import Q, F, Count, Sum, Min, Value, DecimalField, Case, When, Window, OuterRef, Subquery
+from django.db.models.functions import Coalesce, RowNumber
 from django.contrib.auth.models import AbstractUser
 from cloudinary.models import CloudinaryField
 from django.utils import timezone
 
+from . import bangxephang
+from .cache import invalidate_stock
+
+TIEN_PHAT_MOI_NGAY = 3000
+
+
+def _as_date(value):
+    # ngayMuon mặc định là timezone.now (datetime) và dữ liệu từ request là chuỗi;
+    # chuẩn hóa về date giống cách DateField lưu xuống CSDL.
+    return models.DateField().to_python(value)
+
+
+def _cot_bo_dem(tinh_trang):
+    # Cột bộ đếm của NguoiDung ứng với một tình trạng của ChiTietPhieuMuon
+    return 'soLuongMuon' if tinh_trang == 'borrowed' else 'soLuongTra'
+
+
+def _ghi_thay_doi(thay_doi, muc, dau):
+    if muc is None:
+        return
+    key, tien_phat = muc
+    so_luong, tong_tien = thay_doi.get(key, (0, 0))
+    thay_doi[key] = (so_luong + dau, tong_tien + dau * tien_phat)
+
 
 class NguoiDung(AbstractUser):
     CHUC_VU_CHOICES = [
@@ -38,9 +73,73 @@ class NguoiDung(AbstractUser):
 
         super(NguoiDung, self).save(*args, **kwargs)
 
+    # Bộ đếm theo độc giả: soLuongMuon = số phiếu đang mượn, soLuongTra = số phiếu đã trả (đúng hạn hoặc
+    # trễ hạn), soLuongQuaHan = số phiếu đang mượn đã quá hạn. ChiTietPhieuMuon cập nhật chúng trong cùng
+    # transaction với thay đổi trạng thái; doi_soat_bo_dem đếm lại từ lịch sử.
+    BO_DEM = ('soLuongMuon', 'soLuongTra', 'soLuongQuaHan')
+
+    @classmethod
+    def cap_nhat_bo_dem(cls, thay_doi):
+        # thay_doi: {(docGia_id, tên cột): chênh lệch}; một câu UPDATE cho mọi độc giả và mọi cột
+        thay_doi = {key: delta for key, delta in thay_doi.items() if delta and key[0] is not None}
+        if not thay_doi:
+            return 0
+        cap_nhat = {}
+        for field in cls.BO_DEM:
+            cases = [When(pk=pk, then=Value(delta)) for (pk, cot), delta in thay_doi.items() if cot == field]
+            if cases:
+                cap_nhat[field] = F(field) + Case(*cases, default=Value(0))
+        return cls.objects.filter(pk__in={pk for pk, _ in thay_doi}).update(**cap_nhat)
+
+    @classmethod
+    def doi_soat_bo_dem(cls, batch_size=2000):
+        # Đếm lại theo từng lô id độc giả (một GROUP BY cho mỗi lô) và chỉ ghi những độc giả bị lệch.
+        # Khóa các dòng NguoiDung của lô trong lúc đếm: thao tác mượn / trả cập nhật bộ đếm trong cùng
+        # transaction với ChiTietPhieuMuon nên sẽ chờ tới khi lô được ghi xong.
+        da_sua = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                users = list(cls.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                             .only('id', *cls.BO_DEM)[:batch_size])
+                if not users:
+                    break
+                ids = [user.pk for user in users]
+                dem = {row['phieuMuon__docGia']: row for row in ChiTietPhieuMuon.objects.filter(
+                    phieuMuon__docGia__in=ids
+                ).values('phieuMuon__docGia').annotate(
+                    soLuongMuon=Count('id', filter=Q(tinhTrang='borrowed')),
+                    soLuongTra=Count('id', filter=Q(tinhTrang__in=('returned', 'late'))),
+                    soLuongQuaHan=Count('id', filter=Q(tinhTrang='borrowed', quaHan=True)),
+                ).order_by()}
+                lech = []
+                for user in users:
+                    thuc_te = dem.get(user.pk, {})
+                    if any(getattr(user, field) != thuc_te.get(field, 0) for field in cls.BO_DEM):
+                        for field in cls.BO_DEM:
+                            setattr(user, field, thuc_te.get(field, 0))
+                        lech.append(user)
+                cls.objects.bulk_update(lech, cls.BO_DEM)
+                da_sua += len(lech)
+                last_id = ids[-1]
+        return da_sua
+
+    @classmethod
+    def tinh_lai_qua_han(cls, ids):
+        # soLuongQuaHan = số phiếu đang mượn đã quá hạn (quaHan) của độc giả
+        # Một GROUP BY cho cả lô rồi bulk_update, không dùng subquery tương quan cho từng độc giả
+        if not ids:
+            return 0
+        so_qua_han = dict(ChiTietPhieuMuon.objects.filter(
+            phieuMuon__docGia__in=ids, quaHan=True, tinhTrang='borrowed'
+        ).values('phieuMuon__docGia').annotate(total=Count('id')).order_by().values_list('phieuMuon__docGia', 'total'))
+        return cls.objects.bulk_update([cls(pk=pk, soLuongQuaHan=so_qua_han.get(pk, 0)) for pk in ids],
+                                       ['soLuongQuaHan'], batch_size=1000)
+
 # Category model
 class DanhMuc(models.Model):
     tenDanhMuc = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.tenDanhMuc
@@ -53,25 +152,176 @@ class Sach(models.Model):
     namXB = models.IntegerField()
     soLuong = models.IntegerField()
     soSachDangMuon = models.IntegerField(default=0)
+    # Số bản đã trả về nhưng đang giữ cho độc giả đặt trước (DatTruoc 'ready'), không nằm trong soLuong
+    soSachGiuCho = models.IntegerField(default=0)
     danhMuc = models.ForeignKey(DanhMuc, on_delete=models.CASCADE, related_name="books")
     anhSach = CloudinaryField('anhSach', null=True, blank=True)
     totalBorrowCount = models.IntegerField(default=0)
     is_active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Bộ đếm tương tác, cập nhật cùng transaction với Thich / BinhLuan / ChiaSe (xem signals.py)
+    soLuotThich = models.IntegerField(default=0)
+    soBinhLuan = models.IntegerField(default=0)
+    soChiaSe = models.IntegerField(default=0)
+
+    # Số lượng / bộ đếm đổi theo mượn, trả, giữ chỗ, tương tác; chỉ các cột này đổi thì nội dung catalog
+    # (tên, tác giả, danh mục) vẫn như cũ (xem cache.invalidate_stock)
+    COT_KHO = ('soLuong', 'soSachDangMuon', 'soSachGiuCho', 'totalBorrowCount', 'soLuotThich', 'soBinhLuan',
+               'soChiaSe', 'updated_at')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_active', 'id'], name='sach_active_id_idx'),
+            models.Index(fields=['totalBorrowCount'], name='sach_borrow_count_idx'),
+            models.Index(fields=['soLuotThich'], name='sach_so_luot_thich_idx'),
+            models.Index(fields=['soBinhLuan'], name='sach_so_binh_luan_idx'),
+        ]
+
     def __str__(self):
         return self.tenSach
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # Giá trị lúc nạp, để các signal biết save() đổi những cột nào (xem cot_da_doi)
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def cot_da_doi(self):
+        # Các cột khác với lúc nạp từ CSDL; None nếu không biết (đối tượng chưa được nạp từ CSDL)
+        da_nap = getattr(self, '_loaded_values', None)
+        if da_nap is None:
+            return None
+        return {field.attname for field in self._meta.concrete_fields
+                if field.attname in da_nap and getattr(self, field.attname) != da_nap[field.attname]}
+
+    # Cập nhật bộ đếm bằng một câu UPDATE có điều kiện trong CSDL: không mất cập nhật khi
+    # nhiều người mượn cùng lúc, không bao giờ xuống dưới 0 và chỉ ghi các cột bộ đếm.
+    # update() bỏ qua auto_now nên phải tự ghi updated_at (dùng cho ETag / Last-Modified).
     def borrow_book(self):
-        if self.soLuong > 0:
+        updated = Sach.objects.filter(pk=self.pk, soLuong__gt=0).update(
+            soLuong=F('soLuong') - 1,
+            soSachDangMuon=F('soSachDangMuon') + 1,
+            totalBorrowCount=F('totalBorrowCount') + 1,
+            updated_at=timezone.now(),
+        )
+        if updated:
             self.soLuong -= 1
             self.soSachDangMuon += 1
             self.totalBorrowCount += 1
-            self.save()
+            invalidate_stock()
+        return bool(updated)
 
     def return_book(self):
-        if self.soSachDangMuon > 0:
+        updated = Sach.objects.filter(pk=self.pk, soSachDangMuon__gt=0).update(
+            soLuong=F('soLuong') + 1,
+            soSachDangMuon=F('soSachDangMuon') - 1,
+            updated_at=timezone.now(),
+        )
+        if updated:
             self.soLuong += 1
             self.soSachDangMuon -= 1
-            self.save()
+            invalidate_stock()
+        return bool(updated)
+
+    # Phiên bản theo lô: một câu UPDATE cho mọi sách, so_luong là {sach_id: số bản}; trả về False nếu có
+    # sách không đủ bản (caller rollback cả lô).
+    @classmethod
+    def borrow_books(cls, so_luong):
+        if not so_luong:
+            return True
+        so_ban = Case(*[When(pk=pk, then=Value(n)) for pk, n in so_luong.items()], default=Value(0))
+        updated = cls.objects.filter(pk__in=so_luong, soLuong__gte=so_ban).update(
+            soLuong=F('soLuong') - so_ban,
+            soSachDangMuon=F('soSachDangMuon') + so_ban,
+            totalBorrowCount=F('totalBorrowCount') + so_ban,
+            updated_at=timezone.now(),
+        )
+        invalidate_stock()
+        return updated == len(so_luong)
+
+    @classmethod
+    def return_books(cls, so_luong):
+        if not so_luong:
+            return True
+        so_ban = Case(*[When(pk=pk, then=Value(n)) for pk, n in so_luong.items()], default=Value(0))
+        updated = cls.objects.filter(pk__in=so_luong, soSachDangMuon__gte=so_ban).update(
+            soLuong=F('soLuong') + so_ban,
+            soSachDangMuon=F('soSachDangMuon') - so_ban,
+            updated_at=timezone.now(),
+        )
+        invalidate_stock()
+        return updated == len(so_luong)
+
+    # Chuyển bản sách giữa kho (soLuong) và phần đang giữ cho độc giả đặt trước (soSachGiuCho),
+    # so_luong là {sach_id: số bản}; dau = 1 là giữ chỗ, -1 là trả bản giữ về kho.
+    @classmethod
+    def chuyen_giu_cho(cls, so_luong, dau=1):
+        so_luong = {pk: n for pk, n in so_luong.items() if n}
+        if not so_luong:
+            return 0
+        so_ban = Case(*[When(pk=pk, then=Value(n)) for pk, n in so_luong.items()], default=Value(0))
+        nguon = {'soLuong__gte': so_ban} if dau > 0 else {'soSachGiuCho__gte': so_ban}
+        updated = cls.objects.filter(pk__in=so_luong, **nguon).update(
+            soLuong=F('soLuong') - dau * so_ban,
+            soSachGiuCho=F('soSachGiuCho') + dau * so_ban,
+            updated_at=timezone.now(),
+        )
+        invalidate_stock()
+        return updated
+
+    @classmethod
+    def cap_nhat_tuong_tac(cls, sach_id, field, delta):
+        # field: 'soLuotThich' | 'soBinhLuan' | 'soChiaSe'
+        updated = cls.objects.filter(pk=sach_id).update(**{field: F(field) + delta, 'updated_at': timezone.now()})
+        if updated:
+            invalidate_stock()
+            for metric, cot in bangxephang.COT_SACH.items():
+                if cot == field:
+                    transaction.on_commit(partial(bangxephang.ghi_nhan, metric, sach_id, delta))
+        return bool(updated)
+
+    @classmethod
+    def doi_soat_tuong_tac(cls, batch_size=2000):
+        # Đếm lại từ các bảng tương tác theo từng lô id và chỉ ghi những sách bị lệch.
+        # Khóa các dòng Sach của lô trong lúc đếm; các view thích / bình luận / chia sẻ cũng khóa
+        # dòng Sach trước khi ghi nên không chen vào giữa lúc đếm và lúc ghi.
+        nguon = (('soLuotThich', Thich), ('soBinhLuan', BinhLuan), ('soChiaSe', ChiaSe))
+        da_sua = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                books = list(cls.objects.select_for_update().filter(pk__gt=last_id).order_by('pk')
+                             .only('id', 'soLuotThich', 'soBinhLuan', 'soChiaSe', 'updated_at')[:batch_size])
+                if not books:
+                    break
+                ids = [book.pk for book in books]
+                dem = {
+                    field: dict(model.objects.filter(sach_id__in=ids).values('sach')
+                                .annotate(total=Count('id')).values_list('sach', 'total'))
+                    for field, model in nguon
+                }
+                lech = []
+                for book in books:
+                    thuc_te = {field: dem[field].get(book.pk, 0) for field, _ in nguon}
+                    if any(getattr(book, field) != value for field, value in thuc_te.items()):
+                        for field, value in thuc_te.items():
+                            setattr(book, field, value)
+                        book.updated_at = timezone.now()
+                        lech.append(book)
+                cls.objects.bulk_update(lech, [field for field, _ in nguon] + ['updated_at'])
+                if lech:
+                    invalidate_stock()
+                da_sua += len(lech)
+                last_id = ids[-1]
+        if da_sua:
+            bangxephang.reset(*bangxephang.COT_SACH)
+        return da_sua
+
+class PhieuMuonQuerySet(models.QuerySet):
+    def with_related(self):
+        return self.select_related('docGia', 'sach__danhMuc')
+
 
 class PhieuMuon(models.Model):
     docGia = models.ForeignKey(NguoiDung, on_delete=models.CASCADE)
@@ -79,9 +329,24 @@ class PhieuMuon(models.Model):
     ngayMuon = models.DateField(default=timezone.now)
     ngayTraDuKien = models.DateField()
 
+    objects = PhieuMuonQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ngayMuon'], name='phieumuon_ngaymuon_idx'),
+            models.Index(fields=['ngayTraDuKien'], name='phieumuon_ngaytradukien_idx'),
+        ]
+
     def __str__(self):
         return f"Phiếu mượn sách #{self.sach.tenSach} - {self.id} - {self.docGia.username} - Ngày mượn: {self.ngayMuon} - Ngày trả dự kiến: {self.ngayTraDuKien}"
 
+class ChiTietPhieuMuonQuerySet(models.QuerySet):
+    # Nạp sẵn phiếu mượn, độc giả, sách và danh mục trong cùng một câu JOIN
+    # để serializer không phát sinh truy vấn cho từng dòng.
+    def with_related(self):
+        return self.select_related('phieuMuon__docGia', 'phieuMuon__sach__danhMuc')
+
+
 class ChiTietPhieuMuon(models.Model):
     STATUS_CHOICES = (
         ('borrowed', 'Đang mượn'),
@@ -94,30 +359,457 @@ class ChiTietPhieuMuon(models.Model):
     tinhTrang = models.CharField(max_length=10, choices=STATUS_CHOICES, default='borrowed')
     tienPhat = models.DecimalField(max_digits=10, decimal_places=0, null=True, blank=True)
     ghiChu = models.TextField(null=True, blank=True)
+    # Đang mượn và đã quá ngayTraDuKien; do lệnh quet_qua_han đánh dấu, tienPhat khi đó là tiền phạt tạm tính
+    quaHan = models.BooleanField(default=False)
+    # Tiền phạt đã được thanh toán qua cổng (ThanhToan.xac_nhan / doi_soat)
+    daThanhToan = models.BooleanField(default=False)
+
+    objects = ChiTietPhieuMuonQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Thống kê trả/trễ hạn: WHERE tinhTrang = ? AND ngayTraThucTe BETWEEN ...
+            models.Index(fields=['tinhTrang', 'ngayTraThucTe'], name='ctpm_tinhtrang_ngaytra_idx'),
+            # Thống kê đang mượn: JOIN phiếu mượn (lọc theo ngayMuon) rồi lọc tinhTrang
+            models.Index(fields=['phieuMuon', 'tinhTrang'], name='ctpm_phieumuon_tt_idx'),
+            models.Index(fields=['quaHan'], name='ctpm_quahan_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
 
     def save(self, *args, **kwargs):
         sach = None
         if self.phieuMuon:
             sach = self.phieuMuon.sach
 
-        if not self.pk:
-            if sach:
-                sach.borrow_book()
-        if self.ngayTraThucTe:
-            if self.ngayTraThucTe > self.phieuMuon.ngayTraDuKien:
-                days_late = (self.ngayTraThucTe - self.phieuMuon.ngayTraDuKien).days
-                self.tienPhat = days_late * 3000
-                self.tinhTrang = 'late'
+        is_new = not self.pk
+        trang_thai_cu = None if is_new else self._trang_thai_cu()
+
+        with transaction.atomic():
+            if is_new and sach:
+                DatTruoc.nhan_sach(self.phieuMuon.docGia_id, {sach.pk: 1})
+                if not sach.borrow_book():
+                    raise ValidationError('Sách đã hết.')
+            qua_han = self.quaHan and not is_new
+            if self.ngayTraThucTe:
+                self._tinh_tien_phat()
+
+                # Chỉ hoàn sách khi chuyển từ 'đang mượn' sang đã trả, lưu lại lần nữa không cộng thêm
+                if sach and (trang_thai_cu is None or trang_thai_cu[0] == 'borrowed'):
+                    if sach.return_book():
+                        DatTruoc.phan_bo({sach.pk: 1})
+
+            super().save(*args, **kwargs)
+
+            # Bộ đếm của độc giả theo hiệu giữa trạng thái cũ và mới
+            doc_gia_id = self.phieuMuon.docGia_id if self.phieuMuon else None
+            bo_dem = Counter()
+            if trang_thai_cu:
+                bo_dem[(doc_gia_id, _cot_bo_dem(trang_thai_cu[0]))] -= 1
+            bo_dem[(doc_gia_id, _cot_bo_dem(self.tinhTrang))] += 1
+            bo_dem[(doc_gia_id, 'soLuongQuaHan')] += self.quaHan - qua_han
+            NguoiDung.cap_nhat_bo_dem(bo_dem)
+
+            # Cập nhật bảng tổng hợp theo ngày bằng hiệu giữa trạng thái cũ và mới
+            thay_doi = {}
+            if is_new:
+                _ghi_thay_doi(thay_doi, self._muc_thong_ke('issued'), 1)
+            if trang_thai_cu:
+                _ghi_thay_doi(thay_doi, self._muc_thong_ke(*trang_thai_cu), -1)
+            _ghi_thay_doi(thay_doi, self._muc_thong_ke(*self._trang_thai()), 1)
+            ThongKeLuuThong.cap_nhat(thay_doi)
+
+        self._loaded_values = {
+            'tinhTrang': self.tinhTrang,
+            'ngayTraThucTe': self.ngayTraThucTe,
+            'tienPhat': self.tienPhat,
+        }
+
+    def _tinh_tien_phat(self):
+        ngay_tra = _as_date(self.ngayTraThucTe)
+        ngay_tra_du_kien = _as_date(self.phieuMuon.ngayTraDuKien)
+        self.quaHan = False
+        if ngay_tra > ngay_tra_du_kien:
+            days_late = (ngay_tra - ngay_tra_du_kien).days
+            self.tienPhat = days_late * TIEN_PHAT_MOI_NGAY
+            self.tinhTrang = 'late'
+        else:
+            self.tienPhat = None
+            self.tinhTrang = 'returned'
+
+    # Mượn nhiều sách cùng lúc: một UPDATE bộ đếm có điều kiện, hai bulk_create và một lần
+    # cập nhật bảng tổng hợp, thay cho chuỗi save() riêng lẻ của từng cuốn.
+    @classmethod
+    def borrow_many(cls, doc_gia, danh_sach_sach, so_ngay_muon=7):
+        ngay_muon = timezone.localdate()
+        ngay_tra_du_kien = ngay_muon + timedelta(days=so_ngay_muon)
+
+        with transaction.atomic():
+            so_luong = Counter(sach.pk for sach in danh_sach_sach)
+            DatTruoc.nhan_sach(doc_gia.pk, so_luong)
+            if not Sach.borrow_books(so_luong):
+                raise ValidationError('Sách đã hết.')
+
+            phieu_muon_list = [
+                PhieuMuon(docGia=doc_gia, sach=sach, ngayMuon=ngay_muon, ngayTraDuKien=ngay_tra_du_kien)
+                for sach in danh_sach_sach
+            ]
+            if connection.features.can_return_rows_from_bulk_insert:
+                PhieuMuon.objects.bulk_create(phieu_muon_list)
             else:
-                self.tinhTrang = 'returned'
+                # MySQL không trả id sau bulk_create và không đoán được id từ bộ lọc (có thể khớp phiếu cũ
+                # chưa có chi tiết), nên tạo từng phiếu (mỗi lần mượn chỉ vài cuốn)
+                for phieu_muon in phieu_muon_list:
+                    phieu_muon.save(force_insert=True)
+
+            chi_tiet_list = cls.objects.bulk_create([cls(phieuMuon=phieu_muon) for phieu_muon in phieu_muon_list])
+
+            thay_doi = {}
+            for chi_tiet in chi_tiet_list:
+                _ghi_thay_doi(thay_doi, chi_tiet._muc_thong_ke('issued'), 1)
+                _ghi_thay_doi(thay_doi, chi_tiet._muc_thong_ke('borrowed'), 1)
+            ThongKeLuuThong.cap_nhat(thay_doi)
+            NguoiDung.cap_nhat_bo_dem({(doc_gia.pk, 'soLuongMuon'): len(chi_tiet_list)})
+        return chi_tiet_list
+
+    # Trả nhiều sách cùng lúc; chi_tiet_list là các dòng 'đang mượn' đã nạp kèm phiếu mượn.
+    @classmethod
+    def return_many(cls, chi_tiet_list, ngay_tra=None):
+        ngay_tra = ngay_tra or timezone.localdate()
+
+        with transaction.atomic():
+            thay_doi = {}
+            bo_dem = Counter()
+            for chi_tiet in chi_tiet_list:
+                doc_gia_id = chi_tiet.phieuMuon.docGia_id
+                _ghi_thay_doi(thay_doi, chi_tiet._muc_thong_ke(*chi_tiet._trang_thai()), -1)
+                bo_dem[(doc_gia_id, _cot_bo_dem(chi_tiet.tinhTrang))] -= 1
+                bo_dem[(doc_gia_id, 'soLuongQuaHan')] -= chi_tiet.quaHan
+                chi_tiet.ngayTraThucTe = ngay_tra
+                chi_tiet._tinh_tien_phat()
+                _ghi_thay_doi(thay_doi, chi_tiet._muc_thong_ke(*chi_tiet._trang_thai()), 1)
+                bo_dem[(doc_gia_id, 'soLuongTra')] += 1
+
+            cls.objects.bulk_update(chi_tiet_list, ['ngayTraThucTe', 'tinhTrang', 'tienPhat', 'quaHan'])
+            NguoiDung.cap_nhat_bo_dem(bo_dem)
+            tra_sach = Counter(chi_tiet.phieuMuon.sach_id for chi_tiet in chi_tiet_list if chi_tiet.phieuMuon.sach_id)
+            if not Sach.return_books(tra_sach):
+                raise ValidationError('Số sách đang mượn không khớp với các phiếu trả.')
+            DatTruoc.phan_bo(tra_sach)
+            ThongKeLuuThong.cap_nhat(thay_doi)
+        return chi_tiet_list
+
+    # Quét các phiếu đang mượn đã quá hạn. Tiền phạt tạm tính chỉ phụ thuộc ngayTraDuKien nên phiếu được đọc
+    # theo từng khối ngày (một truy vấn theo khoảng ngày), gom theo ngày trả dự kiến và mỗi ngày là một câu
+    # UPDATE theo khóa chính cho các phiếu chưa đúng giá trị, rồi tính lại soLuongQuaHan của các độc giả vừa
+    # có phiếu quá hạn. Mỗi ngày là một transaction nên có thể dừng và chạy tiếp từ after_date; chạy lại cùng
+    # ngày không ghi gì thêm.
+    @classmethod
+    def quet_qua_han(cls, today=None, after_date=None, on_batch=None, block_days=31):
+        today = today or timezone.localdate()
+        dang_mo = cls.objects.filter(tinhTrang='borrowed', ngayTraThucTe__isnull=True)
+        thong_ke = {'dates': 0, 'updated': 0, 'cleared': 0, 'last_date': after_date}
+
+        with transaction.atomic():
+            # Phiếu được gia hạn (ngayTraDuKien lùi về sau) không còn quá hạn
+            da_gia_han = dang_mo.filter(quaHan=True, phieuMuon__ngayTraDuKien__gte=today)
+            doc_gia = set(da_gia_han.values_list('phieuMuon__docGia', flat=True))
+            thong_ke['cleared'] = da_gia_han.update(quaHan=False, tienPhat=None)
+            NguoiDung.tinh_lai_qua_han(doc_gia)
+
+        qua_han = dang_mo.filter(phieuMuon__ngayTraDuKien__lt=today)
+        if after_date:
+            qua_han = qua_han.filter(phieuMuon__ngayTraDuKien__gt=after_date)
+        dau = qua_han.aggregate(ngay=Min('phieuMuon__ngayTraDuKien'))['ngay']
+        while dau is not None and dau < today:
+            cuoi = min(dau + timedelta(days=block_days), today)
+            rows = qua_han.filter(phieuMuon__ngayTraDuKien__gte=dau, phieuMuon__ngayTraDuKien__lt=cuoi) \
+                .order_by('phieuMuon__ngayTraDuKien').values_list('phieuMuon__ngayTraDuKien', 'pk', 'phieuMuon__docGia',
+                                                                  'quaHan', 'tienPhat')
+            for ngay, nhom in groupby(rows, key=itemgetter(0)):
+                tien_phat = Decimal((today - ngay).days * TIEN_PHAT_MOI_NGAY)
+                can_sua = [(pk, doc_gia, da_qua_han) for _, pk, doc_gia, da_qua_han, tien in nhom
+                           if not (da_qua_han and tien == tien_phat)]
+                if can_sua:
+                    with transaction.atomic():
+                        # Lọc lại theo dang_mo: phiếu vừa được trả sau lúc đọc thì không bị đánh dấu
+                        thong_ke['updated'] += dang_mo.filter(pk__in=[pk for pk, _, _ in can_sua]) \
+                            .update(quaHan=True, tienPhat=tien_phat)
+                        NguoiDung.tinh_lai_qua_han({doc_gia for _, doc_gia, da_qua_han in can_sua if not da_qua_han})
+                thong_ke['dates'] += 1
+                thong_ke['last_date'] = ngay
+                if on_batch:
+                    on_batch(thong_ke)
+            dau = cuoi
+        return thong_ke
+
+    def _trang_thai(self):
+        return self.tinhTrang, self.ngayTraThucTe, self.tienPhat
+
+    def _trang_thai_cu(self):
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None or not {'tinhTrang', 'ngayTraThucTe', 'tienPhat'} <= loaded.keys():
+            loaded = ChiTietPhieuMuon.objects.filter(pk=self.pk) \
+                .values('tinhTrang', 'ngayTraThucTe', 'tienPhat').first()
+            if loaded is None:
+                return None
+        return loaded['tinhTrang'], loaded['ngayTraThucTe'], loaded['tienPhat']
+
+    def _muc_thong_ke(self, tinh_trang, ngay_tra=None, tien_phat=None):
+        # Khóa (ngày, sách, trạng thái) của dòng này trong ThongKeLuuThong: phát sinh mượn
+        # và đang mượn tính theo ngày mượn, đã trả / trễ hạn tính theo ngày trả thực tế.
+        phieu_muon = self.phieuMuon
+        if phieu_muon is None or phieu_muon.sach_id is None:
+            return None
+        if tinh_trang in ('issued', 'borrowed'):
+            ngay, tien_phat = _as_date(phieu_muon.ngayMuon), 0
+        else:
+            ngay = _as_date(ngay_tra)
+        if ngay is None:
+            return None
+        return (ngay, phieu_muon.sach_id, tinh_trang), Decimal(tien_phat or 0)
 
-            if sach:
-                sach.return_book()
+    def __str__(self):
+        return f"{self.phieuMuon.sach.tenSach} - {self.phieuMuon.docGia.username}"
+
+# Bảng tổng hợp lưu thông theo (ngày, sách, trạng thái). 'issued' đếm số lượt mượn phát
+# sinh theo ngày mượn; các trạng thái còn lại phản ánh tình trạng hiện tại của ChiTietPhieuMuon.
+class ThongKeLuuThong(models.Model):
+    TINH_TRANG_CHOICES = (('issued', 'Phát sinh mượn'),) + ChiTietPhieuMuon.STATUS_CHOICES
 
-        super().save(*args, **kwargs)
+    ngay = models.DateField()
+    sach = models.ForeignKey(Sach, on_delete=models.CASCADE, related_name='thong_ke_luu_thong')
+    tinhTrang = models.CharField(max_length=10, choices=TINH_TRANG_CHOICES)
+    soLuong = models.IntegerField(default=0)
+    tienPhat = models.DecimalField(max_digits=14, decimal_places=0, default=0)
+
+    class Meta:
+        unique_together = ('ngay', 'sach', 'tinhTrang')
+        indexes = [
+            models.Index(fields=['tinhTrang', 'ngay'], name='tkl_tinhtrang_ngay_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.phieuMuon.sach.tenSach} - {self.phieuMuon.docGia.username}"
+        return f'{self.ngay} - {self.sach_id} - {self.tinhTrang}: {self.soLuong}'
+
+    @classmethod
+    def cap_nhat(cls, thay_doi):
+        # thay_doi: {(ngay, sach_id, tinhTrang): (so_luong, tien_phat)}
+        thay_doi = {key: value for key, value in thay_doi.items() if value != (0, 0)}
+        if not thay_doi:
+            return
+        with transaction.atomic():
+            cls.objects.bulk_create([
+                cls(ngay=ngay, sach_id=sach_id, tinhTrang=tinh_trang)
+                for ngay, sach_id, tinh_trang in thay_doi
+            ], ignore_conflicts=True)
+
+            dieu_kien = Q()
+            for ngay, sach_id, tinh_trang in thay_doi:
+                dieu_kien |= Q(ngay=ngay, sach_id=sach_id, tinhTrang=tinh_trang)
+            rows = list(cls.objects.select_for_update().filter(dieu_kien))
+            for row in rows:
+                so_luong, tien_phat = thay_doi[(row.ngay, row.sach_id, row.tinhTrang)]
+                row.soLuong += so_luong
+                row.tienPhat += tien_phat
+            cls.objects.bulk_update(rows, ['soLuong', 'tienPhat'])
+            transaction.on_commit(partial(bangxephang.ghi_nhan_luu_thong, thay_doi))
+
+    @classmethod
+    def rebuild(cls, batch_size=5000):
+        co_sach = ChiTietPhieuMuon.objects.filter(phieuMuon__sach__isnull=False)
+        nguon = [
+            co_sach.annotate(ngay=F('phieuMuon__ngayMuon'), tinh_trang=Value('issued')),
+            co_sach.filter(tinhTrang='borrowed')
+            .annotate(ngay=F('phieuMuon__ngayMuon'), tinh_trang=Value('borrowed')),
+            co_sach.filter(tinhTrang__in=['returned', 'late'], ngayTraThucTe__isnull=False)
+            .annotate(ngay=F('ngayTraThucTe'), tinh_trang=F('tinhTrang')),
+        ]
+        with transaction.atomic():
+            cls.objects.all().delete()
+            for queryset in nguon:
+                rows = queryset.values('ngay', 'phieuMuon__sach', 'tinh_trang').annotate(
+                    so_luong=Count('id'),
+                    tien_phat=Coalesce(Sum('tienPhat'), Value(0), output_field=DecimalField()),
+                ).order_by()
+                batch = []
+                for row in rows.iterator(chunk_size=batch_size):
+                    batch.append(cls(
+                        ngay=row['ngay'],
+                        sach_id=row['phieuMuon__sach'],
+                        tinhTrang=row['tinh_trang'],
+                        soLuong=row['so_luong'],
+                        tienPhat=row['tien_phat'] if row['tinh_trang'] in ('returned', 'late') else 0,
+                    ))
+                    if len(batch) >= batch_size:
+                        cls.objects.bulk_create(batch)
+                        batch = []
+                cls.objects.bulk_create(batch)
+            transaction.on_commit(partial(bangxephang.reset, *bangxephang.LUU_THONG))
+
+
+def han_nhan_sach(now):
+    return now + timedelta(days=getattr(settings, 'THUVIEN_HOLD_PICKUP_DAYS', 3))
+
+
+class DatTruocQuerySet(models.QuerySet):
+    # viTri: thứ tự trong hàng đợi của lượt đang chờ (1 là lượt kế tiếp), None với các trạng thái khác;
+    # subquery đếm chạy trên chỉ mục (sach, trangThai, id)
+    def with_related(self):
+        truoc = DatTruoc.objects.filter(sach=OuterRef('sach'), trangThai='waiting', id__lte=OuterRef('id')) \
+            .order_by().values('sach').annotate(total=Count('id')).values('total')
+        return self.select_related('sach').annotate(viTri=Case(When(trangThai='waiting', then=Subquery(truoc))))
+
+
+# Hàng đợi đặt trước sách đã hết, FIFO theo id trên từng sách. Khi có bản được trả, lượt chờ đầu
+# tiên chuyển sang 'ready' và bản đó được giữ (Sach.soSachGiuCho) tới hanNhan; độc giả mượn sách
+# thì lượt đặt trước thành 'fulfilled', quá hạn nhận thì 'expired' và bản giữ chuyển cho lượt kế.
+# Mọi thay đổi trạng thái đều cập nhật (khóa) dòng Sach trước nên các thao tác trên cùng một
+# sách được tuần tự hóa.
+class DatTruoc(models.Model):
+    TRANG_THAI_CHOICES = (
+        ('waiting', 'Đang chờ'),
+        ('ready', 'Sẵn sàng nhận'),
+        ('fulfilled', 'Đã mượn'),
+        ('cancelled', 'Đã hủy'),
+        ('expired', 'Hết hạn'),
+    )
+    DANG_HOAT_DONG = ('waiting', 'ready')
+
+    objects = DatTruocQuerySet.as_manager()
+
+    docGia = models.ForeignKey(NguoiDung, on_delete=models.CASCADE, related_name='dat_truoc')
+    sach = models.ForeignKey(Sach, on_delete=models.CASCADE, related_name='dat_truoc')
+    trangThai = models.CharField(max_length=10, choices=TRANG_THAI_CHOICES, default='waiting')
+    ngayDat = models.DateTimeField(auto_now_add=True)
+    ngayGiu = models.DateTimeField(null=True, blank=True)
+    hanNhan = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Lượt kế tiếp: WHERE sach = ? AND trangThai = 'waiting' ORDER BY id
+            models.Index(fields=['sach', 'trangThai', 'id'], name='dattruoc_hang_doi_idx'),
+            # Quét hết hạn: WHERE trangThai = 'ready' AND hanNhan < ?
+            models.Index(fields=['trangThai', 'hanNhan'], name='dattruoc_het_han_idx'),
+            models.Index(fields=['docGia', 'trangThai'], name='dattruoc_doc_gia_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.docGia_id} - {self.sach_id}: {self.trangThai}'
+
+    @classmethod
+    def dat(cls, doc_gia, sach_id):
+        with transaction.atomic():
+            sach = Sach.objects.select_for_update().get(pk=sach_id)
+            if sach.soLuong > 0:
+                raise ValidationError('Sách vẫn còn, có thể mượn ngay.')
+            if cls.objects.filter(docGia=doc_gia, sach=sach, trangThai__in=cls.DANG_HOAT_DONG).exists():
+                raise ValidationError('Bạn đã đặt trước sách này.')
+            return cls.objects.create(docGia=doc_gia, sach=sach)
+
+    def huy(self):
+        with transaction.atomic():
+            list(Sach.objects.select_for_update().filter(pk=self.sach_id).values_list('pk'))
+            trang_thai = DatTruoc.objects.filter(pk=self.pk).values_list('trangThai', flat=True).first()
+            if trang_thai not in self.DANG_HOAT_DONG:
+                return False
+            DatTruoc.objects.filter(pk=self.pk).update(trangThai='cancelled')
+            self.trangThai = 'cancelled'
+            if trang_thai == 'ready':
+                Sach.chuyen_giu_cho({self.sach_id: 1}, -1)
+                DatTruoc.phan_bo({self.sach_id: 1})
+        return True
+
+    @classmethod
+    def phan_bo(cls, so_luong, now=None):
+        # so_luong: {sach_id: số bản vừa có lại}. Gọi sau khi đã cập nhật dòng Sach trong cùng transaction.
+        # Một truy vấn ROW_NUMBER() lấy n lượt chờ đầu tiên của mỗi sách.
+        so_luong = {pk: n for pk, n in so_luong.items() if n > 0}
+        if not so_luong:
+            return 0
+        rows = list(cls.objects.filter(sach_id__in=so_luong, trangThai='waiting').annotate(
+            thu_tu=Window(RowNumber(), partition_by=[F('sach')], order_by=F('id').asc()),
+            so_ban=Case(*[When(sach_id=pk, then=Value(n)) for pk, n in so_luong.items()]),
+        ).filter(thu_tu__lte=F('so_ban')).values_list('id', 'sach_id'))
+        if not rows:
+            return 0
+        now = now or timezone.now()
+        cls.objects.filter(pk__in=[pk for pk, _ in rows]).update(trangThai='ready', ngayGiu=now, hanNhan=han_nhan_sach(now))
+        Sach.chuyen_giu_cho(Counter(sach_id for _, sach_id in rows))
+        return len(rows)
+
+    @classmethod
+    def nhan_sach(cls, doc_gia_id, so_luong):
+        # Độc giả mượn sách mình đang đặt trước: lượt đặt thành 'fulfilled' và bản đang giữ (nếu 'ready')
+        # trả về soLuong để chính lượt mượn này lấy. Gọi trước Sach.borrow_book(s).
+        dat_truoc = cls.objects.filter(docGia_id=doc_gia_id, sach_id__in=so_luong, trangThai__in=cls.DANG_HOAT_DONG)
+        if not dat_truoc.exists():
+            return 0
+        list(Sach.objects.select_for_update().filter(pk__in=so_luong).order_by('pk').values_list('pk'))
+        rows = list(dat_truoc.values_list('id', 'sach_id', 'trangThai'))
+        cls.objects.filter(pk__in=[pk for pk, _, _ in rows]).update(trangThai='fulfilled')
+        Sach.chuyen_giu_cho(Counter(sach_id for _, sach_id, trang_thai in rows if trang_thai == 'ready'), -1)
+        return len(rows)
+
+    @classmethod
+    def het_han(cls, now=None, batch_size=500, on_batch=None):
+        # Quét theo lô các lượt 'ready' quá hanNhan; mỗi lô một transaction: khóa các sách liên quan,
+        # đánh dấu 'expired', trả bản giữ về kho rồi chuyển ngay cho lượt chờ kế tiếp.
+        now = now or timezone.now()
+        thong_ke = {'expired': 0, 'reassigned': 0}
+        while True:
+            with transaction.atomic():
+                ids = list(cls.objects.filter(trangThai='ready', hanNhan__lt=now)
+                           .order_by('id').values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                sach_ids = set(cls.objects.filter(pk__in=ids).values_list('sach_id', flat=True))
+                list(Sach.objects.select_for_update().filter(pk__in=sach_ids).order_by('pk').values_list('pk'))
+                rows = list(cls.objects.filter(pk__in=ids, trangThai='ready').values_list('id', 'sach_id'))
+                cls.objects.filter(pk__in=[pk for pk, _ in rows]).update(trangThai='expired')
+                tra_lai = Counter(sach_id for _, sach_id in rows)
+                Sach.chuyen_giu_cho(tra_lai, -1)
+                thong_ke['expired'] += len(rows)
+                thong_ke['reassigned'] += cls.phan_bo(tra_lai, now)
+            if on_batch:
+                on_batch(thong_ke)
+        return thong_ke
+
+
+# Chỉ mục đảo cho tìm kiếm sách (xem timkiem.py). TuKhoa là từ điển các từ đã bỏ dấu,
+# TuKhoaTrigram ánh xạ trigram -> từ để tìm gần đúng, ChiMucSach là danh sách sách chứa từ.
+class TuKhoa(models.Model):
+    tu = models.CharField(max_length=64, unique=True)
+    soTrigram = models.IntegerField()
+
+    def __str__(self):
+        return self.tu
+
+
+class TuKhoaTrigram(models.Model):
+    trigram = models.CharField(max_length=3)
+    tuKhoa = models.ForeignKey(TuKhoa, on_delete=models.CASCADE, related_name='trigrams')
+
+    class Meta:
+        unique_together = ('trigram', 'tuKhoa')
+
+
+class ChiMucSach(models.Model):
+    tuKhoa = models.ForeignKey(TuKhoa, on_delete=models.CASCADE, related_name='chi_muc')
+    sach = models.ForeignKey(Sach, on_delete=models.CASCADE, related_name='chi_muc')
+    trongSo = models.IntegerField()
+
+    class Meta:
+        unique_together = ('tuKhoa', 'sach')
+        indexes = [
+            # Đọc sách của một từ theo trọng số giảm dần và dừng sớm (timkiem._ung_vien)
+            models.Index(fields=['tuKhoa', 'trongSo', 'sach'], name='chimuc_tukhoa_trongso_idx'),
+        ]
+
 
 class BaseModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -139,6 +831,12 @@ class Interaction(BaseModel):
 class BinhLuan(Interaction):
     content = models.CharField(max_length=255)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['sach', '-created_at'], name='binhluan_sach_created_idx'),
+            models.Index(fields=['-created_at'], name='binhluan_created_idx'),
+        ]
+
     def __str__(self):
         return f'Comment by {self.user.username} on {self.sach.tenSach}: {self.content}'
 
@@ -157,4 +855,112 @@ class ChiaSe(Interaction):
     message = models.CharField(max_length=255, null=True, blank=True)
 
     def __str__(self):
-        return f'Share by {self.user.username} on {self.sach.tenSach} with message: {self.message}'
\ No newline at end of file
+        return f'Share by {self.user.username} on {self.sach.tenSach} with message: {self.message}'
+
+
+# Sổ đơn thanh toán gửi sang cổng MoMo / ZaloPay. idempotencyKey (gắn theo người trả, cổng và phiếu phạt) là duy nhất
+# nên gửi lại cùng một yêu cầu trả về đơn cũ thay vì tạo đơn mới; maDonHang là orderId / app_trans_id
+# gửi cho cổng. Kết quả thanh toán chỉ được ghi một lần bằng UPDATE có điều kiện trên trangThai.
+class ThanhToan(BaseModel):
+    CONG_CHOICES = (('momo', 'MoMo'), ('zalopay', 'ZaloPay'))
+    TRANG_THAI_CHOICES = (
+        ('pending', 'Chờ thanh toán'),
+        ('paid', 'Đã thanh toán'),
+        ('failed', 'Thất bại'),
+    )
+
+    maDonHang = models.CharField(max_length=50, unique=True)
+    idempotencyKey = models.CharField(max_length=150, unique=True)
+    cong = models.CharField(max_length=10, choices=CONG_CHOICES)
+    docGia = models.ForeignKey(NguoiDung, on_delete=models.SET_NULL, null=True, blank=True, related_name='thanh_toan')
+    chiTiet = models.ForeignKey(ChiTietPhieuMuon, on_delete=models.SET_NULL, null=True, blank=True,
+                                related_name='thanh_toan')
+    soTien = models.DecimalField(max_digits=12, decimal_places=0)
+    trangThai = models.CharField(max_length=10, choices=TRANG_THAI_CHOICES, default='pending')
+    payUrl = models.CharField(max_length=500, blank=True)
+    maGiaoDich = models.CharField(max_length=64, blank=True)
+    phanHoi = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['trangThai', 'created_at'], name='thanhtoan_trangthai_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.maDonHang} - {self.soTien} - {self.trangThai}'
+
+    @classmethod
+    def tao(cls, cong, so_tien, idempotency_key, ma_don_hang, doc_gia=None, chi_tiet=None):
+        # Trả về (đơn, created). Đơn cùng khóa đã thất bại thì được mở lại với mã đơn mới.
+        don, created = cls.objects.get_or_create(idempotencyKey=idempotency_key, defaults={
+            'maDonHang': ma_don_hang, 'cong': cong, 'soTien': so_tien, 'docGia': doc_gia, 'chiTiet': chi_tiet,
+        })
+        if not created and don.trangThai == 'failed':
+            if cls.objects.filter(pk=don.pk, trangThai='failed').update(
+                    trangThai='pending', maDonHang=ma_don_hang, cong=cong, soTien=so_tien, payUrl='',
+                    maGiaoDich='', phanHoi=None, updated_at=timezone.now()):
+                don.refresh_from_db()
+                created = True
+        return don, created
+
+    @classmethod
+    def xac_nhan(cls, ma_don_hang, so_tien, ma_giao_dich, thanh_cong):
+        # Ghi kết quả từ IPN / callback. Trả về 'paid' | 'failed' khi ghi được, 'duplicate' khi đơn đã có kết
+        # quả, 'mismatch' khi số tiền không khớp, 'unknown' khi không có đơn.
+        with transaction.atomic():
+            updated = cls.objects.filter(maDonHang=ma_don_hang, trangThai='pending', soTien=so_tien).update(
+                trangThai='paid' if thanh_cong else 'failed', maGiaoDich=str(ma_giao_dich or '')[:64],
+                updated_at=timezone.now())
+            if updated:
+                if thanh_cong:
+                    ChiTietPhieuMuon.objects.filter(thanh_toan__maDonHang=ma_don_hang, daThanhToan=False) \
+                        .update(daThanhToan=True)
+                return 'paid' if thanh_cong else 'failed'
+        don = cls.objects.filter(maDonHang=ma_don_hang).values('trangThai', 'soTien').first()
+        if don is None:
+            return 'unknown'
+        return 'duplicate' if don['trangThai'] != 'pending' else 'mismatch'
+
+    @classmethod
+    def doi_soat(cls, rows, batch_size=1000):
+        # rows: [(maDonHang, maGiaoDich, soTien, thanh_cong)] từ sao kê của cổng. Mỗi lô: một truy vấn nạp đơn,
+        # một UPDATE cho các đơn được xác nhận (kèm maGiaoDich), một UPDATE cho các đơn thất bại và một
+        # UPDATE ghi nhận tiền phạt đã thanh toán.
+        thong_ke = Counter()
+        rows = list(rows)
+        for offset in range(0, len(rows), batch_size):
+            batch = {ma: (ma_gd, Decimal(so_tien), ok) for ma, ma_gd, so_tien, ok in rows[offset:offset + batch_size]}
+            with transaction.atomic():
+                don = {ma: (pk, trang_thai, tien) for ma, pk, trang_thai, tien in cls.objects.select_for_update()
+                       .filter(maDonHang__in=batch).values_list('maDonHang', 'pk', 'trangThai', 'soTien')}
+                da_tra, that_bai = {}, []
+                for ma, (ma_gd, tien, ok) in batch.items():
+                    if ma not in don:
+                        thong_ke['unknown'] += 1
+                        continue
+                    pk, trang_thai, so_tien = don[ma]
+                    if so_tien != tien:
+                        thong_ke['mismatch'] += 1
+                    elif trang_thai == 'pending':
+                        if ok:
+                            da_tra[pk] = str(ma_gd or '')[:64]
+                        else:
+                            that_bai.append(pk)
+                    elif (trang_thai == 'paid') != ok:
+                        thong_ke['conflict'] += 1
+                    else:
+                        thong_ke['matched'] += 1
+                now = timezone.now()
+                if da_tra:
+                    cls.objects.filter(pk__in=da_tra, trangThai='pending').update(
+                        trangThai='paid', updated_at=now,
+                        maGiaoDich=Case(*[When(pk=pk, then=Value(ma_gd)) for pk, ma_gd in da_tra.items()],
+                                        default=Value('')),
+                    )
+                    ChiTietPhieuMuon.objects.filter(thanh_toan__in=da_tra, daThanhToan=False).update(daThanhToan=True)
+                if that_bai:
+                    cls.objects.filter(pk__in=that_bai, trangThai='pending').update(trangThai='failed', updated_at=now)
+                thong_ke['paid'] += len(da_tra)
+                thong_ke['failed'] += len(that_bai)
+        return dict(thong_ke)
+
@@ -0,0 +1,16 @@
+from rest_framework.pagination import CursorPagination
+
+
+# Phân trang theo con trỏ (keyset) trên khóa chính: trang thứ N chỉ là
+# "WHERE id < cursor ORDER BY id DESC LIMIT page_size", không dùng OFFSET/COUNT
+# nên chi phí mỗi trang không đổi dù client đi sâu đến đâu.
+class IdCursorPagination(CursorPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-id'
+
+
+# Bình luận hiển thị theo thời gian, dùng chỉ mục (sach, -created_at).
+class CreatedAtCursorPagination(IdCursorPagination):
+    ordering = '-created_at'
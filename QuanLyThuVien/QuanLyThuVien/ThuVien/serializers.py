@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, BinhLuan, Thich, ChiaSe
+from .models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, BinhLuan, Thich, ChiaSe, DatTruoc, ThanhToan
 
 class DanhMucSerializer(serializers.ModelSerializer):
     class Meta:
@@ -27,6 +27,7 @@ class SachSerializer(serializers.ModelSerializer):
     class Meta:
         model = Sach
         fields = '__all__'
+        read_only_fields = ['soLuotThich', 'soBinhLuan', 'soChiaSe', 'soSachGiuCho']
 
 
 class NguoiDungSerializer(serializers.ModelSerializer):
@@ -99,6 +100,8 @@ class ChiTietPhieuMuonSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChiTietPhieuMuon
         fields = '__all__'
+        # Tiền phạt do trả sách / quet_qua_han tính; daThanhToan chỉ đổi qua sổ thanh toán (ThanhToan.xac_nhan)
+        read_only_fields = ['quaHan', 'tienPhat', 'daThanhToan']
 
     def get_anhSach_url(self, instance):
         # Access the sach through the phieuMuon relation
@@ -151,4 +154,73 @@ class ChiaSeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ChiaSe
-        fields = ['id', 'user', 'sach', 'message', 'created_at', 'updated_at']
\ No newline at end of file
+        fields = ['id', 'user', 'sach', 'message', 'created_at', 'updated_at']
+
+# Biểu diễn rút gọn cho các feed tương tác: mỗi dòng chỉ giữ id người dùng và id sách,
+# thông tin chi tiết nằm trong bảng phụ 'users' / 'books' (mỗi đối tượng xuất hiện một lần).
+class FeedNguoiDungSerializer(serializers.ModelSerializer):
+    avatar_url = serializers.SerializerMethodField()
+
+    def get_avatar_url(self, instance):
+        if instance.avatar:
+            request = self.context.get('request')
+            if request:
+                return request.build_absolute_uri(instance.avatar.url)
+            return instance.avatar.url
+        return None
+
+    class Meta:
+        model = NguoiDung
+        fields = ['id', 'username', 'first_name', 'last_name', 'avatar_url']
+
+
+class FeedSachSerializer(serializers.ModelSerializer):
+    tenDanhMuc = serializers.CharField(source='danhMuc.tenDanhMuc', read_only=True)
+    anhSach_url = serializers.SerializerMethodField()
+
+    def get_anhSach_url(self, instance):
+        if instance.anhSach:
+            request = self.context.get('request')
+            if request:
+                return request.build_absolute_uri(instance.anhSach.url)
+            return instance.anhSach.url
+        return None
+
+    class Meta:
+        model = Sach
+        fields = ['id', 'tenSach', 'tenTacGia', 'tenDanhMuc', 'anhSach_url']
+
+
+class BinhLuanFeedSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BinhLuan
+        fields = ['id', 'user', 'sach', 'content', 'created_at', 'updated_at']
+
+
+class ThichFeedSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Thich
+        fields = ['id', 'thich', 'user', 'sach', 'created_at', 'updated_at']
+
+
+class ChiaSeFeedSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChiaSe
+        fields = ['id', 'user', 'sach', 'message', 'created_at', 'updated_at']
+
+
+class DatTruocSerializer(serializers.ModelSerializer):
+    tenSach = serializers.CharField(source='sach.tenSach', read_only=True)
+    viTri = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = DatTruoc
+        fields = ['id', 'docGia', 'sach', 'tenSach', 'trangThai', 'viTri', 'ngayDat', 'ngayGiu', 'hanNhan']
+        read_only_fields = ['docGia', 'trangThai', 'ngayDat', 'ngayGiu', 'hanNhan']
+
+
+class ThanhToanSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ThanhToan
+        fields = ['id', 'maDonHang', 'cong', 'chiTiet', 'soTien', 'trangThai', 'payUrl', 'maGiaoDich',
+                  'created_at', 'updated_at']
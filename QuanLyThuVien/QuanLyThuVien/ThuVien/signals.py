@@ -0,0 +1,72 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_delete, post_save, post_delete
+from django.dispatch import receiver
+
+from . import timkiem, giamsat
+from .cache import invalidate_catalog, invalidate_stock
+from .models import DanhMuc, Sach, NguoiDung, ChiTietPhieuMuon, ThongKeLuuThong, Thich, BinhLuan, ChiaSe, \
+    _ghi_thay_doi, _cot_bo_dem
+
+BO_DEM_TUONG_TAC = {Thich: 'soLuotThich', BinhLuan: 'soBinhLuan', ChiaSe: 'soChiaSe'}
+
+
+@receiver(post_delete, sender=Sach)
+@receiver(post_save, sender=DanhMuc)
+@receiver(post_delete, sender=DanhMuc)
+def lam_moi_cache_catalog(sender, **kwargs):
+    invalidate_catalog()
+
+
+@receiver(post_save, sender=Sach)
+def lam_moi_cache_sach(sender, instance, created, **kwargs):
+    # save() chỉ đổi số lượng / bộ đếm (vd. sửa kho qua admin) không làm mất cache nội dung catalog
+    da_doi = None if created else instance.cot_da_doi()
+    if da_doi is not None and da_doi <= set(Sach.COT_KHO):
+        invalidate_stock()
+    else:
+        invalidate_catalog()
+
+
+@receiver(post_save, sender=Sach)
+def cap_nhat_chi_muc_sach(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & timkiem.TRUONG_CHI_MUC:
+        return
+    # save() đầy đủ chỉ đổi các cột khác (số lượng, ảnh...) thì không ghi lại chỉ mục
+    da_doi = None if created else instance.cot_da_doi()
+    if da_doi is not None and not da_doi & timkiem.TRUONG_CHI_MUC:
+        return
+    timkiem.cap_nhat_sach(instance)
+
+
+@receiver(pre_delete, sender=ChiTietPhieuMuon)
+def xoa_chi_tiet_phieu_muon(sender, instance, **kwargs):
+    # Dùng pre_delete vì khi xóa dây chuyền từ PhieuMuon, phiếu mượn vẫn còn đọc được ở bước này.
+    thay_doi = {}
+    _ghi_thay_doi(thay_doi, instance._muc_thong_ke('issued'), -1)
+    _ghi_thay_doi(thay_doi, instance._muc_thong_ke(*instance._trang_thai()), -1)
+    ThongKeLuuThong.cap_nhat(thay_doi)
+    doc_gia_id = instance.phieuMuon.docGia_id if instance.phieuMuon else None
+    NguoiDung.cap_nhat_bo_dem({
+        (doc_gia_id, _cot_bo_dem(instance.tinhTrang)): -1,
+        (doc_gia_id, 'soLuongQuaHan'): -instance.quaHan,
+    })
+
+
+@receiver(post_save, sender=Thich)
+@receiver(post_save, sender=BinhLuan)
+@receiver(post_save, sender=ChiaSe)
+def tang_bo_dem_tuong_tac(sender, instance, created, **kwargs):
+    if created:
+        Sach.cap_nhat_tuong_tac(instance.sach_id, BO_DEM_TUONG_TAC[sender], 1)
+
+
+@receiver(post_delete, sender=Thich)
+@receiver(post_delete, sender=BinhLuan)
+@receiver(post_delete, sender=ChiaSe)
+def giam_bo_dem_tuong_tac(sender, instance, **kwargs):
+    Sach.cap_nhat_tuong_tac(instance.sach_id, BO_DEM_TUONG_TAC[sender], -1)
+
+
+@receiver(connection_created)
+def gan_do_luong_truy_van(sender, connection, **kwargs):
+    giamsat.gan_vao(connection)
@@ -0,0 +1,159 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Max, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import timkiem
+from .models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, BinhLuan, Thich, ChiaSe, \
+    ThongKeLuuThong, TIEN_PHAT_MOI_NGAY
+
+
+# Sinh dữ liệu giả lập bằng bulk_create. Khóa chính được gán trước (max(id) + 1...)
+# để các bảng con tham chiếu được ngay, kể cả trên MySQL nơi bulk_create không trả về id.
+# Mọi bảng được sinh theo lô batch_size dòng nên bộ nhớ không tăng theo số dòng (chạy được
+# tới hàng triệu phiếu mượn); id của mỗi bảng liên tục nên chỉ cần giữ khoảng id.
+def _next_id(model):
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+
+def _bulk_create(model, total, batch_size, build, on_batch=None, **kwargs):
+    # build(i) trả về đối tượng thứ i; trả về khoảng id đã tạo
+    start = _next_id(model)
+    for offset in range(0, total, batch_size):
+        model.objects.bulk_create([build(start + i) for i in range(offset, min(offset + batch_size, total))],
+                                  batch_size=batch_size, **kwargs)
+        if on_batch:
+            on_batch(model.__name__, min(offset + batch_size, total))
+    return range(start, start + total)
+
+
+def _chon(rng, ids, skew):
+    # Phân bố lệch: với skew > 1 một phần nhỏ sách / người dùng đầu khoảng id chiếm phần lớn lượt
+    # mượn, bình luận, thích... như dữ liệu thật (skew = 1 là đều)
+    return ids[int(len(ids) * rng.random() ** skew)]
+
+
+def generate(categories=20, books=10000, users=2000, loans=50000, comments=20000, likes=0, shares=0,
+             days=730, batch_size=2000, seed=0, skew=1.0, on_batch=None):
+    rng = random.Random(seed)
+    today = timezone.localdate()
+
+    danh_muc_ids = _bulk_create(DanhMuc, categories, batch_size, lambda pk: DanhMuc(
+        id=pk, tenDanhMuc=f'Danh mục {pk}'), on_batch)
+
+    sach_ids = _bulk_create(Sach, books, batch_size, lambda pk: Sach(
+        id=pk,
+        tenSach=f'Sách {pk}',
+        tenTacGia=f'Tác giả {rng.randrange(max(books // 10, 1))}',
+        nXB=f'NXB {rng.randrange(50)}',
+        namXB=rng.randint(1950, today.year),
+        soLuong=rng.randint(0, 20),
+        danhMuc_id=rng.choice(danh_muc_ids),
+        totalBorrowCount=rng.randint(0, 100),
+        is_active=rng.random() > 0.05,
+    ), on_batch)
+
+    user_ids = _bulk_create(NguoiDung, users, batch_size, lambda pk: NguoiDung(
+        id=pk,
+        username=f'synthetic_{pk}',
+        password='!',
+        nam_sinh=rng.randint(1950, today.year - 6),
+        chucVu='doc_gia',
+        is_staff=True,
+    ), on_batch)
+
+    def chi_tiet(pk, phieu_muon):
+        # ~10% đang mượn, ~15% trả trễ, còn lại trả đúng hạn
+        roll = rng.random()
+        chi_tiet = ChiTietPhieuMuon(id=pk, phieuMuon_id=phieu_muon.pk, tinhTrang='borrowed')
+        if roll > 0.85:
+            ngay_tra = phieu_muon.ngayTraDuKien + timedelta(days=rng.randint(1, 30))
+        elif roll > 0.1:
+            ngay_tra = phieu_muon.ngayMuon + timedelta(days=rng.randint(0, 7))
+        else:
+            ngay_tra = None
+        if ngay_tra and ngay_tra <= today:
+            chi_tiet.ngayTraThucTe = ngay_tra
+            if ngay_tra > phieu_muon.ngayTraDuKien:
+                chi_tiet.tinhTrang = 'late'
+                chi_tiet.tienPhat = Decimal((ngay_tra - phieu_muon.ngayTraDuKien).days * TIEN_PHAT_MOI_NGAY)
+            else:
+                chi_tiet.tinhTrang = 'returned'
+        return chi_tiet
+
+    start = _next_id(PhieuMuon)
+    ct_start = _next_id(ChiTietPhieuMuon)
+    for offset in range(0, loans, batch_size):
+        phieu_muon_list = []
+        for i in range(offset, min(offset + batch_size, loans)):
+            ngay_muon = today - timedelta(days=rng.randrange(days))
+            phieu_muon_list.append(PhieuMuon(
+                id=start + i,
+                docGia_id=_chon(rng, user_ids, skew),
+                sach_id=_chon(rng, sach_ids, skew),
+                ngayMuon=ngay_muon,
+                ngayTraDuKien=ngay_muon + timedelta(days=7),
+            ))
+        PhieuMuon.objects.bulk_create(phieu_muon_list, batch_size=batch_size)
+        ChiTietPhieuMuon.objects.bulk_create([chi_tiet(ct_start + phieu_muon.pk - start, phieu_muon)
+                                              for phieu_muon in phieu_muon_list], batch_size=batch_size)
+        if on_batch:
+            on_batch('PhieuMuon', min(offset + batch_size, loans))
+
+    _bulk_create(BinhLuan, comments, batch_size, lambda pk: BinhLuan(
+        id=pk, user_id=_chon(rng, user_ids, skew), sach_id=_chon(rng, sach_ids, skew), content=f'Bình luận {pk}',
+    ), on_batch)
+    # Mỗi (người dùng, sách) chỉ thích một lần: cặp trùng bị bỏ qua nên số lượt thích thực tế có thể ít hơn
+    like_ids = _bulk_create(Thich, likes, batch_size, lambda pk: Thich(
+        id=pk, user_id=_chon(rng, user_ids, skew), sach_id=_chon(rng, sach_ids, skew),
+    ), on_batch, ignore_conflicts=True)
+    _bulk_create(ChiaSe, shares, batch_size, lambda pk: ChiaSe(
+        id=pk, user_id=_chon(rng, user_ids, skew), sach_id=_chon(rng, sach_ids, skew), message=f'Chia sẻ {pk}',
+    ), on_batch)
+
+    return {
+        'categories': categories,
+        'books': books,
+        'users': users,
+        'loans': loans,
+        'comments': comments,
+        'likes': Thich.objects.filter(pk__gte=like_ids.start).count() if likes else 0,
+        'shares': shares,
+    }
+
+
+def cap_nhat_du_lieu_dan_xuat(batch_size=2000, search_index=True, on_batch=None):
+    # bulk_create bỏ qua save() / signal nên các bộ đếm, bảng tổng hợp và chỉ mục được tính lại từ dữ liệu:
+    # kho sách (soSachDangMuon, totalBorrowCount) theo từng khoảng id, rồi các hàm đối soát / rebuild sẵn có.
+    # Gọi sau generate() khi dữ liệu sinh ra cần nhất quán như khi đi qua các view.
+    last_id = 0
+    while True:
+        ids = list(Sach.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        Sach.objects.filter(pk__gte=ids[0], pk__lte=ids[-1]).update(
+            soSachDangMuon=Coalesce(Subquery(
+                ChiTietPhieuMuon.objects.filter(phieuMuon__sach=OuterRef('pk'), tinhTrang='borrowed')
+                .order_by().values('phieuMuon__sach').annotate(total=Count('id')).values('total')), Value(0)),
+            totalBorrowCount=Coalesce(Subquery(
+                PhieuMuon.objects.filter(sach=OuterRef('pk'))
+                .order_by().values('sach').annotate(total=Count('id')).values('total')), Value(0)),
+        )
+        last_id = ids[-1]
+    if on_batch:
+        on_batch('Sach.soSachDangMuon', None)
+    steps = [
+        ('Sach.doi_soat_tuong_tac', lambda: Sach.doi_soat_tuong_tac(batch_size)),
+        ('ChiTietPhieuMuon.quet_qua_han', ChiTietPhieuMuon.quet_qua_han),
+        ('NguoiDung.doi_soat_bo_dem', lambda: NguoiDung.doi_soat_bo_dem(batch_size)),
+        ('ThongKeLuuThong.rebuild', lambda: ThongKeLuuThong.rebuild(batch_size)),
+    ]
+    if search_index:
+        steps.append(('timkiem.rebuild', timkiem.rebuild))
+    for name, step in steps:
+        step()
+        if on_batch:
+            on_batch(name, None)
@@ -1,3 +1,1075 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import timkiem, goiy, bangxephang, thanhtoan, giamsat
+from .cache import catalog_version, get_cache
+from .gia_lap_thanh_toan import GatewayStub
+from .models import (DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, BinhLuan, ThongKeLuuThong,
+                     ChiMucSach, Thich, ChiaSe, DatTruoc, ThanhToan)
+
+
+class ThuVienTestCase(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        bangxephang.reset()
+        self.admin = NguoiDung.objects.create_user(username='admin', password='admin', chucVu='nhan_vien')
+        self.doc_gia = NguoiDung.objects.create_user(username='docgia', password='docgia')
+        self.danh_muc = DanhMuc.objects.create(tenDanhMuc='Văn học')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin)
+
+    def tao_sach(self, so_luong=5, **kwargs):
+        data = {
+            'tenSach': 'Sách', 'tenTacGia': 'Tác giả', 'nXB': 'NXB Trẻ', 'namXB': 2020,
+            'soLuong': so_luong, 'danhMuc': self.danh_muc,
+        }
+        data.update(kwargs)
+        return Sach.objects.create(**data)
+
+    def tao_phieu_muon(self, sach, doc_gia=None, ngay_muon=None):
+        ngay_muon = ngay_muon or timezone.localdate()
+        phieu_muon = PhieuMuon.objects.create(
+            docGia=doc_gia or self.doc_gia,
+            sach=sach,
+            ngayMuon=ngay_muon,
+            ngayTraDuKien=ngay_muon + timedelta(days=7),
+        )
+        return ChiTietPhieuMuon.objects.create(phieuMuon=phieu_muon)
+
+
+class PaginationTests(ThuVienTestCase):
+    def test_sach_list_cursor_pages_cover_every_active_book(self):
+        for i in range(25):
+            self.tao_sach(tenSach=f'Sách {i}')
+        self.tao_sach(tenSach='Ngừng phát hành', is_active=False)
+
+        ids = []
+        url = '/sach/?page_size=10'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 10)
+            ids.extend(book['id'] for book in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(len(ids), 25)
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+
+class CatalogCacheTests(ThuVienTestCase):
+    def test_second_list_is_served_from_cache_until_catalog_changes(self):
+        self.tao_sach(tenSach='A')
+        first = self.client.get('/sach/')
+        # Chỉ còn câu aggregate tính ETag và câu đọc lại cột kho
+        with self.assertNumQueries(2):
+            second = self.client.get('/sach/')
+        self.assertEqual(first.data, second.data)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tao_sach(tenSach='B')
+        response = self.client.get('/sach/')
+        self.assertEqual([book['tenSach'] for book in response.data['results']], ['B', 'A'])
+
+        stats = self.client.get('/sach/cache-stats/').data['endpoints']['sach-list']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    @override_settings(ALLOWED_HOSTS=['a.example.com', 'b.example.com', 'testserver'])
+    def test_cache_key_includes_host(self):
+        self.tao_sach(tenSach='A')
+        for host in ('a.example.com', 'b.example.com', 'a.example.com'):
+            self.assertEqual(self.client.get('/sach/', HTTP_HOST=host).status_code, 200)
+        stats = self.client.get('/sach/cache-stats/').data['endpoints']['sach-list']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_borrow_keeps_cache_but_shows_current_stock(self):
+        sach = self.tao_sach(so_luong=2)
+        self.client.get(f'/sach/{self.danh_muc.pk}/by-danhmuc/')
+        self.client.get('/sach/thong-ke-theo-danh-muc/', {'mode': 'summary'})
+        version = catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            sach.borrow_book()
+        self.assertEqual(catalog_version(), version)
+
+        response = self.client.get(f'/sach/{self.danh_muc.pk}/by-danhmuc/')
+        self.assertEqual(response.data['results'][0]['soLuong'], 1)
+        summary = self.client.get('/sach/thong-ke-theo-danh-muc/', {'mode': 'summary'})
+        self.assertEqual(summary.data[0]['borrowed_copies'], 1)
+
+        stats = self.client.get('/sach/cache-stats/').data['endpoints']
+        self.assertEqual((stats['by-danhmuc']['hits'], stats['by-danhmuc']['misses']), (1, 1))
+        self.assertEqual(stats['thong-ke-theo-danh-muc']['misses'], 2)
+
+
+class ConditionalRequestTests(ThuVienTestCase):
+    def test_sach_list_returns_304_until_stock_changes(self):
+        sach = self.tao_sach(so_luong=2)
+        etag = self.client.get('/sach/')['ETag']
+
+        response = self.client.get('/sach/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        sach.borrow_book()
+        response = self.client.get('/sach/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_renaming_category_changes_book_etag(self):
+        sach = self.tao_sach()
+        etag = self.client.get(f'/sach/{sach.pk}/')['ETag']
+        self.danh_muc.tenDanhMuc = 'Lịch sử'
+        self.danh_muc.save()
+        response = self.client.get(f'/sach/{sach.pk}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['tenDanhMuc'], 'Lịch sử')
+
+    def test_binhluan_detail_honours_if_modified_since(self):
+        binh_luan = BinhLuan.objects.create(user=self.doc_gia, sach=self.tao_sach(), content='Hay')
+        last_modified = self.client.get(f'/binhluan/{binh_luan.pk}/')['Last-Modified']
+        response = self.client.get(f'/binhluan/{binh_luan.pk}/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+
+class SearchTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dac_nhan_tam = self.tao_sach(tenSach='Đắc Nhân Tâm', tenTacGia='Dale Carnegie')
+        self.nha_gia_kim = self.tao_sach(tenSach='Nhà Giả Kim', tenTacGia='Paulo Coelho')
+        self.tam_ly = self.tao_sach(tenSach='Tâm lý học', tenTacGia='Nguyễn Văn Nhân')
+
+    def search(self, q):
+        response = self.client.get('/sach/search/', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [book['id'] for book in response.data['results']]
+
+    def test_search_ignores_diacritics_and_ranks_title_matches_first(self):
+        self.assertEqual(timkiem.tach_tu('Đắc Nhân Tâm'), ['dac', 'nhan', 'tam'])
+        self.assertEqual(self.search('dac nhan tam')[0], self.dac_nhan_tam.pk)
+        # 'nha' (Nhà Giả Kim) chỉ khớp gần đúng nên đứng sau hai kết quả khớp đúng
+        self.assertEqual(self.search('nhân'), [self.dac_nhan_tam.pk, self.tam_ly.pk, self.nha_gia_kim.pk])
+
+    def test_search_tolerates_typos(self):
+        self.assertEqual(self.search('carnegei')[:1], [self.dac_nhan_tam.pk])
+
+    def test_index_follows_updates_and_rebuild(self):
+        self.nha_gia_kim.tenSach = 'Ông Già Và Biển Cả'
+        self.nha_gia_kim.save()
+        self.assertEqual(self.search('bien ca'), [self.nha_gia_kim.pk])
+        self.dac_nhan_tam.is_active = False
+        self.dac_nhan_tam.save()
+        self.assertNotIn(self.dac_nhan_tam.pk, self.search('dac nhan tam'))
+
+        incremental = set(ChiMucSach.objects.values_list('tuKhoa__tu', 'sach', 'trongSo'))
+        timkiem.rebuild()
+        self.assertEqual(incremental, set(ChiMucSach.objects.values_list('tuKhoa__tu', 'sach', 'trongSo')))
+
+    def test_saves_that_do_not_touch_indexed_fields_keep_postings(self):
+        sach = Sach.objects.get(pk=self.tam_ly.pk)
+        postings = list(ChiMucSach.objects.filter(sach=sach).values_list('id', flat=True))
+        sach.soLuong += 1
+        sach.save()
+        self.assertEqual(list(ChiMucSach.objects.filter(sach=sach).values_list('id', flat=True)), postings)
+        sach.tenTacGia = 'Carnegie'
+        sach.save()
+        self.assertEqual(self.search('carnegie')[:2], [self.dac_nhan_tam.pk, self.tam_ly.pk])
+
+    def test_common_words_only_rank_books_with_the_rarest_word(self):
+        for i in range(3):
+            self.tao_sach(tenSach=f'Nhân vật {i}')
+        with mock.patch.object(timkiem, 'MAX_UNG_VIEN', 2):
+            self.assertEqual(self.search('nhan tam dac')[0], self.dac_nhan_tam.pk)
+            self.assertEqual(len(self.search('nhan')), 2)
+
+
+class AutocompleteTests(ThuVienTestCase):
+    def test_prefix_returns_weighted_titles_and_authors_without_queries(self):
+        it_muon = self.tao_sach(tenSach='Đắc Nhân Tâm', tenTacGia='Dale Carnegie', totalBorrowCount=5)
+        nhieu_muon = self.tao_sach(tenSach='Dạy Con Làm Giàu', tenTacGia='Robert Kiyosaki', totalBorrowCount=9)
+        self.tao_sach(tenSach='Lịch sử', tenTacGia='Đào Duy Anh', totalBorrowCount=1)
+        Thich.objects.create(user=self.doc_gia, sach=it_muon)
+        goiy.refresh()
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/sach/autocomplete/', {'q': 'D'})
+        self.assertEqual([book['id'] for book in response.data['titles']], [nhieu_muon.pk, it_muon.pk])
+        self.assertEqual([author['tenTacGia'] for author in response.data['authors']],
+                         ['Dale Carnegie', 'Đào Duy Anh'])
+
+        response = self.client.get('/sach/autocomplete/', {'q': 'đắc nhân', 'limit': 1})
+        self.assertEqual(response.data['titles'], [{'id': it_muon.pk, 'tenSach': 'Đắc Nhân Tâm', 'weight': 6}])
+
+
+class InteractionCounterTests(ThuVienTestCase):
+    def test_endpoints_maintain_counters(self):
+        sach = self.tao_sach()
+        self.client.force_authenticate(user=self.doc_gia)
+        self.assertEqual(self.client.post(f'/thich/{sach.pk}/toggle-like/').status_code, 201)
+        self.client.post(f'/binhluan/{sach.pk}/create-comment/', {'content': 'Hay'})
+        self.client.post(f'/binhluan/{sach.pk}/create-comment/', {'content': 'Rất hay'})
+        self.client.post(f'/chiase/{sach.pk}/share/', {'message': 'Đọc đi'})
+        sach.refresh_from_db()
+        self.assertEqual((sach.soLuotThich, sach.soBinhLuan, sach.soChiaSe), (1, 2, 1))
+
+        self.assertEqual(self.client.post(f'/thich/{sach.pk}/toggle-like/').status_code, 204)
+        response = self.client.get(f'/sach/{sach.pk}/like-count/')
+        self.assertEqual(response.data['like_count'], 0)
+
+        # Nạp bảng xếp hạng lần đầu + một truy vấn lấy tên sách
+        with self.assertNumQueries(2):
+            response = self.client.get('/sach/most-commented/')
+        self.assertEqual(response.data, [{'tenSach': 'Sách', 'comment_count': 2}])
+
+    def test_reconcile_repairs_drift(self):
+        sach = self.tao_sach()
+        Thich.objects.create(user=self.doc_gia, sach=sach)
+        ChiaSe.objects.create(user=self.doc_gia, sach=sach)
+        Sach.objects.filter(pk=sach.pk).update(soLuotThich=7, soChiaSe=0)
+
+        self.assertEqual(Sach.doi_soat_tuong_tac(batch_size=1), 1)
+        sach.refresh_from_db()
+        self.assertEqual((sach.soLuotThich, sach.soBinhLuan, sach.soChiaSe), (1, 0, 1))
+        self.assertEqual(Sach.doi_soat_tuong_tac(), 0)
+
+
+class LeaderboardTests(ThuVienTestCase):
+    def test_board_follows_committed_changes_without_rewarming(self):
+        books = [self.tao_sach(tenSach=f'Sách {i}') for i in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            Thich.objects.create(user=self.doc_gia, sach=books[0])
+        self.assertEqual(bangxephang.top('liked'), [(books[0].pk, 1)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Thich.objects.create(user=self.doc_gia, sach=books[2])
+            Thich.objects.create(user=self.admin, sach=books[2])
+        with self.assertNumQueries(1):
+            response = self.client.get('/sach/most-liked/')
+        self.assertEqual([(book['id'], book['like_count']) for book in response.data],
+                         [(books[2].pk, 2), (books[0].pk, 1)])
+
+    def test_member_dropping_below_outsiders_forces_rewarm(self):
+        board = bangxephang.Leaderboard(capacity=2)
+        board.load([(1, 5), (2, 4), (3, 3)])
+        board.apply(3, 1)
+        self.assertFalse(board.dirty)
+        self.assertEqual(board.top(2), [(1, 5), (2, 4)])
+        board.apply(2, -1)
+        self.assertTrue(board.dirty)
+
+    def test_board_that_is_not_full_stays_bounded(self):
+        board = bangxephang.Leaderboard(capacity=2)
+        board.load([(1, 5)])
+        for sach_id, delta in ((2, 1), (3, 2), (4, 1)):
+            board.apply(sach_id, delta)
+        self.assertEqual(board.scores, {1: 5, 3: 2})
+        self.assertEqual((board.floor, board.dirty), (1, False))
+        board.apply(4, 1)
+        self.assertTrue(board.dirty)
+
+    def test_warm_query_runs_outside_the_lock(self):
+        sach = self.tao_sach()
+        warm = bangxephang._warm
+
+        def warm_with_concurrent_change(metric, window):
+            self.assertFalse(bangxephang._lock.locked())
+            bangxephang.ghi_nhan('liked', sach.pk, 1)
+            return warm(metric, window)
+
+        with mock.patch.object(bangxephang, '_warm', warm_with_concurrent_change):
+            self.assertEqual(bangxephang.top('liked'), [])
+        self.assertTrue(bangxephang._boards[('liked', 'all')].dirty)
+
+    def test_monthly_window_counts_issued_loans(self):
+        sach = self.tao_sach()
+        ngay = timezone.localdate()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tao_phieu_muon(sach, ngay_muon=ngay)
+        response = self.client.get('/sach/most-borrowed/', {'month': ngay.month, 'year': ngay.year, 'limit': 5})
+        self.assertEqual(response.data, [{'tenSach': 'Sách', 'total_borrow_count': 1}])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tao_phieu_muon(sach, ngay_muon=ngay)
+        self.assertEqual(bangxephang.top('issued', window=bangxephang.month_window(ngay)), [(sach.pk, 2)])
+
+    def test_most_borrowed_without_limit_lists_every_book_of_the_month(self):
+        ngay = timezone.localdate()
+        for i in range(3):
+            self.tao_phieu_muon(self.tao_sach(tenSach=f'Sách {i}'), ngay_muon=ngay)
+        params = {'month': ngay.month, 'year': ngay.year}
+        with mock.patch.object(bangxephang, 'CAPACITY', 2):
+            self.assertEqual(len(self.client.get('/sach/most-borrowed/', params).data), 3)
+            self.assertEqual(len(self.client.get('/sach/most-borrowed/', {**params, 'limit': 10}).data), 2)
+
+    def test_most_borrowed_rejects_invalid_limit(self):
+        ngay = timezone.localdate()
+        for limit in ('0', '-3', 'abc'):
+            response = self.client.get('/sach/most-borrowed/',
+                                       {'month': ngay.month, 'year': ngay.year, 'limit': limit})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get('/sach/most-borrowed/', {'month': 'x', 'year': ngay.year})
+        self.assertEqual(response.status_code, 400)
+
+
+class DashboardTests(ThuVienTestCase):
+    def test_dashboard_combines_sections_and_caches_them(self):
+        self.doc_gia.nam_sinh = timezone.localdate().year - 20
+        self.doc_gia.save()
+        sach = self.tao_sach(so_luong=3)
+        self.tao_phieu_muon(sach)
+        Thich.objects.create(user=self.doc_gia, sach=sach)
+
+        response = self.client.get('/sach/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['cached'])
+        self.assertEqual(response.data['users'], {'user_count': 2, 'ages': [{'age': 20, 'count': 1}]})
+        self.assertEqual(response.data['books']['total_books'], 2)  # soLuong còn lại sau khi mượn 1
+        self.assertEqual(response.data['books']['total_likes'], 1)
+        self.assertEqual(response.data['categories'][0]['book_count'], 1)
+        self.assertEqual(response.data['circulation'][-1]['borrowed'], 1)
+        self.assertEqual(response.data['leaderboards']['liked'], [{'id': sach.pk, 'tenSach': 'Sách', 'total': 1}])
+        self.assertEqual(set(response.data['timings_ms']),
+                         {'users', 'books', 'categories', 'circulation', 'leaderboards'})
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/sach/dashboard/')
+        self.assertTrue(response.data['cached'])
+
+
+class AgeHistogramTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        year = timezone.localdate().year
+        for i, (tuoi, active) in enumerate([(15, True), (20, True), (25, False), (40, True), (70, True)]):
+            NguoiDung.objects.create_user(username=f'u{i}', password='x', nam_sinh=year - tuoi, is_active=active)
+        self.admin.nam_sinh = year - 30
+        self.admin.save()
+
+    def test_per_age_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/nguoidung/thong-ke-do-tuoi/', {'chucVu': 'doc_gia'})
+        self.assertEqual(response.data, [{'age': age, 'count': 1} for age in (15, 20, 25, 40, 70)])
+
+    def test_buckets_and_is_active_filter(self):
+        response = self.client.get('/nguoidung/thong-ke-do-tuoi/', {'buckets': '18,26,41', 'is_active': 'true'})
+        self.assertEqual([(row['bucket'], row['count']) for row in response.data],
+                         [('0-17', 1), ('18-25', 1), ('26-40', 2), ('41+', 1)])
+        response = self.client.get('/nguoidung/thong-ke-do-tuoi/', {'buckets': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CategorySummaryTests(ThuVienTestCase):
+    def test_summary_mode_is_one_aggregate_query(self):
+        self.tao_phieu_muon(self.tao_sach(so_luong=3))
+        self.tao_sach(so_luong=2, is_active=False)
+        DanhMuc.objects.create(tenDanhMuc='Trống')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/sach/thong-ke-theo-danh-muc/', {'mode': 'summary'})
+        van_hoc, trong = response.data
+        self.assertEqual(
+            {key: van_hoc[key] for key in ('book_count', 'active_count', 'inactive_count',
+                                           'available_copies', 'borrowed_copies')},
+            {'book_count': 2, 'active_count': 1, 'inactive_count': 1, 'available_copies': 4, 'borrowed_copies': 1},
+        )
+        self.assertTrue(van_hoc['books_url'].endswith(f'/sach/{self.danh_muc.pk}/by-danhmuc/'))
+        self.assertEqual((trong['book_count'], trong['borrowed_copies']), (0, 0))
+
+
+class OverdueScanTests(ThuVienTestCase):
+    def test_scan_marks_overdue_loans_and_is_idempotent(self):
+        today = timezone.localdate()
+        sach = self.tao_sach()
+        qua_han = [self.tao_phieu_muon(sach, ngay_muon=today - timedelta(days=n)) for n in (10, 12)]
+        dung_han = self.tao_phieu_muon(sach, ngay_muon=today - timedelta(days=2))
+
+        thong_ke = ChiTietPhieuMuon.quet_qua_han(today)
+        self.assertEqual((thong_ke['dates'], thong_ke['updated'], thong_ke['last_date']),
+                         (2, 2, qua_han[0].phieuMuon.ngayTraDuKien))
+        self.assertEqual(
+            list(ChiTietPhieuMuon.objects.filter(quaHan=True).order_by('id').values_list('id', 'tienPhat')),
+            [(qua_han[0].pk, 9000), (qua_han[1].pk, 15000)],
+        )
+        self.assertFalse(ChiTietPhieuMuon.objects.get(pk=dung_han.pk).quaHan)
+        self.doc_gia.refresh_from_db()
+        self.assertEqual(self.doc_gia.soLuongQuaHan, 2)
+
+        self.assertEqual(ChiTietPhieuMuon.quet_qua_han(today)['updated'], 0)
+        # Chạy tiếp từ ngày cuối: không còn gì để quét
+        self.assertEqual(ChiTietPhieuMuon.quet_qua_han(today, after_date=thong_ke['last_date'])['dates'], 0)
+        # Ngày hôm sau tiền phạt tạm tính tăng thêm
+        ChiTietPhieuMuon.quet_qua_han(today + timedelta(days=1))
+        self.assertEqual(ChiTietPhieuMuon.objects.get(pk=qua_han[0].pk).tienPhat, 12000)
+
+    def test_returning_an_overdue_loan_clears_the_flag_and_counter(self):
+        today = timezone.localdate()
+        chi_tiet = self.tao_phieu_muon(self.tao_sach(), ngay_muon=today - timedelta(days=10))
+        ChiTietPhieuMuon.quet_qua_han(today)
+
+        chi_tiet = ChiTietPhieuMuon.objects.get(pk=chi_tiet.pk)
+        chi_tiet.ngayTraThucTe = today
+        chi_tiet.save()
+        chi_tiet.refresh_from_db()
+        self.assertEqual((chi_tiet.quaHan, chi_tiet.tinhTrang, chi_tiet.tienPhat), (False, 'late', 9000))
+        self.doc_gia.refresh_from_db()
+        self.assertEqual(self.doc_gia.soLuongQuaHan, 0)
+
+
+class ReaderCounterTests(ThuVienTestCase):
+    def bo_dem(self):
+        self.doc_gia.refresh_from_db()
+        return self.doc_gia.soLuongMuon, self.doc_gia.soLuongTra, self.doc_gia.soLuongQuaHan
+
+    def test_counters_follow_loan_state_changes(self):
+        today = timezone.localdate()
+        sach = self.tao_sach()
+        mot = self.tao_phieu_muon(sach, ngay_muon=today - timedelta(days=10))
+        hai = self.tao_phieu_muon(sach)
+        nhieu = ChiTietPhieuMuon.borrow_many(self.doc_gia, [sach, sach])
+        self.assertEqual(self.bo_dem(), (4, 0, 0))
+
+        ChiTietPhieuMuon.quet_qua_han(today)
+        self.assertEqual(self.bo_dem(), (4, 0, 1))
+
+        mot = ChiTietPhieuMuon.objects.get(pk=mot.pk)
+        mot.ngayTraThucTe = today
+        mot.save()
+        mot.save()
+        self.assertEqual(self.bo_dem(), (3, 1, 0))
+
+        ChiTietPhieuMuon.return_many(list(ChiTietPhieuMuon.objects.select_related('phieuMuon')
+                                          .filter(pk__in=[chi_tiet.pk for chi_tiet in nhieu])))
+        self.assertEqual(self.bo_dem(), (1, 3, 0))
+
+        hai.phieuMuon.delete()
+        self.assertEqual(self.bo_dem(), (0, 3, 0))
+        self.assertEqual(NguoiDung.doi_soat_bo_dem(), 0)
+
+    def test_summary_reads_the_counters_and_backfill_fixes_drift(self):
+        self.tao_phieu_muon(self.tao_sach())
+        NguoiDung.objects.filter(pk=self.doc_gia.pk).update(soLuongMuon=0, soLuongTra=7, soLuongQuaHan=2)
+
+        call_command('doi_soat_bo_dem_doc_gia', stdout=StringIO())
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/nguoidung/{self.doc_gia.pk}/summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'id': self.doc_gia.pk, 'username': 'docgia',
+            'soLuongMuon': 1, 'soLuongTra': 0, 'soLuongQuaHan': 0, 'tongSoLuotMuon': 1,
+        })
+
+
+class HoldQueueTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sach = self.tao_sach(so_luong=1)
+        self.dang_muon = self.tao_phieu_muon(self.sach)
+        self.cho = [NguoiDung.objects.create_user(username=f'cho{i}', password='x') for i in range(2)]
+        self.dat_truoc = [DatTruoc.dat(user, self.sach.pk) for user in self.cho]
+
+    def trang_thai(self):
+        self.sach.refresh_from_db()
+        return ((self.sach.soLuong, self.sach.soSachGiuCho),
+                list(DatTruoc.objects.order_by('id').values_list('trangThai', flat=True)))
+
+    def test_hold_endpoint_reports_queue_position_and_rejects_invalid_holds(self):
+        self.client.force_authenticate(user=self.cho[1])
+        response = self.client.get('/dattruoc/')
+        self.assertEqual([(row['trangThai'], row['viTri']) for row in response.data['results']], [('waiting', 2)])
+
+        self.assertEqual(self.client.post('/dattruoc/', {'sach': self.sach.pk}).status_code, 400)
+        self.client.force_authenticate(user=self.doc_gia)
+        response = self.client.post('/dattruoc/', {'sach': self.sach.pk})
+        self.assertEqual((response.status_code, response.data['viTri']), (201, 3))
+        response = self.client.post('/dattruoc/', {'sach': self.tao_sach(so_luong=2).pk})
+        self.assertEqual(response.data['error'], 'Sách vẫn còn, có thể mượn ngay.')
+
+    def test_returned_copy_goes_to_the_next_hold_which_can_borrow_it(self):
+        self.dang_muon.ngayTraThucTe = timezone.localdate()
+        self.dang_muon.save()
+        self.assertEqual(self.trang_thai(), ((0, 1), ['ready', 'waiting']))
+
+        # Người không đặt trước không lấy được bản đang giữ
+        with self.assertRaises(ValidationError):
+            self.tao_phieu_muon(self.sach)
+
+        self.client.force_authenticate(user=self.cho[0])
+        response = self.client.post(f'/phieumuon/{self.sach.pk}/borrow/',
+                                    {'ngayTraDuKien': timezone.localdate() + timedelta(days=7)})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.trang_thai(), ((0, 0), ['fulfilled', 'waiting']))
+
+        ChiTietPhieuMuon.return_many(list(ChiTietPhieuMuon.objects.select_related('phieuMuon')
+                                          .filter(tinhTrang='borrowed')))
+        self.assertEqual(self.trang_thai(), ((0, 1), ['fulfilled', 'ready']))
+
+    def test_expired_and_cancelled_holds_pass_the_copy_on(self):
+        nguoi_thu_ba = DatTruoc.dat(self.doc_gia, self.sach.pk)
+        self.dang_muon.ngayTraThucTe = timezone.localdate()
+        self.dang_muon.save()
+
+        thong_ke = DatTruoc.het_han(timezone.now() + timedelta(days=4))
+        self.assertEqual(thong_ke, {'expired': 1, 'reassigned': 1})
+        self.assertEqual(self.trang_thai(), ((0, 1), ['expired', 'ready', 'waiting']))
+
+        self.client.force_authenticate(user=self.cho[1])
+        response = self.client.post(f'/dattruoc/{self.dat_truoc[1].pk}/cancel/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.trang_thai(), ((0, 1), ['expired', 'cancelled', 'ready']))
+
+        self.assertTrue(DatTruoc.objects.get(pk=nguoi_thu_ba.pk).huy())
+        self.assertEqual(self.trang_thai(), ((1, 0), ['expired', 'cancelled', 'cancelled']))
+
+
+class PaymentClientTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stub = GatewayStub().start()
+        self.addCleanup(self.stub.stop)
+        self.dung_cong_gia_lap(RETRIES=2, BACKOFF=0)
+
+    def dung_cong_gia_lap(self, **config):
+        override = override_settings(THUVIEN_PAYMENT={**self.stub.payment_settings(), **config})
+        override.enable()
+        self.addCleanup(override.disable)
+        thanhtoan.reset()
+        self.addCleanup(thanhtoan.reset)
+
+    def test_requests_are_signed_and_reuse_one_connection(self):
+        for _ in range(3):
+            response = self.client.post('/payment/', HTTP_AMOUNT='10000')
+            self.assertEqual(response.json()['resultCode'], 0)
+        response = self.client.post('/payment/zalopay/order/', {'amount': 20000}, format='json')
+        self.assertEqual(response.data['return_code'], 1)
+        self.assertEqual(self.stub.stats, {'connections': 1, 'requests': 4})
+
+    def test_failures_are_retried_a_bounded_number_of_times(self):
+        self.stub.fail_rate = 1
+        response = self.client.post('/payment/', HTTP_AMOUNT='10000')
+        self.assertEqual(response.status_code, 500)
+        self.assertIn('503', response.json()['error'])
+        self.assertEqual(self.stub.stats['requests'], 3)
+
+        # Backoff kế tiếp vượt DEADLINE thì dừng sau lần đầu
+        self.dung_cong_gia_lap(RETRIES=5, BACKOFF=1, DEADLINE=0.5)
+        self.assertEqual(self.client.post('/payment/', HTTP_AMOUNT='10000').status_code, 500)
+        self.assertEqual(self.stub.stats['requests'], 4)
+
+        # Request có thể đã tới cổng: hết thời gian đọc thì không gửi lại
+        self.stub.fail_rate, self.stub.delay = 0, 0.5
+        self.dung_cong_gia_lap(RETRIES=2, BACKOFF=0, TIMEOUT=0.1)
+        with self.assertRaisesMessage(thanhtoan.PaymentGatewayError, 'ReadTimeout'):
+            thanhtoan.tao_don_zalopay(20000)
+        self.assertEqual(self.stub.stats['requests'], 5)
+
+    def test_duplicate_reply_after_retry_keeps_order_pending(self):
+        for duong_dan, cong in (('/payment/', 'momo'), ('/payment/zalopay/order/', 'zalopay')):
+            self.stub.lost_responses = 1
+            response = self.client.post(duong_dan, {'amount': 20000}, format='json', HTTP_AMOUNT='20000')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()['duplicate'])
+            self.assertEqual(ThanhToan.objects.get(cong=cong).trangThai, 'pending')
+        self.assertEqual(self.stub.stats['requests'], 4)
+
+    def test_async_client(self):
+        async def tao_don():
+            try:
+                return await asyncio.gather(thanhtoan.atao_don_momo('10000'), thanhtoan.atao_don_zalopay(20000))
+            finally:
+                await thanhtoan.get_async_client().aclose()
+
+        momo, zalopay = asyncio.run(tao_don())
+        self.assertEqual((momo['resultCode'], zalopay['return_code']), (0, 1))
+
+    def test_reset_closes_async_clients_on_their_loop(self):
+        async def tao_don():
+            await thanhtoan.atao_don_momo('10000')
+            return thanhtoan.get_async_client()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        dang_dung = loop.run_until_complete(tao_don())
+        thanhtoan.reset()
+        self.assertTrue(dang_dung.is_closed)
+
+        async def reset_trong_loop():
+            client = await tao_don()
+            thanhtoan.reset()
+            await asyncio.sleep(0)
+            return client
+
+        self.assertTrue(loop.run_until_complete(reset_trong_loop()).is_closed)
+        self.assertEqual(self.stub.stats, {'connections': 2, 'requests': 2})
+
+
+    def test_fine_order_is_idempotent_and_settled_once_by_ipn(self):
+        chi_tiet = self.tao_phieu_muon(self.tao_sach())
+        ChiTietPhieuMuon.objects.filter(pk=chi_tiet.pk).update(tinhTrang='late', tienPhat=30000)
+        self.client.force_authenticate(user=self.doc_gia)
+        first = self.client.post('/payment/fine/', {'chi_tiet_id': chi_tiet.pk}, format='json')
+        second = self.client.post('/payment/fine/', {'chi_tiet_id': chi_tiet.pk}, format='json')
+        self.assertEqual(first.data['maDonHang'], second.data['maDonHang'])
+        self.assertEqual(self.stub.stats['requests'], 1)
+
+        config = thanhtoan.cau_hinh()['MOMO']
+        ipn = {
+            'partnerCode': config['partner_code'], 'orderId': first.data['maDonHang'],
+            'requestId': first.data['maDonHang'], 'amount': 30000, 'orderInfo': 'pay with MoMo',
+            'orderType': 'momo_wallet', 'transId': 4088878653, 'resultCode': 0, 'message': 'Successful.',
+            'payType': 'qr', 'responseTime': 1721720663942, 'extraData': '',
+        }
+        ipn['signature'] = thanhtoan.ky_momo_ipn(ipn, config['secret_key'])
+        callback = APIClient()
+        self.assertEqual(callback.post('/payment/momo/ipn/', {**ipn, 'amount': 1}, format='json').status_code, 400)
+        for _ in range(2):
+            self.assertEqual(callback.post('/payment/momo/ipn/', ipn, format='json').status_code, 204)
+        self.assertEqual(ThanhToan.xac_nhan(ipn['orderId'], 30000, ipn['transId'], True), 'duplicate')
+
+        don = ThanhToan.objects.get()
+        self.assertEqual((don.trangThai, don.maGiaoDich), ('paid', '4088878653'))
+        chi_tiet.refresh_from_db()
+        self.assertTrue(chi_tiet.daThanhToan)
+        response = self.client.post('/payment/fine/', {'chi_tiet_id': chi_tiet.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_idempotency_keys_are_scoped_to_the_payer_and_fine(self):
+        response = self.client.post('/payment/', HTTP_AMOUNT='10000', HTTP_IDEMPOTENCY_KEY='don-1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/payment/', HTTP_AMOUNT='10000').status_code, 200)
+
+        sach = self.tao_sach(so_luong=2)
+        fines = [self.tao_phieu_muon(sach) for _ in range(2)]
+        ChiTietPhieuMuon.objects.filter(pk__in=[c.pk for c in fines]).update(tinhTrang='late', tienPhat=30000)
+        self.client.force_authenticate(user=self.doc_gia)
+        orders = {self.client.post('/payment/fine/', {'chi_tiet_id': chi_tiet.pk}, format='json',
+                                   HTTP_IDEMPOTENCY_KEY='phat').data['maDonHang'] for chi_tiet in fines}
+        self.assertEqual(len(orders), 2)
+        self.assertEqual(set(ThanhToan.objects.filter(chiTiet__isnull=False).values_list('chiTiet', flat=True)),
+                         {c.pk for c in fines})
+
+    def test_fine_cannot_be_marked_paid_through_the_api(self):
+        chi_tiet = self.tao_phieu_muon(self.tao_sach())
+        ChiTietPhieuMuon.objects.filter(pk=chi_tiet.pk).update(tinhTrang='late', tienPhat=30000)
+        response = self.client.patch(f'/chitietphieumuon/{chi_tiet.pk}/',
+                                     {'daThanhToan': True, 'tienPhat': 0}, format='json')
+        self.assertEqual(response.status_code, 200)
+        chi_tiet.refresh_from_db()
+        self.assertEqual((chi_tiet.daThanhToan, chi_tiet.tienPhat), (False, 30000))
+        self.assertEqual(self.client.post('/payment/fine/', {'chi_tiet_id': chi_tiet.pk},
+                                          format='json').status_code, 200)
+
+    def test_zalopay_callback_and_statement_reconciliation(self):
+        for _ in range(2):
+            response = self.client.post('/payment/zalopay/order/', {'amount': 20000}, format='json',
+                                        HTTP_IDEMPOTENCY_KEY='don-1')
+            self.assertEqual(response.data['return_code'], 1)
+        self.assertEqual(self.stub.stats['requests'], 1)
+        zalopay = ThanhToan.objects.get(cong='zalopay')
+
+        data = json.dumps({'app_trans_id': zalopay.maDonHang, 'amount': 20000, 'zp_trans_id': 240731000000175})
+        mac = thanhtoan.ky_zalopay_callback(data, thanhtoan.cau_hinh()['ZALOPAY']['key2'])
+        callback = APIClient()
+        codes = [callback.post('/payment/zalopay/callback/', {'data': data, 'mac': m}, format='json')
+                 .data['return_code'] for m in ('sai', mac, mac)]
+        self.assertEqual(codes, [-1, 1, 2])
+        for khong_phai_object in ('[1, 2]', '"abc"', '7'):
+            mac_sai_kieu = thanhtoan.ky_zalopay_callback(khong_phai_object, thanhtoan.cau_hinh()['ZALOPAY']['key2'])
+            response = callback.post('/payment/zalopay/callback/', {'data': khong_phai_object, 'mac': mac_sai_kieu},
+                                     format='json')
+            self.assertEqual((response.status_code, response.data['return_code']), (200, -1))
+
+        momo, _ = ThanhToan.tao('momo', 10000, 'admin:don-2', 'MMdon2')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('order_id,trans_id,amount,status\n'
+                    f'{zalopay.maDonHang},240731000000175,20000,success\n'
+                    'MMdon2,999,10000,success\nMMkhongco,1,5000,success\n')
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('doi_soat_thanh_toan', f.name, stdout=out)
+        self.assertIn('paid=1, failed=0, matched=1, conflict=0, mismatch=0, unknown=1', out.getvalue())
+        momo.refresh_from_db()
+        self.assertEqual((momo.trangThai, momo.maGiaoDich), ('paid', '999'))
+
+
+    async def test_async_payment_views_share_one_connection_and_replay(self):
+        headers = {'amount': '10000', 'Idempotency-Key': 'don-1'}
+        self.assertEqual((await self.async_client.post('/async/payment/', headers=headers)).status_code, 400)
+        self.assertEqual((await self.async_client.post('/async/payment/zalopay/order/')).status_code, 401)
+
+        await self.async_client.aforce_login(self.admin)
+        for _ in range(2):
+            response = await self.async_client.post('/async/payment/', headers=headers)
+            self.assertEqual(response.json()['resultCode'], 0)
+        response = await self.async_client.post('/async/payment/zalopay/order/', {'amount': 20000},
+                                                content_type='application/json')
+        self.assertEqual(response.json()['return_code'], 1)
+        await thanhtoan.get_async_client().aclose()
+        self.assertEqual(self.stub.stats, {'connections': 1, 'requests': 2})
+        self.assertEqual(await ThanhToan.objects.acount(), 2)
+
+
+class LoanQueryCountTests(ThuVienTestCase):
+    def tao_nhieu_phieu_muon(self, so_luong):
+        for i in range(so_luong):
+            self.tao_phieu_muon(self.tao_sach(tenSach=f'Sách {i}'))
+
+    def assertQueryCountStable(self, url, query_count):
+        for so_luong in (1, 10):
+            ChiTietPhieuMuon.objects.all().delete()
+            self.tao_nhieu_phieu_muon(so_luong)
+            with self.assertNumQueries(query_count):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_borrowed_books_query_count_is_fixed(self):
+        self.assertQueryCountStable(f'/nguoidung/{self.doc_gia.pk}/borrowed-books/', 2)
+
+    def test_chitietphieumuon_list_query_count_is_fixed(self):
+        self.assertQueryCountStable('/chitietphieumuon/', 1)
+
+    def test_phieumuon_list_query_count_is_fixed(self):
+        self.assertQueryCountStable('/phieumuon/', 1)
+
+    def test_readers_see_their_own_loans_including_deactivated_books(self):
+        cua_minh = self.tao_phieu_muon(self.tao_sach(is_active=False))
+        nguoi_khac = NguoiDung.objects.create_user(username='khac', password='khac')
+        cua_nguoi_khac = self.tao_phieu_muon(self.tao_sach(), doc_gia=nguoi_khac)
+
+        def ids(user):
+            self.client.force_authenticate(user=user)
+            return {row['id'] for row in self.client.get('/chitietphieumuon/').data['results']}
+
+        self.assertEqual(ids(self.admin), {cua_minh.pk, cua_nguoi_khac.pk})
+        self.assertEqual(ids(self.doc_gia), {cua_minh.pk})
+        response = self.client.post(f'/chitietphieumuon/{cua_minh.pk}/return-book/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post(f'/chitietphieumuon/{cua_nguoi_khac.pk}/return-book/').status_code, 404)
+
+
+class FeedTests(ThuVienTestCase):
+    def test_binhluan_feed_lists_each_user_and_book_once(self):
+        sach = self.tao_sach()
+        for i in range(6):
+            BinhLuan.objects.create(user=self.doc_gia if i % 2 else self.admin, sach=sach, content=f'Hay {i}')
+
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/binhluan/feed/?sach_id={sach.pk}')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertEqual(response.data['results'][0]['sach'], sach.pk)
+        self.assertEqual(set(response.data['users']), {self.admin.pk, self.doc_gia.pk})
+        self.assertEqual(response.data['books'][sach.pk]['tenDanhMuc'], 'Văn học')
+
+
+class StatisticsTests(ThuVienTestCase):
+    def test_borrow_return_late_statistics_is_one_grouped_query(self):
+        sach = self.tao_sach()
+        today = timezone.localdate()
+        last_month = today.replace(day=1) - timedelta(days=1)
+
+        self.tao_phieu_muon(sach)
+        for ngay_tre in (0, 10):
+            chi_tiet = self.tao_phieu_muon(sach, ngay_muon=last_month.replace(day=1))
+            chi_tiet.ngayTraThucTe = chi_tiet.phieuMuon.ngayTraDuKien + timedelta(days=ngay_tre)
+            chi_tiet.save()
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/sach/borrow-return-late-statistics/?window=2')
+
+        self.assertEqual(response.status_code, 200)
+        by_month = {(row['year'], row['month']): row for row in response.data['monthly_statistics']}
+        self.assertEqual(by_month[(today.year, today.month)]['borrowed'], 1)
+        returned = sum(row['returned'] for row in by_month.values())
+        late = sum(row['late'] for row in by_month.values())
+        self.assertEqual((returned, late), (1, 1))
+
+    def test_borrow_return_late_statistics_rejects_bad_granularity(self):
+        response = self.client.get('/sach/borrow-return-late-statistics/?granularity=year')
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncViewTests(ThuVienTestCase):
+    def test_async_views_match_the_sync_endpoints(self):
+        sach = self.tao_sach()
+        for i in range(3):
+            BinhLuan.objects.create(user=self.doc_gia, sach=sach, content=f'Hay {i}')
+        chi_tiet = self.tao_phieu_muon(sach, ngay_muon=timezone.localdate() - timedelta(days=10))
+        chi_tiet.ngayTraThucTe = timezone.localdate()
+        chi_tiet.save()
+
+        for url in ('binhluan/feed/?sach_id={}&page_size=2'.format(sach.pk),
+                    'sach/borrow-return-late-statistics/?granularity=day&window=14'):
+            expected = self.client.get(f'/{url}')
+            response = self.client.get(f'/async/{url}')
+            self.assertEqual(response.status_code, 200)
+            # Link trang kế tiếp trỏ về chính đường async
+            self.assertEqual(json.loads(response.content.decode().replace('/async/', '/')), expected.json())
+
+        Thich.objects.create(user=self.doc_gia, sach=sach)
+        self.assertEqual(self.client.get('/sach/dashboard/').data['cached'], False)
+        self.assertEqual(self.client.get('/async/sach/dashboard/').json()['cached'], True)
+        expected = self.client.get('/sach/dashboard/').json()
+        get_cache().clear()
+        response = self.client.get('/async/sach/dashboard/').json()
+        self.assertEqual(response['cached'], False)
+        bo_qua = {'generated_at', 'timings_ms', 'cached'}
+        self.assertEqual({k: v for k, v in response.items() if k not in bo_qua},
+                         {k: v for k, v in expected.items() if k not in bo_qua})
+        self.assertEqual(APIClient().get('/async/sach/dashboard/').status_code, 401)
+
+        self.assertEqual(self.client.get('/payment/').status_code, 405)
+        self.assertEqual(self.client.get('/async/payment/').status_code, 405)
+
+
+class QueryMetricsTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        giamsat.reset()
+        self.addCleanup(giamsat.reset)
+        self.sach = self.tao_sach()
+        for i in range(3):
+            BinhLuan.objects.create(user=self.doc_gia, sach=self.sach, content=f'Hay {i}')
+
+    def test_debug_headers_and_percentiles_per_action(self):
+        url = f'/binhluan/feed/?sach_id={self.sach.pk}'
+        self.assertNotIn('X-Query-Count', self.client.get(url))
+        with override_settings(DEBUG=True):
+            response = self.client.get(url)
+        self.assertEqual(response['X-Endpoint'], 'BinhLuanViewSet.feed')
+        self.assertEqual((response['X-Query-Count'], response['X-Duplicate-Queries']), ('3', '0'))
+        self.assertEqual(int(response['X-Response-Size']), len(response.content))
+        self.assertGreater(float(response['X-Render-Time-Ms']), 0)
+
+        rows = {row['endpoint']: row for row in self.client.get('/metrics/').data['endpoints']}
+        feed = rows['BinhLuanViewSet.feed']
+        self.assertEqual(feed['requests'], 2)
+        self.assertEqual((feed['queries']['p50'], feed['queries']['max']), (3, 3))
+        self.assertEqual(feed['n_plus_one']['requests'], 0)
+        self.client.force_authenticate(user=self.doc_gia)
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+
+    def test_repeated_queries_are_flagged_as_n_plus_one(self):
+        for i in range(5):
+            self.tao_sach(tenSach=f'Sách {i}', danhMuc=DanhMuc.objects.create(tenDanhMuc=f'Danh mục {i}'))
+
+        def view(request):
+            return HttpResponse(', '.join(sach.danhMuc.tenDanhMuc for sach in Sach.objects.all()))
+
+        request = RequestFactory().get('/sach/')
+        request.resolver_match = resolve('/sach/')
+        giamsat.QueryMetricsMiddleware(view)(request)
+
+        row, = giamsat.tong_hop()
+        self.assertEqual(row['endpoint'], 'SachViewSet.list')
+        self.assertEqual((row['queries']['max'], row['duplicate_queries']['max']), (7, 5))
+        self.assertEqual(row['n_plus_one']['max_repeats'], 6)
+        self.assertIn('ThuVien_danhmuc', row['n_plus_one']['sql'])
+
+    async def test_async_views_are_measured(self):
+        response = await self.async_client.get(f'/async/binhluan/feed/?sach_id={self.sach.pk}')
+        self.assertEqual(response.status_code, 200)
+        row, = giamsat.tong_hop()
+        self.assertEqual((row['endpoint'], row['queries']['max']), ('ThuVien.views_async.binh_luan_feed', 3))
+
+
+class ThongKeLuuThongTests(ThuVienTestCase):
+    def snapshot(self):
+        return sorted(
+            (row.ngay, row.sach_id, row.tinhTrang, row.soLuong, row.tienPhat)
+            for row in ThongKeLuuThong.objects.filter(soLuong__gt=0)
+        )
+
+    def test_incremental_rollup_matches_rebuild(self):
+        sach_a = self.tao_sach(tenSach='A')
+        sach_b = self.tao_sach(tenSach='B')
+        ngay_muon = timezone.localdate() - timedelta(days=20)
+        loans = [self.tao_phieu_muon(sach, ngay_muon=ngay_muon) for sach in (sach_a, sach_a, sach_b)]
+        loans[0].ngayTraThucTe = ngay_muon + timedelta(days=3)
+        loans[0].save()
+        loans[1].ngayTraThucTe = ngay_muon + timedelta(days=12)
+        loans[1].save()
+        loans[1].ghiChu = 'Bìa rách'
+        loans[1].save()
+        self.tao_phieu_muon(sach_b).phieuMuon.delete()
+
+        incremental = self.snapshot()
+        ThongKeLuuThong.rebuild()
+        self.assertEqual(incremental, self.snapshot())
+        self.assertIn((ngay_muon + timedelta(days=12), sach_a.pk, 'late', 1, 15000), incremental)
+
+    def test_most_late_books_reads_rollup(self):
+        sach = self.tao_sach(tenSach='Trễ')
+        chi_tiet = self.tao_phieu_muon(sach, ngay_muon=timezone.localdate() - timedelta(days=10))
+        chi_tiet.ngayTraThucTe = timezone.localdate()
+        chi_tiet.save()
+
+        response = self.client.get('/sach/most-late-books/')
+        self.assertEqual(response.data, [{'tenSach': 'Trễ', 'late_count': 1}])
+
+
+    def test_filter_books_returns_one_row_per_book(self):
+        sach_a, sach_b = self.tao_sach(tenSach='A'), self.tao_sach(tenSach='B')
+        today = timezone.localdate()
+        for sach, so_lan in ((sach_a, 3), (sach_b, 1)):
+            for _ in range(so_lan):
+                self.tao_phieu_muon(sach)
+
+        response = self.client.get('/sach/filter-books/', {'month': today.month, 'year': today.year,
+                                                           'tinhTrang': 'borrowed'})
+        self.assertEqual(response.data, [
+            {'tenSach': 'A', 'tinhTrang': 'borrowed', 'ngayTraThucTe': None, 'loan_count': 3},
+            {'tenSach': 'B', 'tinhTrang': 'borrowed', 'ngayTraThucTe': None, 'loan_count': 1},
+        ])
+
+
+class SyntheticDataTests(ThuVienTestCase):
+    def test_generated_rows_have_consistent_counters(self):
+        call_command('sinh_du_lieu', books=30, users=10, loans=200, comments=50, likes=50, shares=20,
+                     categories=3, batch_size=64, stdout=StringIO())
+
+        self.assertEqual(PhieuMuon.objects.count(), 200)
+        self.assertEqual(ChiTietPhieuMuon.objects.count(), 200)
+        self.assertEqual(Sach.objects.aggregate(total=Sum('totalBorrowCount'))['total'], 200)
+        self.assertEqual(Sach.objects.aggregate(total=Sum('soSachDangMuon'))['total'],
+                         ChiTietPhieuMuon.objects.filter(tinhTrang='borrowed').count())
+        self.assertEqual(NguoiDung.doi_soat_bo_dem(), 0)
+        self.assertEqual(ChiMucSach.objects.values('sach').distinct().count(),
+                         Sach.objects.filter(is_active=True).count())
+
+
+class InventoryCounterTests(ThuVienTestCase):
+    def test_borrow_refuses_to_go_below_zero(self):
+        sach = self.tao_sach(so_luong=1)
+        self.assertTrue(sach.borrow_book())
+        self.assertFalse(sach.borrow_book())
+        sach.refresh_from_db()
+        self.assertEqual((sach.soLuong, sach.soSachDangMuon, sach.totalBorrowCount), (0, 1, 1))
+
+    def test_borrow_endpoint_rejects_when_out_of_stock(self):
+        sach = self.tao_sach(so_luong=1)
+        data = {'ngayTraDuKien': (timezone.localdate() + timedelta(days=7)).isoformat()}
+        self.assertEqual(self.client.post(f'/phieumuon/{sach.pk}/borrow/', data).status_code, 201)
+        self.assertEqual(self.client.post(f'/phieumuon/{sach.pk}/borrow/', data).status_code, 400)
+        self.assertEqual(PhieuMuon.objects.filter(sach=sach).count(), 1)
+        sach.refresh_from_db()
+        self.assertEqual((sach.soLuong, sach.soSachDangMuon), (0, 1))
+
+    def test_saving_a_returned_loan_again_does_not_return_twice(self):
+        sach = self.tao_sach(so_luong=2)
+        chi_tiet = self.tao_phieu_muon(sach)
+        chi_tiet.ngayTraThucTe = timezone.localdate()
+        chi_tiet.save()
+        chi_tiet.ghiChu = 'Đã kiểm tra'
+        chi_tiet.save()
+        sach.refresh_from_db()
+        self.assertEqual((sach.soLuong, sach.soSachDangMuon), (2, 0))
+
+
+class ConcurrentBorrowTests(TransactionTestCase):
+    @skipUnlessDBFeature('test_db_allows_multiple_connections')
+    def test_concurrent_borrows_of_the_same_book(self):
+        danh_muc = DanhMuc.objects.create(tenDanhMuc='Văn học')
+        sach = Sach.objects.create(tenSach='Sách', tenTacGia='Tác giả', nXB='NXB', namXB=2020,
+                                   soLuong=5, danhMuc=danh_muc)
+        so_luong_thread = 20
+        barrier = threading.Barrier(so_luong_thread)
+        results = []
+
+        def muon():
+            try:
+                copy = Sach.objects.get(pk=sach.pk)
+                barrier.wait()
+                results.append(copy.borrow_book())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=muon) for _ in range(so_luong_thread)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sach.refresh_from_db()
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual((sach.soLuong, sach.soSachDangMuon, sach.totalBorrowCount), (0, 5, 5))
+
+
+class BulkBorrowReturnTests(ThuVienTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.doc_gia)
+
+    def post_counting_queries(self, url, data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_bulk_borrow_and_return_cost_does_not_grow_with_batch_size(self):
+        books = [self.tao_sach(so_luong=2, tenSach=f'Sách {i}') for i in range(6)]
+
+        _, one_book = self.post_counting_queries('/sach/bulk_borrow/', {'books': [books[5].pk]})
+        ids = [sach.pk for sach in books[:5]] + [books[0].pk]
+        response, six_books = self.post_counting_queries('/sach/bulk_borrow/', {'books': ids})
+        self.assertEqual(one_book, six_books)
+        self.assertEqual(len(response.data['borrowed_books']), 6)
+        books[0].refresh_from_db()
+        self.assertEqual((books[0].soLuong, books[0].soSachDangMuon, books[0].totalBorrowCount), (0, 2, 2))
+
+        chi_tiet_ids = list(ChiTietPhieuMuon.objects.order_by('id').values_list('id', flat=True))
+        _, one_loan = self.post_counting_queries('/sach/returned/', {'chi_tiet_ids': chi_tiet_ids[:1]})
+        response, six_loans = self.post_counting_queries('/sach/returned/', {'chi_tiet_ids': chi_tiet_ids[1:]})
+        self.assertEqual(one_loan, six_loans)
+        self.assertEqual(len(response.data['returned_books']), 6)
+        self.assertFalse(ChiTietPhieuMuon.objects.filter(tinhTrang='borrowed').exists())
+        books[0].refresh_from_db()
+        self.assertEqual((books[0].soLuong, books[0].soSachDangMuon), (2, 0))
+
+        incremental = sorted(ThongKeLuuThong.objects.filter(soLuong__gt=0)
+                             .values_list('ngay', 'sach', 'tinhTrang', 'soLuong'))
+        ThongKeLuuThong.rebuild()
+        self.assertEqual(incremental, sorted(ThongKeLuuThong.objects.values_list('ngay', 'sach', 'tinhTrang', 'soLuong')))
+
+    def test_borrow_many_without_bulk_insert_ids_ignores_older_loans(self):
+        sach = self.tao_sach(so_luong=2)
+        today = timezone.localdate()
+        cu = PhieuMuon.objects.create(docGia=self.doc_gia, sach=sach, ngayMuon=today,
+                                      ngayTraDuKien=today + timedelta(days=7))
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert',
+                               new_callable=mock.PropertyMock, return_value=False):
+            chi_tiet_list = ChiTietPhieuMuon.borrow_many(self.doc_gia, [sach])
+        self.assertNotEqual(chi_tiet_list[0].phieuMuon_id, cu.pk)
+        self.assertFalse(ChiTietPhieuMuon.objects.filter(phieuMuon=cu).exists())
+
+    def test_return_many_rolls_back_when_stock_counter_is_short(self):
+        sach = self.tao_sach(so_luong=2)
+        chi_tiet_list = ChiTietPhieuMuon.borrow_many(self.doc_gia, [sach, sach])
+        Sach.objects.filter(pk=sach.pk).update(soSachDangMuon=1)
+        with self.assertRaises(ValidationError):
+            ChiTietPhieuMuon.return_many(list(ChiTietPhieuMuon.objects.select_related('phieuMuon')
+                                              .filter(pk__in=[chi_tiet.pk for chi_tiet in chi_tiet_list])))
+        self.assertEqual(ChiTietPhieuMuon.objects.filter(tinhTrang='borrowed').count(), 2)
+
+    def test_bulk_borrow_reports_unavailable_book_and_writes_nothing(self):
+        available = self.tao_sach(so_luong=1, tenSach='Còn')
+        sold_out = self.tao_sach(so_luong=0, tenSach='Hết')
+
+        response = self.client.post('/sach/bulk_borrow/', {'books': [available.pk, sold_out.pk]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Hết is not available for borrowing.')
+        self.assertFalse(PhieuMuon.objects.exists())
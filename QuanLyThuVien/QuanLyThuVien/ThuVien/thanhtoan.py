@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+import weakref
+from datetime import datetime
+
+import httpx
+from django.conf import settings
+
+# Client gọi cổng thanh toán MoMo / ZaloPay dùng chung cho mọi request: một pool kết nối keep-alive
+# cho mỗi tiến trình (bản async: mỗi event loop), thời gian chờ kết nối / đọc chặt và thử lại có giới
+# hạn trong tổng thời gian DEADLINE. Tạo đơn không idempotent nên chỉ thử lại khi request chắc chắn chưa
+# tới cổng (lỗi ở bước kết nối) hoặc cổng trả 502/503/504; hết thời gian đọc thì không gửi lại. Đơn mang
+# requestId / app_trans_id cố định nên nếu lần trước đã tới cổng, lần gửi lại nhận lỗi "trùng đơn": lỗi
+# này được coi là cổng đã nhận đơn (kết quả gắn 'duplicate': True, IPN / callback sẽ báo kết quả sau).
+MOMO_PATH = '/v2/gateway/api/create'
+ZALOPAY_PATH = '/v2/create'
+RETRY_STATUS = {502, 503, 504}
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+MOMO_TRUNG_DON = 41  # resultCode: trùng orderId
+ZALOPAY_TRUNG_DON = -68  # sub_return_code: trùng app_trans_id
+
+
+class PaymentGatewayError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def cau_hinh():
+    return settings.THUVIEN_PAYMENT
+
+
+def _timeout(con_lai=None):
+    # con_lai: số giây còn lại trước DEADLINE, mỗi lần thử không chờ quá mức đó
+    config = cau_hinh()
+    if con_lai is None:
+        return httpx.Timeout(config['TIMEOUT'], connect=config['CONNECT_TIMEOUT'])
+    return httpx.Timeout(min(config['TIMEOUT'], con_lai), connect=min(config['CONNECT_TIMEOUT'], con_lai))
+
+
+def _limits():
+    config = cau_hinh()
+    return httpx.Limits(max_connections=config['MAX_CONNECTIONS'],
+                        max_keepalive_connections=config['MAX_KEEPALIVE'])
+
+
+def ky_momo(data, secret_key):
+    raw = '&'.join(f'{key}={data[key]}' for key in (
+        'accessKey', 'amount', 'extraData', 'ipnUrl', 'orderId', 'orderInfo', 'partnerCode', 'redirectUrl',
+        'requestId', 'requestType'))
+    return hmac.new(secret_key.encode(), raw.encode(), hashlib.sha256).hexdigest()
+
+
+def ky_zalopay(order, key1):
+    raw = '|'.join(str(order[key]) for key in (
+        'app_id', 'app_trans_id', 'app_user', 'amount', 'app_time', 'embed_data', 'item'))
+    return hmac.new(key1.encode(), raw.encode(), hashlib.sha256).hexdigest()
+
+
+# Chữ ký của thông báo kết quả thanh toán (IPN / callback) do cổng gửi về
+def ky_momo_ipn(data, secret_key):
+    raw = f"accessKey={cau_hinh()['MOMO']['access_key']}&" + '&'.join(f'{key}={data.get(key, "")}' for key in (
+        'amount', 'extraData', 'message', 'orderId', 'orderInfo', 'orderType', 'partnerCode', 'payType',
+        'requestId', 'responseTime', 'resultCode', 'transId'))
+    return hmac.new(secret_key.encode(), raw.encode(), hashlib.sha256).hexdigest()
+
+
+def ky_zalopay_callback(data, key2):
+    return hmac.new(key2.encode(), data.encode(), hashlib.sha256).hexdigest()
+
+
+def xac_thuc_momo_ipn(data):
+    return hmac.compare_digest(str(data.get('signature', '')), ky_momo_ipn(data, cau_hinh()['MOMO']['secret_key']))
+
+
+def xac_thuc_zalopay_callback(data, mac):
+    return hmac.compare_digest(str(mac or ''), ky_zalopay_callback(data, cau_hinh()['ZALOPAY']['key2']))
+
+
+def ma_don_hang(cong):
+    # Mã đơn gửi cho cổng, duy nhất trên mọi môi trường dùng chung một tài khoản sandbox.
+    # ZaloPay yêu cầu app_trans_id dạng yymmdd_xxx.
+    if cong == 'zalopay':
+        return '{:%y%m%d}_{}'.format(datetime.today(), uuid.uuid4().hex[:20])
+    return f'MM{uuid.uuid4().hex[:24]}'
+
+
+def don_momo(amount, order_id=None, order_info='pay with MoMo', request_type='payWithATM'):
+    config = cau_hinh()['MOMO']
+    order_id = order_id or ma_don_hang('momo')
+    data = {
+        'partnerCode': config['partner_code'],
+        'accessKey': config['access_key'],
+        # requestId trùng orderId để gửi lại cùng đơn là idempotent ở phía MoMo
+        'requestId': order_id,
+        'amount': amount,
+        'orderId': order_id,
+        'orderInfo': order_info,
+        'redirectUrl': config['redirect_url'],
+        'ipnUrl': config['ipn_url'],
+        'extraData': '',
+        'requestType': request_type,
+        'lang': 'vi',
+    }
+    data['signature'] = ky_momo(data, config['secret_key'])
+    return data
+
+
+def don_zalopay(amount, app_user='user123', bank_code='zalopayapp', app_trans_id=None):
+    config = cau_hinh()['ZALOPAY']
+    app_trans_id = app_trans_id or ma_don_hang('zalopay')
+    order = {
+        'app_id': config['app_id'],
+        'app_trans_id': app_trans_id,
+        'app_user': app_user,
+        'app_time': int(round(time.time() * 1000)),
+        'embed_data': json.dumps({}),
+        'item': json.dumps([{
+            'itemid': 'knb',
+            'itemname': 'Kim Nguyên Bảo',
+            'itemprice': amount,
+            'itemquantity': 1,
+        }]),
+        'amount': amount,
+        'description': 'ZaloPay - Thanh toán tiền phạt #{}'.format(app_trans_id.split('_')[-1]),
+        'bank_code': bank_code,
+    }
+    order['mac'] = ky_zalopay(order, config['key1'])
+    return order
+
+
+def _ket_qua(response, trung_don=None):
+    if response.status_code != 200:
+        raise PaymentGatewayError(f'Status code: {response.status_code}', response.status_code)
+    try:
+        result = response.json()
+    except ValueError:
+        raise PaymentGatewayError('Invalid JSON response from payment gateway', response.status_code)
+    if trung_don is not None and trung_don(result):
+        result = {**result, 'duplicate': True}
+    return result
+
+
+def _trung_momo(result):
+    return result.get('resultCode') == MOMO_TRUNG_DON
+
+
+def _trung_zalopay(result):
+    return result.get('sub_return_code') == ZALOPAY_TRUNG_DON
+
+
+def _cho(attempt):
+    # Backoff lũy thừa có jitter giữa các lần thử
+    return cau_hinh()['BACKOFF'] * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def _thu_tiep(attempt, bat_dau):
+    # Số giây chờ trước lần thử kế tiếp; None khi đã hết lượt hoặc lần thử kế tiếp bắt đầu sau DEADLINE
+    config = cau_hinh()
+    cho = _cho(attempt)
+    if attempt >= config['RETRIES'] or time.monotonic() - bat_dau + cho >= config['DEADLINE']:
+        return None
+    return cho
+
+
+def _con_lai(bat_dau):
+    return max(cau_hinh()['DEADLINE'] - (time.monotonic() - bat_dau), 0.01)
+
+
+def _loi(response, error):
+    # Hết lượt thử: trả lỗi của lần cuối
+    if response is not None:
+        return _ket_qua(response)
+    raise PaymentGatewayError(f'{type(error).__name__}: {error}')
+
+
+_lock = threading.Lock()
+_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = httpx.Client(timeout=_timeout(), limits=_limits())
+    return _client
+
+
+def get_async_client():
+    # AsyncClient gắn với event loop tạo ra nó nên mỗi loop (mỗi worker ASGI) giữ một pool riêng
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(timeout=_timeout(), limits=_limits())
+    return client
+
+
+def _dong_async_client(loop, client):
+    # aclose() phải chạy trên loop sở hữu client: loop đang chạy thì lên lịch trên loop đó, loop đang dừng thì
+    # chạy tới khi đóng xong. Loop đã đóng thì không còn chạy được coroutine nào nên bỏ qua.
+    if loop.is_closed():
+        return
+    try:
+        dang_chay = asyncio.get_running_loop()
+    except RuntimeError:
+        dang_chay = None
+    if loop is dang_chay:
+        loop.create_task(client.aclose())
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+    elif dang_chay is None:
+        loop.run_until_complete(client.aclose())
+
+
+def reset():
+    # Đóng pool hiện tại (vd. sau khi đổi THUVIEN_PAYMENT); lần gọi sau tạo pool mới
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        async_clients = list(_async_clients.items())
+        _async_clients.clear()
+    for loop, client in async_clients:
+        _dong_async_client(loop, client)
+
+
+# trung_don: hàm nhận ra phản hồi "trùng đơn", chỉ dùng khi một lần thử trước có thể đã tới cổng
+def post(url, trung_don=None, **kwargs):
+    bat_dau = time.monotonic()
+    da_toi_cong = False
+    attempt = 0
+    while True:
+        response = error = None
+        try:
+            response = get_client().post(url, timeout=_timeout(_con_lai(bat_dau)), **kwargs)
+        except RETRY_ERRORS as e:
+            error = e
+        except httpx.TransportError as e:
+            raise PaymentGatewayError(f'{type(e).__name__}: {e}')
+        if response is not None and response.status_code not in RETRY_STATUS:
+            return _ket_qua(response, trung_don if da_toi_cong else None)
+        da_toi_cong = da_toi_cong or response is not None
+        cho = _thu_tiep(attempt, bat_dau)
+        if cho is None:
+            return _loi(response, error)
+        time.sleep(cho)
+        attempt += 1
+
+
+async def apost(url, trung_don=None, **kwargs):
+    bat_dau = time.monotonic()
+    da_toi_cong = False
+    attempt = 0
+    while True:
+        response = error = None
+        try:
+            response = await get_async_client().post(url, timeout=_timeout(_con_lai(bat_dau)), **kwargs)
+        except RETRY_ERRORS as e:
+            error = e
+        except httpx.TransportError as e:
+            raise PaymentGatewayError(f'{type(e).__name__}: {e}')
+        if response is not None and response.status_code not in RETRY_STATUS:
+            return _ket_qua(response, trung_don if da_toi_cong else None)
+        da_toi_cong = da_toi_cong or response is not None
+        cho = _thu_tiep(attempt, bat_dau)
+        if cho is None:
+            return _loi(response, error)
+        await asyncio.sleep(cho)
+        attempt += 1
+
+
+def tao_don_momo(amount, order_id=None):
+    return post(cau_hinh()['MOMO']['endpoint'], trung_don=_trung_momo, json=don_momo(amount, order_id))
+
+
+def tao_don_zalopay(amount, app_user='user123', bank_code='zalopayapp', app_trans_id=None):
+    return post(cau_hinh()['ZALOPAY']['endpoint'], trung_don=_trung_zalopay,
+                data=don_zalopay(amount, app_user, bank_code, app_trans_id))
+
+
+async def atao_don_momo(amount, order_id=None):
+    return await apost(cau_hinh()['MOMO']['endpoint'], trung_don=_trung_momo, json=don_momo(amount, order_id))
+
+
+async def atao_don_zalopay(amount, app_user='user123', bank_code='zalopayapp', app_trans_id=None):
+    return await apost(cau_hinh()['ZALOPAY']['endpoint'], trung_don=_trung_zalopay,
+                       data=don_zalopay(amount, app_user, bank_code, app_trans_id))
+
+
+def tao_don(cong, amount, order_id, app_user='user123', bank_code='zalopayapp'):
+    if cong == 'zalopay':
+        return tao_don_zalopay(amount, app_user, bank_code, order_id)
+    return tao_don_momo(amount, order_id)
+
+
+async def atao_don(cong, amount, order_id, app_user='user123', bank_code='zalopayapp'):
+    if cong == 'zalopay':
+        return await atao_don_zalopay(amount, app_user, bank_code, order_id)
+    return await atao_don_momo(amount, order_id)
+
+
+def thanh_cong(cong, result):
+    # Cổng đã nhận đơn: MoMo resultCode = 0, ZaloPay return_code = 1, hoặc lần gửi lại báo trùng đơn
+    if result.get('duplicate'):
+        return True
+    if cong == 'zalopay':
+        return result.get('return_code') == 1
+    return result.get('resultCode') == 0
+
+
+def pay_url(cong, result):
+    return result.get('order_url' if cong == 'zalopay' else 'payUrl', '')
@@ -0,0 +1,281 @@
+import time
+from datetime import date, timedelta
+
+from asgiref.sync import sync_to_async
+from django.db.models import Q, Sum, Count, Value, DateField, Case, When, IntegerField
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
+
+from . import bangxephang
+from .cache import get_cache
+from .models import NguoiDung, DanhMuc, Sach, ThongKeLuuThong
+
+GRANULARITIES = ('day', 'week', 'month')
+MAX_WINDOW = 366
+
+
+def period_start(day, granularity):
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def shift_period(start, granularity, periods):
+    if granularity == 'day':
+        return start + timedelta(days=periods)
+    if granularity == 'week':
+        return start + timedelta(weeks=periods)
+    year, month = divmod(start.year * 12 + start.month - 1 + periods, 12)
+    return date(year, month + 1, 1)
+
+
+def _circulation_rows(granularity, window, today):
+    # Một truy vấn GROUP BY trên bảng tổng hợp theo ngày: sách đang mượn tính theo ngày mượn,
+    # đã trả / trễ hạn tính theo ngày trả thực tế, rồi cộng có điều kiện theo từng kỳ.
+    today = today or timezone.localdate()
+    current = period_start(today, granularity)
+    start = shift_period(current, granularity, -(window - 1))
+    end = shift_period(current, granularity, 1)
+
+    return ThongKeLuuThong.objects.filter(
+        tinhTrang__in=['borrowed', 'returned', 'late'],
+        ngay__gte=start,
+        ngay__lt=end,
+        soLuong__gt=0,
+    ).annotate(
+        period=Trunc('ngay', granularity, output_field=DateField())
+    ).values('period').annotate(
+        borrowed=Coalesce(Sum('soLuong', filter=Q(tinhTrang='borrowed')), Value(0)),
+        returned=Coalesce(Sum('soLuong', filter=Q(tinhTrang='returned')), Value(0)),
+        late=Coalesce(Sum('soLuong', filter=Q(tinhTrang='late')), Value(0)),
+    ).order_by('period')
+
+
+def _circulation_item(row, granularity):
+    item = {
+        'period': row['period'].isoformat(),
+        'year': row['period'].year,
+        'month': row['period'].month,
+        'borrowed': row['borrowed'],
+        'returned': row['returned'],
+        'late': row['late'],
+    }
+    if granularity != 'month':
+        item['day'] = row['period'].day
+    return item
+
+
+def circulation_statistics(granularity='month', window=12, today=None):
+    return [_circulation_item(row, granularity) for row in _circulation_rows(granularity, window, today)]
+
+
+async def acirculation_statistics(granularity='month', window=12, today=None):
+    return [_circulation_item(row, granularity) async for row in _circulation_rows(granularity, window, today)]
+
+
+def top_books(tinh_trang, start=None, end=None, limit=None):
+    rows = ThongKeLuuThong.objects.filter(tinhTrang=tinh_trang)
+    if start is not None:
+        rows = rows.filter(ngay__gte=start)
+    if end is not None:
+        rows = rows.filter(ngay__lt=end)
+    rows = rows.values('sach', 'sach__tenSach').annotate(total=Sum('soLuong')) \
+        .filter(total__gt=0).order_by('-total')
+    return rows[:limit] if limit else rows
+
+
+def age_histogram(buckets=None, chuc_vu=None, is_active=None, today=None):
+    # Đếm trong CSDL theo nam_sinh, không nạp NguoiDung lên bộ nhớ. buckets là các mốc tuổi tăng dần,
+    # vd. [18, 26, 41] cho các khoảng 0-17, 18-25, 26-40, 41+; không có buckets thì đếm theo từng tuổi.
+    year = (today or timezone.localdate()).year
+    users = NguoiDung.objects.filter(nam_sinh__isnull=False)
+    if chuc_vu is not None:
+        users = users.filter(chucVu=chuc_vu)
+    if is_active is not None:
+        users = users.filter(is_active=is_active)
+
+    if not buckets:
+        rows = users.values('nam_sinh').annotate(count=Count('id')).order_by('-nam_sinh')
+        return [{'age': year - row['nam_sinh'], 'count': row['count']} for row in rows]
+
+    # tuổi trong [lo, hi) <=> nam_sinh trong (year - hi, year - lo]
+    edges = [0] + sorted(set(buckets) - {0})
+    ranges = list(zip(edges, edges[1:] + [None]))
+    bucket = Case(
+        *[When(Q(nam_sinh__lte=year - lo) & (Q(nam_sinh__gt=year - hi) if hi is not None else Q()), then=Value(i))
+          for i, (lo, hi) in enumerate(ranges)],
+        output_field=IntegerField(),
+    )
+    counts = dict(users.annotate(bucket=bucket).values('bucket').annotate(count=Count('id'))
+                  .order_by().values_list('bucket', 'count'))
+    return [
+        {
+            'bucket': f'{lo}-{hi - 1}' if hi is not None else f'{lo}+',
+            'min_age': lo,
+            'max_age': hi - 1 if hi is not None else None,
+            'count': counts.get(i, 0),
+        }
+        for i, (lo, hi) in enumerate(ranges)
+    ]
+
+
+def category_summary():
+    # Mỗi danh mục một dòng, tính trong một truy vấn GROUP BY (LEFT JOIN Sach)
+    return DanhMuc.objects.annotate(
+        book_count=Count('books'),
+        active_count=Count('books', filter=Q(books__is_active=True)),
+        inactive_count=Count('books', filter=Q(books__is_active=False)),
+        available_copies=Coalesce(Sum('books__soLuong'), 0),
+        borrowed_copies=Coalesce(Sum('books__soSachDangMuon'), 0),
+    ).values('id', 'tenDanhMuc', 'book_count', 'active_count', 'inactive_count',
+             'available_copies', 'borrowed_copies').order_by('id')
+
+
+DASHBOARD_KEY = 'thuvien:dashboard'
+DASHBOARD_TOP = 5
+
+
+# Mỗi phần của dashboard có bản đồng bộ và bản async (ORM async: aaggregate / async for), dùng chung
+# truy vấn và cách định dạng nên hai đường trả cùng kết quả.
+def _nguoi_dung_rows():
+    # Một GROUP BY nam_sinh cho cả phân bố độ tuổi lẫn số người dùng (user-count)
+    return NguoiDung.objects.values('nam_sinh').annotate(
+        count=Count('id'), staff=Count('id', filter=Q(is_staff=True))
+    ).order_by('nam_sinh')
+
+
+def _nguoi_dung_tu(rows, today):
+    return {
+        'user_count': sum(row['staff'] for row in rows),
+        'ages': [{'age': today.year - row['nam_sinh'], 'count': row['count']}
+                 for row in rows if row['nam_sinh'] is not None],
+    }
+
+
+def _nguoi_dung(today):
+    return _nguoi_dung_tu(list(_nguoi_dung_rows()), today)
+
+
+async def _anguoi_dung(today):
+    return _nguoi_dung_tu([row async for row in _nguoi_dung_rows()], today)
+
+
+# book-count, total-borrow-return-counts và total-interactions trong một aggregate
+TONG_SACH = {
+    'total_books': Coalesce(Sum('soLuong'), 0),
+    'total_borrow_count': Coalesce(Sum('totalBorrowCount'), 0),
+    'total_likes': Coalesce(Sum('soLuotThich'), 0),
+    'total_comments': Coalesce(Sum('soBinhLuan'), 0),
+    'total_shares': Coalesce(Sum('soChiaSe'), 0),
+}
+
+
+def _sach_tu(totals):
+    totals['combined_total'] = totals['total_likes'] + totals['total_comments']
+    return totals
+
+
+def _sach(today):
+    return _sach_tu(Sach.objects.aggregate(**TONG_SACH))
+
+
+async def _asach(today):
+    return _sach_tu(await Sach.objects.aaggregate(**TONG_SACH))
+
+
+def _danh_muc(today):
+    return list(category_summary())
+
+
+async def _adanh_muc(today):
+    return [row async for row in category_summary()]
+
+
+def _luu_thong(today):
+    return circulation_statistics('month', 12, today)
+
+
+async def _aluu_thong(today):
+    return await acirculation_statistics('month', 12, today)
+
+
+# Các bảng xếp hạng đọc từ bộ nhớ; tên sách của mọi bảng lấy chung một truy vấn
+def _bang_xep_hang():
+    return {metric: bangxephang.top(metric, DASHBOARD_TOP) for metric in ('liked', 'commented', 'borrowed', 'late')}
+
+
+def _ten_sach(boards):
+    return Sach.objects.filter(pk__in={sach_id for rows in boards.values() for sach_id, _ in rows}) \
+        .values_list('id', 'tenSach')
+
+
+def _xep_hang_tu(boards, names):
+    return {
+        metric: [{'id': sach_id, 'tenSach': names[sach_id], 'total': total}
+                 for sach_id, total in rows if sach_id in names]
+        for metric, rows in boards.items()
+    }
+
+
+def _xep_hang(today):
+    boards = _bang_xep_hang()
+    return _xep_hang_tu(boards, dict(_ten_sach(boards)))
+
+
+async def _axep_hang(today):
+    # Bảng chưa nạp (hoặc hết TTL) được nạp lại từ CSDL bằng truy vấn đồng bộ nên chạy qua sync_to_async
+    boards = await sync_to_async(_bang_xep_hang)()
+    return _xep_hang_tu(boards, {sach_id: ten async for sach_id, ten in _ten_sach(boards)})
+
+
+DASHBOARD_SECTIONS = (
+    ('users', _nguoi_dung),
+    ('books', _sach),
+    ('categories', _danh_muc),
+    ('circulation', _luu_thong),
+    ('leaderboards', _xep_hang),
+)
+
+ADASHBOARD_SECTIONS = (
+    ('users', _anguoi_dung),
+    ('books', _asach),
+    ('categories', _adanh_muc),
+    ('circulation', _aluu_thong),
+    ('leaderboards', _axep_hang),
+)
+
+
+def dashboard(today=None, timeout=30):
+    # Kết quả gộp được cache ngắn hạn; timings_ms là thời gian tính của từng phần ở lần tính gần nhất.
+    cache = get_cache()
+    data = cache.get(DASHBOARD_KEY)
+    if data is not None:
+        return {**data, 'cached': True}
+
+    today = today or timezone.localdate()
+    data = {'generated_at': timezone.now().isoformat(), 'timings_ms': {}}
+    for name, compute in DASHBOARD_SECTIONS:
+        started = time.perf_counter()
+        data[name] = compute(today)
+        data['timings_ms'][name] = round((time.perf_counter() - started) * 1000, 2)
+    cache.set(DASHBOARD_KEY, data, timeout)
+    return {**data, 'cached': False}
+
+
+async def adashboard(today=None, timeout=30):
+    # Bản async của dashboard(), dùng chung khóa cache
+    cache = get_cache()
+    data = await cache.aget(DASHBOARD_KEY)
+    if data is not None:
+        return {**data, 'cached': True}
+
+    today = today or timezone.localdate()
+    data = {'generated_at': timezone.now().isoformat(), 'timings_ms': {}}
+    for name, compute in ADASHBOARD_SECTIONS:
+        started = time.perf_counter()
+        data[name] = await compute(today)
+        data['timings_ms'][name] = round((time.perf_counter() - started) * 1000, 2)
+    await cache.aset(DASHBOARD_KEY, data, timeout)
+    return {**data, 'cached': False}
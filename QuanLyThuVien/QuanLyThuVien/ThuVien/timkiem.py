@@ -0,0 +1,170 @@
+import math
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Sum, Case, When, Value, F, FloatField
+
+from .models import Sach, TuKhoa, TuKhoaTrigram, ChiMucSach
+
+# Khớp ở tên sách được xếp trên tác giả, tác giả trên NXB
+TRUONG_TRONG_SO = (('tenSach', 3), ('tenTacGia', 2), ('nXB', 1))
+TRUONG_CHI_MUC = {'tenSach', 'tenTacGia', 'nXB', 'is_active'}
+NGUONG_TUONG_TU = 0.3
+SO_TU_GAN_DUNG = 10
+MAX_TU_TRUY_VAN = 8
+# Khi các từ truy vấn khớp nhiều hơn ngần này dòng chỉ mục, chỉ xếp hạng các sách chứa từ hiếm nhất
+# (tối đa ngần này sách, đọc theo trọng số giảm dần) thay vì gộp mọi dòng của mọi từ
+MAX_UNG_VIEN = 1000
+
+
+def bo_dau(text):
+    # "Đắc Nhân Tâm" -> "Dac Nhan Tam"; đ/Đ không phải dấu kết hợp nên thay riêng
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if not unicodedata.combining(c))
+
+
+def tach_tu(text):
+    return [tu[:64] for tu in re.findall(r'[a-z0-9]+', bo_dau(text or '').lower())]
+
+
+def trigrams(tu):
+    # Đệm giống pg_trgm để đầu từ có trọng lượng hơn: "tam" -> "  t", " ta", "tam", "am "
+    padded = f'  {tu} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _trong_so_sach(sach):
+    trong_so = defaultdict(int)
+    for field, weight in TRUONG_TRONG_SO:
+        for tu in tach_tu(getattr(sach, field)):
+            trong_so[tu] += weight
+    return trong_so
+
+
+def _lay_tu_khoa(words, tu_dien):
+    # tu_dien: {tu: id}, được dùng lại giữa các lô khi rebuild
+    thieu = [tu for tu in words if tu not in tu_dien]
+    if thieu:
+        tu_dien.update(TuKhoa.objects.filter(tu__in=thieu).values_list('tu', 'id'))
+    moi = [tu for tu in thieu if tu not in tu_dien]
+    if moi:
+        TuKhoa.objects.bulk_create([TuKhoa(tu=tu, soTrigram=len(trigrams(tu))) for tu in moi],
+                                   ignore_conflicts=True)
+        ids = dict(TuKhoa.objects.filter(tu__in=moi).values_list('tu', 'id'))
+        TuKhoaTrigram.objects.bulk_create([
+            TuKhoaTrigram(trigram=trigram, tuKhoa_id=ids[tu]) for tu in moi for trigram in trigrams(tu)
+        ], ignore_conflicts=True)
+        tu_dien.update(ids)
+    return tu_dien
+
+
+def cap_nhat_sach(sach):
+    # Cập nhật tăng dần cho một sách: xóa các dòng cũ rồi ghi lại. Sách ngừng hoạt động không được chỉ mục.
+    with transaction.atomic():
+        ChiMucSach.objects.filter(sach_id=sach.pk).delete()
+        if not sach.is_active:
+            return
+        trong_so = _trong_so_sach(sach)
+        tu_dien = _lay_tu_khoa(trong_so, {})
+        ChiMucSach.objects.bulk_create([
+            ChiMucSach(tuKhoa_id=tu_dien[tu], sach_id=sach.pk, trongSo=weight)
+            for tu, weight in trong_so.items()
+        ])
+
+
+def rebuild(batch_size=1000):
+    with transaction.atomic():
+        ChiMucSach.objects.all().delete()
+        TuKhoaTrigram.objects.all().delete()
+        TuKhoa.objects.all().delete()
+
+        tu_dien = {}
+        last_id = 0
+        queryset = Sach.objects.filter(is_active=True).only('id', 'tenSach', 'tenTacGia', 'nXB').order_by('id')
+        while True:
+            books = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not books:
+                break
+            trong_so = {sach.pk: _trong_so_sach(sach) for sach in books}
+            _lay_tu_khoa({tu for item in trong_so.values() for tu in item}, tu_dien)
+            ChiMucSach.objects.bulk_create([
+                ChiMucSach(tuKhoa_id=tu_dien[tu], sach_id=sach_id, trongSo=weight)
+                for sach_id, item in trong_so.items() for tu, weight in item.items()
+            ], batch_size=batch_size)
+            last_id = books[-1].pk
+    return TuKhoa.objects.count()
+
+
+def tu_gan_dung(tu):
+    # Các từ trong từ điển có độ tương tự trigram (Jaccard) >= NGUONG_TUONG_TU, từ khớp đúng có điểm 1.
+    # Jaccard >= t chỉ có thể khi số trigram của từ nằm trong [n*t, n/t] nên lọc trước theo soTrigram.
+    tu_trigrams = trigrams(tu)
+    n = len(tu_trigrams)
+    rows = TuKhoaTrigram.objects.filter(
+        trigram__in=tu_trigrams,
+        tuKhoa__soTrigram__gte=math.ceil(n * NGUONG_TUONG_TU),
+        tuKhoa__soTrigram__lte=math.floor(n / NGUONG_TUONG_TU),
+    ).values('tuKhoa', 'tuKhoa__soTrigram').annotate(chung=Count('id')).order_by('-chung')[:SO_TU_GAN_DUNG * 5]
+
+    ket_qua = []
+    for row in rows:
+        do_tuong_tu = row['chung'] / (n + row['tuKhoa__soTrigram'] - row['chung'])
+        if do_tuong_tu >= NGUONG_TUONG_TU:
+            ket_qua.append((row['tuKhoa'], do_tuong_tu))
+    ket_qua.sort(key=lambda item: -item[1])
+    return ket_qua[:SO_TU_GAN_DUNG]
+
+
+def _so_dong(tu_khoa_ids):
+    # Số dòng chỉ mục của một từ truy vấn, chỉ đếm tới MAX_UNG_VIEN + 1 nên không quét hết từ phổ biến
+    return ChiMucSach.objects.filter(tuKhoa_id__in=tu_khoa_ids)[:MAX_UNG_VIEN + 1].count()
+
+
+def _ung_vien(tu_khoa_ids, so_dong):
+    # Sách chứa một trong các từ (xếp theo độ tương tự giảm dần), tối đa MAX_UNG_VIEN; từ phổ biến được đọc
+    # theo chỉ mục (tuKhoa, trongSo, sach) từ trọng số cao xuống nên dừng sớm được
+    if so_dong <= MAX_UNG_VIEN:
+        return set(ChiMucSach.objects.filter(tuKhoa_id__in=tu_khoa_ids).values_list('sach', flat=True))
+    ung_vien = set()
+    for tu_khoa_id in tu_khoa_ids:
+        con_lai = MAX_UNG_VIEN - len(ung_vien)
+        if con_lai <= 0:
+            break
+        ung_vien.update(ChiMucSach.objects.filter(tuKhoa_id=tu_khoa_id).order_by('-trongSo', '-sach')
+                        .values_list('sach', flat=True)[:con_lai])
+    return ung_vien
+
+
+def tim_kiem(query, limit=20):
+    # Trả về [(sach_id, số từ truy vấn khớp, điểm)], xếp theo số từ khớp rồi tổng
+    # (trọng số trường x độ tương tự); cả việc cộng điểm lẫn xếp hạng đều chạy trong CSDL.
+    tu_truy_van = list(dict.fromkeys(tach_tu(query)))[:MAX_TU_TRUY_VAN]
+    mo_rong = {}  # tuKhoa_id -> (vị trí từ truy vấn, độ tương tự)
+    for vi_tri, tu in enumerate(tu_truy_van):
+        for tu_khoa_id, do_tuong_tu in tu_gan_dung(tu):
+            if do_tuong_tu > mo_rong.get(tu_khoa_id, (None, 0))[1]:
+                mo_rong[tu_khoa_id] = (vi_tri, do_tuong_tu)
+    if not mo_rong:
+        return []
+
+    rows = ChiMucSach.objects.filter(tuKhoa_id__in=mo_rong)
+    # Từ hiếm nhất trước: nếu tổng số dòng chỉ mục của các từ lớn (từ phổ biến như "sach" ở hàng triệu tên sách),
+    # chỉ gộp điểm trên các sách chứa từ truy vấn hiếm nhất thay vì mọi dòng khớp
+    theo_vi_tri = defaultdict(list)
+    for tu_khoa_id, (i, do_tuong_tu) in sorted(mo_rong.items(), key=lambda item: -item[1][1]):
+        theo_vi_tri[i].append(tu_khoa_id)
+    so_dong = {i: _so_dong(ids) for i, ids in theo_vi_tri.items()}
+    if sum(so_dong.values()) > MAX_UNG_VIEN:
+        hiem_nhat = min(so_dong, key=so_dong.get)
+        rows = rows.filter(sach_id__in=_ung_vien(theo_vi_tri[hiem_nhat], so_dong[hiem_nhat]))
+
+    vi_tri = Case(*[When(tuKhoa_id=pk, then=Value(i)) for pk, (i, _) in mo_rong.items()])
+    do_tuong_tu = Case(*[When(tuKhoa_id=pk, then=Value(sim)) for pk, (_, sim) in mo_rong.items()],
+                       output_field=FloatField())
+    rows = rows.values('sach').annotate(
+        so_tu=Count(vi_tri, distinct=True),
+        diem=Sum(F('trongSo') * do_tuong_tu, output_field=FloatField()),
+    ).order_by('-so_tu', '-diem', 'sach')[:limit]
+    return [(row['sach'], row['so_tu'], row['diem']) for row in rows]
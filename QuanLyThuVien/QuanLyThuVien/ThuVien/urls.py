@@ -2,7 +2,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .admin import admin_site
-from . import views
+from . import views, views_async
 
 router = DefaultRouter()
 router.register('danhmuc', views.DanhMucViewSet, basename='danhmuc')
@@ -10,10 +10,12 @@ router.register('sach', views.SachViewSet, basename='sach')
 router.register('nguoidung', views.NguoiDungViewSet, basename='nguoidung')
 router.register('phieumuon', views.PhieuMuonViewSet, basename='phieumuon')
 router.register('chitietphieumuon', views.ChiTietPhieuMuonViewSet, basename='chitietphieumuon')
+router.register('dattruoc', views.DatTruocViewSet, basename='dattruoc')
 router.register('thich', views.ThichViewSet, basename='thich')
 router.register('binhluan', views.BinhLuanViewSet, basename='binhluan')
 router.register('chiase', views.ChiaSeViewSet, basename='chiase')
 router.register('payment', views.PaymentViewSet, basename='payment')
+router.register('metrics', views.MetricsViewSet, basename='metrics')
 
 
 urlpatterns = [
@@ -21,4 +23,12 @@ urlpatterns = [
     path('admin/', admin_site.urls),
     path('api/', include(router.urls)),
     path('payment/', views.payment_view, name='payment'),
+
+    # Bản async của các endpoint chờ I/O, dùng khi chạy dưới ASGI (xem views_async)
+    path('async/payment/', views_async.payment_view, name='async-payment'),
+    path('async/payment/zalopay/order/', views_async.zalopay_create_order, name='async-payment-zalopay-order'),
+    path('async/sach/borrow-return-late-statistics/', views_async.borrow_return_late_statistics,
+         name='async-sach-borrow-return-late-statistics'),
+    path('async/sach/dashboard/', views_async.dashboard, name='async-sach-dashboard'),
+    path('async/binhluan/feed/', views_async.binh_luan_feed, name='async-binhluan-feed'),
 ]
\ No newline at end of file
@@ -1,29 +1,61 @@
-import urllib
-from collections import Counter
-from distutils.command.config import config
 import json
-import random
-import time
-import hmac
-import hashlib
-import urllib.request
+from collections import Counter
+from decimal import Decimal, InvalidOperation
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from datetime import timezone, datetime
-from django.contrib.sites import requests
 from django.http import HttpRequest, JsonResponse, HttpResponse
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Count, Q, Sum
+from django.db.models import Count, Max, Q, Sum, Prefetch
+from django.urls import reverse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework import viewsets, status, permissions
+from django.views.decorators.http import require_POST
+from rest_framework import viewsets, status, permissions, mixins
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from . import thongke, timkiem, goiy, bangxephang, thanhtoan, giamsat
+from .cache import cached_response, cache_stats, conditional_response
 from .forms import PaymentForm
-from .models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, Thich, BinhLuan, ChiaSe
+from .paginators import CreatedAtCursorPagination
+from .models import DanhMuc, Sach, NguoiDung, PhieuMuon, ChiTietPhieuMuon, Thich, BinhLuan, ChiaSe, ThongKeLuuThong, \
+    DatTruoc, ThanhToan
 from .serializers import DanhMucSerializer, SachSerializer, NguoiDungSerializer, PhieuMuonSerializer, ThichSerializer, \
-    BinhLuanSerializer, ChiaSeSerializer, ChiTietPhieuMuonSerializer
+    BinhLuanSerializer, ChiaSeSerializer, ChiTietPhieuMuonSerializer, FeedNguoiDungSerializer, FeedSachSerializer, \
+    BinhLuanFeedSerializer, ThichFeedSerializer, ChiaSeFeedSerializer, DatTruocSerializer, \
+    ThanhToanSerializer
+
+class FeedMixin:
+    feed_serializer_class = None
+
+    # Feed rút gọn: các dòng tham chiếu người dùng/sách theo id, người dùng và sách
+    # được nạp một lần theo lô và trả về trong bảng phụ.
+    @action(detail=False, methods=['get'], url_path='feed')
+    def feed(self, request):
+        queryset = self.get_queryset()
+        sach_id = request.query_params.get('sach_id')
+        if sach_id:
+            queryset = queryset.filter(sach__id=sach_id)
+
+        page = self.paginate_queryset(queryset)
+        response = self.get_paginated_response(self.feed_serializer_class(page, many=True).data)
+
+        context = {'request': request}
+        users = NguoiDung.objects.only('id', 'username', 'first_name', 'last_name', 'avatar') \
+            .in_bulk({row.user_id for row in page})
+        books = Sach.objects.select_related('danhMuc') \
+            .only('id', 'tenSach', 'tenTacGia', 'anhSach', 'danhMuc__tenDanhMuc') \
+            .in_bulk({row.sach_id for row in page})
+        response.data['users'] = {
+            user['id']: user for user in FeedNguoiDungSerializer(users.values(), many=True, context=context).data
+        }
+        response.data['books'] = {
+            book['id']: book for book in FeedSachSerializer(books.values(), many=True, context=context).data
+        }
+        return response
+
 
 class NguoiDungViewSet(viewsets.ModelViewSet):
     queryset = NguoiDung.objects.all()
@@ -44,19 +76,26 @@ class NguoiDungViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'], url_path='thong-ke-do-tuoi')
     def thong_ke_do_tuoi(self, request):
+        # ?buckets=18,26,41 để gom theo khoảng tuổi; lọc thêm theo ?chucVu=...&is_active=true|false
+        buckets = request.query_params.get('buckets')
+        chuc_vu = request.query_params.get('chucVu')
+        is_active = request.query_params.get('is_active')
         try:
-            current_year = datetime.now().year
-            ages = []
-            users = NguoiDung.objects.all()
-            for user in users:
-                if user.nam_sinh is not None:
-                    age = current_year - user.nam_sinh
-                    ages.append(age)
-
-            age_count = Counter(ages)
-
-            age_statistics = [{"age": age, "count": count} for age, count in age_count.items()]
+            buckets = [int(edge) for edge in buckets.split(',') if edge.strip()] if buckets else None
+        except ValueError:
+            return Response({'error': 'buckets phải là các số nguyên, vd. 18,26,41.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if buckets and min(buckets) < 0:
+            return Response({'error': 'buckets không được âm.'}, status=status.HTTP_400_BAD_REQUEST)
+        if chuc_vu is not None and chuc_vu not in dict(NguoiDung.CHUC_VU_CHOICES):
+            return Response({'error': 'chucVu không hợp lệ.'}, status=status.HTTP_400_BAD_REQUEST)
+        if is_active is not None:
+            if is_active.lower() not in ('true', 'false'):
+                return Response({'error': 'is_active phải là true hoặc false.'}, status=status.HTTP_400_BAD_REQUEST)
+            is_active = is_active.lower() == 'true'
 
+        try:
+            age_statistics = thongke.age_histogram(buckets, chuc_vu, is_active)
             return Response(age_statistics, status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -68,7 +107,7 @@ class NguoiDungViewSet(viewsets.ModelViewSet):
     def get_borrowed_books(self, request, pk=None):
         user = self.get_object()
 
-        borrowed_books = ChiTietPhieuMuon.objects.filter(
+        borrowed_books = ChiTietPhieuMuon.objects.with_related().filter(
             phieuMuon__docGia=user,
             tinhTrang__in=['returned', 'borrowed', 'late']
         )
@@ -77,6 +116,19 @@ class NguoiDungViewSet(viewsets.ModelViewSet):
         serializer = ChiTietPhieuMuonSerializer(borrowed_books, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'], url_path='summary')
+    def summary(self, request, pk=None):
+        # Đọc thẳng các bộ đếm trên dòng NguoiDung, không duyệt lịch sử mượn như borrowed-books
+        user = get_object_or_404(self.get_queryset().only('id', 'username', *NguoiDung.BO_DEM), pk=pk)
+        return Response({
+            'id': user.id,
+            'username': user.username,
+            'soLuongMuon': user.soLuongMuon,
+            'soLuongTra': user.soLuongTra,
+            'soLuongQuaHan': user.soLuongQuaHan,
+            'tongSoLuotMuon': user.soLuongMuon + user.soLuongTra,
+        })
+
     @action(methods=['get', 'patch'], url_path='current-user', detail=False)
     def get_current_user(self, request):
         user = request.user
@@ -135,15 +187,69 @@ class NguoiDungViewSet(viewsets.ModelViewSet):
         except NguoiDung.DoesNotExist:
             return Response({"error": "NguoiDung not found."}, status=status.HTTP_404_NOT_FOUND)
 
+# Queryset dùng để tính ETag / Last-Modified cho từng endpoint (xem cache.conditional_response)
+def _danh_sach_hien_tai(view, request, *args, **kwargs):
+    return view.get_queryset()
+
+
+def _doi_tuong_hien_tai(view, request, *args, **kwargs):
+    return view.get_queryset().filter(pk=kwargs['pk'])
+
+
+def _sach_dang_hoat_dong(view, request, *args, **kwargs):
+    return view.get_queryset().filter(is_active=True)
+
+
+def _sach_theo_danh_muc(view, request, pk=None, **kwargs):
+    return Sach.objects.filter(danhMuc=pk)
+
+
+# SachSerializer trả về tenDanhMuc nên sửa danh mục cũng phải đổi ETag của sách
+SACH_TIMESTAMPS = ('updated_at', 'danhMuc__updated_at')
+
+
+# Danh sách sách lấy từ cache được đọc lại các cột kho (Sach.COT_KHO) bằng một truy vấn theo khóa chính,
+# nên mượn / trả không làm mất cache mà số lượng (và updated_at dùng cho ETag) vẫn đúng
+def _lam_moi_kho_sach(data):
+    rows = data['results'] if isinstance(data, dict) else data
+    live = {moi['id']: moi for moi in
+            Sach.objects.filter(pk__in=[row['id'] for row in rows]).values('id', *Sach.COT_KHO)}
+    fields = SachSerializer().fields
+    for row in rows:
+        moi = live.get(row['id'])
+        if moi is not None:
+            row.update({field: fields[field].to_representation(moi[field]) for field in Sach.COT_KHO})
+    return data
+
+
+def _theo_kho_danh_muc(request):
+    # Bản tóm tắt (mode=summary) có tổng số bản còn / đang mượn của mỗi danh mục
+    return request.query_params.get('mode') == 'summary'
+
+
+# Đọc top-N từ bảng xếp hạng trong bộ nhớ rồi nạp các cột cần hiển thị bằng một truy vấn theo khóa chính
+def _bang_xep_hang(metric, n, window='all', fields=('tenSach',)):
+    rows = bangxephang.top(metric, n, window)
+    books = Sach.objects.only(*fields).in_bulk([sach_id for sach_id, _ in rows])
+    return [(books[sach_id], score) for sach_id, score in rows if sach_id in books]
+
+
 class DanhMucViewSet(viewsets.ModelViewSet):
     queryset = DanhMuc.objects.all()
     serializer_class = DanhMucSerializer
     permission_classes = [IsAuthenticated]
 
+    @conditional_response(_danh_sach_hien_tai)
+    @cached_response('danhmuc-list')
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @conditional_response(_doi_tuong_hien_tai)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     @action(methods=['post'], detail=False, url_path='create-danhmuc')
     def create_danhmuc(self, request):
@@ -174,8 +280,19 @@ class SachViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     @action(detail=False, methods=['get'], url_path='thong-ke-theo-danh-muc')
+    @cached_response('thong-ke-theo-danh-muc', theo_kho=_theo_kho_danh_muc)
     def statistic_by_category(self, request):
-        categories = DanhMuc.objects.prefetch_related('books').annotate(book_count=Count('books'))
+        # ?mode=summary: chỉ số liệu tổng hợp theo danh mục, danh sách sách lấy riêng qua by-danhmuc (có phân trang)
+        if request.query_params.get('mode') == 'summary':
+            result = [
+                {**row, 'books_url': request.build_absolute_uri(reverse('sach-by-danhmuc', args=[row['id']]))}
+                for row in thongke.category_summary()
+            ]
+            return Response(result, status=status.HTTP_200_OK)
+
+        categories = DanhMuc.objects.prefetch_related(
+            Prefetch('books', queryset=Sach.objects.only('id', 'tenSach', 'danhMuc'))
+        ).annotate(book_count=Count('books'))
 
         result = []
         for category in categories:
@@ -187,6 +304,49 @@ class SachViewSet(viewsets.ModelViewSet):
             result.append(category_data)
 
         return Response(result, status=status.HTTP_200_OK)
+    @action(detail=False, methods=['get'], url_path='search')
+    def search(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'error': 'Thiếu tham số q.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+        except ValueError:
+            return Response({'error': 'limit phải là số nguyên.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        ket_qua = timkiem.tim_kiem(query, limit)
+        books = Sach.objects.select_related('danhMuc').in_bulk([sach_id for sach_id, _, _ in ket_qua])
+        results = []
+        for sach_id, so_tu, diem in ket_qua:
+            if sach_id not in books:
+                continue
+            data = SachSerializer(books[sach_id], context={'request': request}).data
+            data['matched_terms'] = so_tu
+            data['score'] = round(diem, 3)
+            results.append(data)
+        return Response({'query': query, 'results': results}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='autocomplete')
+    def autocomplete(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), goiy.MAX_K)
+        except ValueError:
+            return Response({'error': 'limit phải là số nguyên.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'query': query, **goiy.autocomplete(query, limit)}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['get'], url_path='dashboard')
+    def dashboard(self, request):
+        try:
+            data = thongke.dashboard(timeout=getattr(settings, 'THUVIEN_DASHBOARD_TTL', 30))
+            return Response(data, status=status.HTTP_200_OK)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'], url_path='cache-stats')
+    def cache_stats(self, request):
+        return Response(cache_stats(), status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], url_path='book-count', permission_classes=[permissions.IsAuthenticated])
     def book_count(self, request):
         total_books = Sach.objects.aggregate(total_quantity=Sum('soLuong'))['total_quantity'] or 0
@@ -202,18 +362,28 @@ class SachViewSet(viewsets.ModelViewSet):
         serializer.save()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @conditional_response(_sach_dang_hoat_dong, SACH_TIMESTAMPS)
+    @cached_response('sach-list', lam_moi=_lam_moi_kho_sach)
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset().filter(is_active=True)
-        serializer = SachSerializer(queryset, many=True)
-        return Response(serializer.data)
+        page = self.paginate_queryset(queryset)
+        serializer = SachSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @conditional_response(_doi_tuong_hien_tai, SACH_TIMESTAMPS)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     @action(detail=False, methods=['get'], url_path='recent-books')
+    @cached_response('recent-books', lam_moi=_lam_moi_kho_sach)
     def recent_books(self, request):
         queryset = Sach.objects.order_by('-id')[:5]
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['get'], url_path='by-danhmuc')
+    @conditional_response(_sach_theo_danh_muc, SACH_TIMESTAMPS)
+    @cached_response('by-danhmuc', lam_moi=_lam_moi_kho_sach)
     def by_danhmuc(self, request, pk=None):
         try:
             if pk is None:
@@ -222,8 +392,9 @@ class SachViewSet(viewsets.ModelViewSet):
                 category = DanhMuc.objects.get(pk=pk)
                 books = Sach.objects.filter(danhMuc=category)
 
-            serializer = SachSerializer(books, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            page = self.paginate_queryset(books)
+            serializer = SachSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
         except DanhMuc.DoesNotExist:
             return Response({"error": "Danh mục không tìm thấy."}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
@@ -296,22 +467,34 @@ class SachViewSet(viewsets.ModelViewSet):
                                     status=status.HTTP_400_BAD_REQUEST)
                 if not (1900 <= year <= timezone.now().year):
                     return Response({'error': 'Invalid year.'}, status=status.HTTP_400_BAD_REQUEST)
-                start_date = timezone.datetime(year, month, 1)
-                end_date = timezone.datetime(year, month + 1, 1) if month < 12 else timezone.datetime(year + 1, 1, 1)
-                most_borrowed_books = ChiTietPhieuMuon.objects.filter(
-                    phieuMuon__ngayMuon__gte=start_date,
-                    phieuMuon__ngayMuon__lt=end_date
-                ).values('phieuMuon__sach__tenSach').annotate(
-                    total_borrow_count=Count('phieuMuon__sach')
-                ).order_by('-total_borrow_count')
+                # Mặc định trả mọi sách của tháng (đọc bảng tổng hợp); ?limit= lấy top-N (tối đa CAPACITY) từ
+                # bảng xếp hạng trong bộ nhớ của tiến trình, có thể trễ tối đa TTL so với worker khác
+                limit = request.query_params.get('limit', '').strip('/')
+                if limit:
+                    if not limit.isdigit() or int(limit) < 1:
+                        return Response({'error': 'Invalid limit. Must be a positive integer.'},
+                                        status=status.HTTP_400_BAD_REQUEST)
+                    limit = min(int(limit), bangxephang.CAPACITY)
+                    most_borrowed_books = [
+                        (book.tenSach, total)
+                        for book, total in _bang_xep_hang('issued', limit, f'{year:04d}-{month:02d}')
+                    ]
+                else:
+                    start_date = timezone.datetime(year, month, 1)
+                    end_date = timezone.datetime(year, month + 1, 1) if month < 12 else \
+                        timezone.datetime(year + 1, 1, 1)
+                    most_borrowed_books = [
+                        (book['sach__tenSach'], book['total'])
+                        for book in thongke.top_books('issued', start_date, end_date)
+                    ]
 
                 if most_borrowed_books:
                     result = [
                         {
-                            'tenSach': book['phieuMuon__sach__tenSach'],
-                            'total_borrow_count': book['total_borrow_count']
+                            'tenSach': ten_sach,
+                            'total_borrow_count': total
                         }
-                        for book in most_borrowed_books
+                        for ten_sach, total in most_borrowed_books
                     ]
                     return Response(result, status=status.HTTP_200_OK)
                 else:
@@ -322,6 +505,8 @@ class SachViewSet(viewsets.ModelViewSet):
                 return Response({'error': 'Month and year parameters are required.'},
                                 status=status.HTTP_400_BAD_REQUEST)
 
+        except ValueError:
+            return Response({'error': 'Month and year must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': 'An unexpected error occurred. Please try again later.'},
                             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -342,12 +527,11 @@ class SachViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'], url_path='like-count')
     def like_count(self, request, pk=None):
         try:
-            sach = Sach.objects.get(pk=pk)
-            like_count = Thich.objects.filter(sach=sach).count()
+            sach = Sach.objects.only('tenSach', 'soLuotThich').get(pk=pk)
             return Response(
                 {
                     'tenSach': sach.tenSach,
-                    'like_count': like_count
+                    'like_count': sach.soLuotThich
                 },
                 status=status.HTTP_200_OK
             )
@@ -361,7 +545,7 @@ class SachViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], url_path='most-liked')
     def most_liked_books(self, request):
         try:
-            most_liked_books = Sach.objects.annotate(like_count=Count('thich')).order_by('-like_count')[:5]
+            most_liked_books = _bang_xep_hang('liked', 5, fields=('tenSach', 'tenTacGia', 'anhSach'))
 
             result = [
                 {
@@ -369,9 +553,9 @@ class SachViewSet(viewsets.ModelViewSet):
                     'tenSach': book.tenSach,
                     'tenTacGia': book.tenTacGia,
                     'anhSach_url': book.anhSach.url if book.anhSach else None,
-                    'like_count': book.like_count
+                    'like_count': like_count
                 }
-                for book in most_liked_books
+                for book, like_count in most_liked_books
             ]
 
             return Response(result, status=status.HTTP_200_OK)
@@ -383,16 +567,12 @@ class SachViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], url_path='most-commented')
     def most_commented_books(self, request):
         try:
-            most_commented_books = Sach.objects.annotate(
-                comment_count=Count('binhluan__content')
-            )[:5]
-
             result = [
                 {
                     'tenSach': book.tenSach,
-                    'comment_count': book.comment_count
+                    'comment_count': comment_count
                 }
-                for book in most_commented_books
+                for book, comment_count in _bang_xep_hang('commented', 5)
             ]
 
             if result:
@@ -406,9 +586,9 @@ class SachViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], url_path='total-interactions')
     def total_interactions(self, request):
         try:
-            total_likes = Sach.objects.aggregate(total_likes=Count('thich'))['total_likes'] or 0
-
-            total_comments = Sach.objects.aggregate(total_comments=Count('binhluan'))['total_comments'] or 0
+            totals = Sach.objects.aggregate(total_likes=Sum('soLuotThich'), total_comments=Sum('soBinhLuan'))
+            total_likes = totals['total_likes'] or 0
+            total_comments = totals['total_comments'] or 0
 
             combined_total = total_likes + total_comments
 
@@ -427,27 +607,29 @@ class SachViewSet(viewsets.ModelViewSet):
             with transaction.atomic():
                 data = request.data.get('books')
                 user = request.user
-                borrowed_books = []
 
+                # Khóa và nạp mọi sách cần mượn bằng một truy vấn, kiểm tra số lượng còn lại trong bộ nhớ;
+                # bản đang giữ cho lượt đặt trước 'ready' của chính người mượn cũng được tính là còn
+                books = Sach.objects.select_related('danhMuc').select_for_update(of=('self',)).in_bulk(data)
+                giu_cho = Counter(DatTruoc.objects.filter(docGia=user, sach__in=books, trangThai='ready')
+                                  .values_list('sach_id', flat=True))
+                danh_sach_sach = []
+                da_chon = Counter()
                 for book_id in data:
-                    sach = Sach.objects.get(id=book_id)
-                    if sach.soLuong > 0:
-                        phieu_muon, created = PhieuMuon.objects.get_or_create(
-                            docGia=user,
-                            ngayTraDuKien=timezone.now() + timezone.timedelta(days=7)
-                        )
-
-                        chi_tiet_phieu_muon = ChiTietPhieuMuon.objects.create(
-                            phieuMuon=phieu_muon,
-                            sach=sach,
-                            tinhTrang='borrowed'
-                        )
-                        borrowed_books.append(SachSerializer(sach).data)
+                    sach = books.get(Sach._meta.pk.to_python(book_id))
+                    if sach is None:
+                        raise Sach.DoesNotExist('Sach matching query does not exist.')
+                    if sach.soLuong + giu_cho[sach.pk] - da_chon[sach.pk] > 0:
+                        da_chon[sach.pk] += 1
+                        danh_sach_sach.append(sach)
                     else:
                         return Response({
                             'error': f'{sach.tenSach} is not available for borrowing.'
                         }, status=status.HTTP_400_BAD_REQUEST)
 
+                ChiTietPhieuMuon.borrow_many(user, danh_sach_sach)
+                borrowed_books = SachSerializer(danh_sach_sach, many=True).data
+
                 return Response({
                     'borrowed_books': borrowed_books,
                     'message': f'{len(borrowed_books)} books borrowed successfully.'
@@ -462,14 +644,19 @@ class SachViewSet(viewsets.ModelViewSet):
             with transaction.atomic():
                 data = request.data.get('chi_tiet_ids')
                 user = request.user
-                returned_books = []
 
+                chi_tiet_map = ChiTietPhieuMuon.objects.with_related() \
+                    .select_for_update(of=('self',)).in_bulk(data)
+                can_tra = {}
                 for chi_tiet_id in data:
-                    chi_tiet = ChiTietPhieuMuon.objects.get(id=chi_tiet_id)
-                    if chi_tiet.phieuMuon.docGia == user and chi_tiet.tinhTrang == 'borrowed':
-                        chi_tiet.ngayTraThucTe = timezone.now()
-                        chi_tiet.save()
-                        returned_books.append(SachSerializer(chi_tiet.sach).data)
+                    chi_tiet = chi_tiet_map.get(ChiTietPhieuMuon._meta.pk.to_python(chi_tiet_id))
+                    if chi_tiet is None:
+                        raise ChiTietPhieuMuon.DoesNotExist('ChiTietPhieuMuon matching query does not exist.')
+                    if chi_tiet.phieuMuon.docGia_id == user.pk and chi_tiet.tinhTrang == 'borrowed':
+                        can_tra[chi_tiet.pk] = chi_tiet
+
+                ChiTietPhieuMuon.return_many(list(can_tra.values()))
+                returned_books = [SachSerializer(chi_tiet.phieuMuon.sach).data for chi_tiet in can_tra.values()]
 
                 return Response({
                     'returned_books': returned_books,
@@ -482,107 +669,63 @@ class SachViewSet(viewsets.ModelViewSet):
     def high_borrow_count(self, request):
         threshold = int(request.query_params.get('threshold', 20))
         high_borrow_books = Sach.objects.filter(totalBorrowCount__gte=threshold)
-        return Response(SachSerializer(high_borrow_books, many=True).data)
+        page = self.paginate_queryset(high_borrow_books)
+        return self.get_paginated_response(SachSerializer(page, many=True).data)
 
     @action(detail=False, methods=['get'], url_path='most-returned-books')
     def most_returned_books(self, request):
-        most_returned_books = Sach.objects.filter(
-            phieu_muon__chi_tiet_phieu_muon__tinhTrang='returned'
-        ).annotate(return_count=Count('phieu_muon__chi_tiet_phieu_muon',
-                                      filter=Q(phieu_muon__chi_tiet_phieu_muon__tinhTrang='returned'))
-                   ).order_by('-return_count')[:10]
-
         result = [
             {
                 'tenSach': book.tenSach,
-                'return_count': book.return_count
-            } for book in most_returned_books
+                'return_count': total
+            } for book, total in _bang_xep_hang('returned', 10)
         ]
 
         return Response(result, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'], url_path='most-borrowed-books')
     def most_borrowed_books(self, request):
-        most_borrowed_books = Sach.objects.filter(
-            phieu_muon__chi_tiet_phieu_muon__tinhTrang='borrowed'
-        ).annotate(borrow_count=Count('phieu_muon__chi_tiet_phieu_muon',
-                                      filter=Q(phieu_muon__chi_tiet_phieu_muon__tinhTrang='borrowed'))
-                   ).order_by('-borrow_count')[:10]
-
         result = [
             {
                 'tenSach': book.tenSach,
-                'borrow_count': book.borrow_count
-            } for book in most_borrowed_books
+                'borrow_count': total
+            } for book, total in _bang_xep_hang('borrowed', 10)
         ]
 
         return Response(result, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'], url_path='most-late-books')
     def most_late_books(self, request):
-        most_late_books = Sach.objects.filter(
-            phieu_muon__chi_tiet_phieu_muon__tinhTrang='late'
-        ).annotate(late_count=Count('phieu_muon__chi_tiet_phieu_muon',
-                                    filter=Q(phieu_muon__chi_tiet_phieu_muon__tinhTrang='late'))
-                   ).order_by('-late_count')[:10]
-
         result = [
             {
                 'tenSach': book.tenSach,
-                'late_count': book.late_count
-            } for book in most_late_books
+                'late_count': total
+            } for book, total in _bang_xep_hang('late', 10)
         ]
 
         return Response(result, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=['get'], url_path='borrow-return-late-statistics')
     def borrow_return_late_statistics(self, request):
-        try:
-            current_time = timezone.now()
-            current_year = current_time.year
-            current_month = current_time.month
+        granularity = request.query_params.get('granularity', 'month').strip('/')
+        window = request.query_params.get('window', '12').strip('/')
 
+        if granularity not in thongke.GRANULARITIES:
+            return Response({'error': 'Invalid granularity. Must be one of: day, week, month.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not window.isdigit() or not (1 <= int(window) <= thongke.MAX_WINDOW):
+            return Response({'error': f'Invalid window. Must be between 1 and {thongke.MAX_WINDOW}.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            statistics = thongke.circulation_statistics(granularity, int(window))
             result = {
-                'monthly_statistics': []
+                'granularity': granularity,
+                'window': int(window),
+                'statistics': statistics,
             }
-
-            for i in range(12):
-                month = (current_month - i) % 12
-                year = current_year - (current_month - i <= 0)
-                if month == 0:
-                    month = 12
-
-                start_date = timezone.datetime(year, month, 1)
-                end_date = timezone.datetime(year, month + 1, 1) if month < 12 else timezone.datetime(year + 1, 1, 1)
-
-                borrowed_books = ChiTietPhieuMuon.objects.filter(
-                    tinhTrang='borrowed',
-                    phieuMuon__ngayMuon__gte=start_date,
-                    phieuMuon__ngayMuon__lt=end_date
-                ).count()
-
-                returned_books = ChiTietPhieuMuon.objects.filter(
-                    tinhTrang='returned',
-                    ngayTraThucTe__gte=start_date,
-                    ngayTraThucTe__lt=end_date
-                ).count()
-
-                late_books = ChiTietPhieuMuon.objects.filter(
-                    tinhTrang='late',
-                    ngayTraThucTe__gte=start_date,
-                    ngayTraThucTe__lt=end_date
-                ).count()
-
-                if borrowed_books > 0 or returned_books > 0 or late_books > 0:
-                    result['monthly_statistics'].append({
-                        'year': year,
-                        'month': month,
-                        'borrowed': borrowed_books,
-                        'returned': returned_books,
-                        'late': late_books
-                    })
-
-            result['monthly_statistics'].sort(key=lambda x: (x['year'], x['month']))
+            if granularity == 'month':
+                result['monthly_statistics'] = statistics
 
             return Response(result, status=status.HTTP_200_OK)
 
@@ -608,27 +751,28 @@ class SachViewSet(viewsets.ModelViewSet):
                     int(year) + 1, 1, 1)
 
                 if tinhTrang == 'borrowed':
-                    filtered_books = ChiTietPhieuMuon.objects.filter(
-                        tinhTrang='borrowed',
-                        ngayTraThucTe__isnull=True
-                    ).values('phieuMuon__sach__tenSach', 'tinhTrang', 'ngayTraThucTe')  # Change to phieuMuon__sach
+                    filtered_books = ThongKeLuuThong.objects.filter(tinhTrang='borrowed')
                 else:
-                    filtered_books = ChiTietPhieuMuon.objects.filter(
-                        Q(ngayTraThucTe__gte=start_date, ngayTraThucTe__lt=end_date),
-                        tinhTrang=tinhTrang
-                    ).values('phieuMuon__sach__tenSach', 'tinhTrang', 'phieuMuon__ngayMuon',
-                             'ngayTraThucTe')  # Change to phieuMuon__sach
-
-                if filtered_books:
-                    result = [
-                        {
-                            'tenSach': book['phieuMuon__sach__tenSach'],  # Change to phieuMuon__sach
-                            'tinhTrang': book['tinhTrang'],
-                            'ngayTraThucTe': book['ngayTraThucTe'],
-                        }
-                        for book in filtered_books
-                    ]
-                    return Response(result, status=status.HTTP_200_OK)
+                    filtered_books = ThongKeLuuThong.objects.filter(
+                        tinhTrang=tinhTrang,
+                        ngay__gte=start_date,
+                        ngay__lt=end_date
+                    )
+                # Một dòng mỗi sách (không nhân bản theo từng lượt mượn): loan_count là tổng số lượt,
+                # ngayTraThucTe là ngày gần nhất trong tháng
+                filtered_books = filtered_books.filter(soLuong__gt=0).values('sach', 'sach__tenSach').annotate(
+                    loan_count=Sum('soLuong'), ngay_cuoi=Max('ngay')).order_by('-loan_count', 'sach')
+
+                result = [
+                    {
+                        'tenSach': book['sach__tenSach'],
+                        'tinhTrang': tinhTrang,
+                        'ngayTraThucTe': None if tinhTrang == 'borrowed' else book['ngay_cuoi'],
+                        'loan_count': book['loan_count'],
+                    }
+                    for book in filtered_books
+                ]
+                return Response(result, status=status.HTTP_200_OK)
 
             else:
                 return Response({'error': 'Month and year parameters are required.'},
@@ -646,28 +790,29 @@ class PhieuMuonViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         user = self.request.user
         if user.is_superuser:
-            return PhieuMuon.objects.all()
+            return PhieuMuon.objects.with_related()
         elif user.is_staff:
-            return PhieuMuon.objects.filter(docGia=user)
+            return PhieuMuon.objects.with_related().filter(docGia=user)
         return PhieuMuon.objects.none()
 
     @action(methods=['post'], detail=False, url_path='create-phieumuon')
     def create_phieumuon(self, request):
         serializer = PhieuMuonSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        phieu_muon = serializer.save()
 
         try:
-            # Create the associated ChiTietPhieuMuon with the status fixed as 'borrowed'
-            chi_tiet = ChiTietPhieuMuon.objects.create(
-                phieuMuon=phieu_muon,
-                tinhTrang='borrowed',  # Set the status to 'borrowed'
-                # Add other default values if required
-                # Example:
-                # ngayTraThucTe=None,
-                # ghiChu='',
-                # tienPhat=0,
-            )
+            with transaction.atomic():
+                phieu_muon = serializer.save()
+                # Create the associated ChiTietPhieuMuon with the status fixed as 'borrowed'
+                chi_tiet = ChiTietPhieuMuon.objects.create(
+                    phieuMuon=phieu_muon,
+                    tinhTrang='borrowed',  # Set the status to 'borrowed'
+                    # Add other default values if required
+                    # Example:
+                    # ngayTraThucTe=None,
+                    # ghiChu='',
+                    # tienPhat=0,
+                )
         except Exception as e:
             # Log the error for troubleshooting
             print(f"Error creating ChiTietPhieuMuon: {e}")
@@ -700,14 +845,15 @@ class PhieuMuonViewSet(viewsets.ModelViewSet):
 
     @action(methods=['post'], detail=True, url_path='borrow')
     def borrow_book(self, request, pk=None):
-        sach = Sach.objects.get(pk=pk)
-        if sach.soLuong > sach.soSachDangMuon:
-            sach.soSachDangMuon += 1
-            sach.save()
-            phieu_muon = PhieuMuon.objects.create(docGia=request.user, ngayTraDuKien=request.data['ngayTraDuKien'], sach=sach)
-            ChiTietPhieuMuon.objects.create(phieuMuon=phieu_muon)
-            return Response({'detail': 'Đã mượn sách thành công.'}, status=status.HTTP_201_CREATED)
-        return Response({'detail': 'Sách đã hết.'}, status=status.HTTP_400_BAD_REQUEST)
+        sach = get_object_or_404(Sach, pk=pk)
+        try:
+            # Bộ đếm của sách được giảm có điều kiện khi tạo ChiTietPhieuMuon
+            with transaction.atomic():
+                phieu_muon = PhieuMuon.objects.create(docGia=request.user, ngayTraDuKien=request.data['ngayTraDuKien'], sach=sach)
+                ChiTietPhieuMuon.objects.create(phieuMuon=phieu_muon)
+        except ValidationError:
+            return Response({'detail': 'Sách đã hết.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'detail': 'Đã mượn sách thành công.'}, status=status.HTTP_201_CREATED)
 
 
 class ChiTietPhieuMuonViewSet(viewsets.ModelViewSet):
@@ -715,12 +861,14 @@ class ChiTietPhieuMuonViewSet(viewsets.ModelViewSet):
     serializer_class = ChiTietPhieuMuonSerializer
     permission_classes = [IsAuthenticated]
 
+    # Cùng quy tắc với PhieuMuonViewSet: nhân viên thấy mọi phiếu, độc giả chỉ thấy phiếu của mình. Không lọc
+    # theo sách còn hoạt động: phiếu của sách đã ngừng vẫn phải xem và trả được.
     def get_queryset(self):
         user = self.request.user
         if user.is_superuser:
-            return ChiTietPhieuMuon.objects.filter(sach__is_active=True)
+            return ChiTietPhieuMuon.objects.with_related()
         elif user.is_staff:
-            return ChiTietPhieuMuon.objects.filter(docGia=user, sach__is_active=True)
+            return ChiTietPhieuMuon.objects.with_related().filter(phieuMuon__docGia=user)
         return ChiTietPhieuMuon.objects.none()
 
     @action(methods=['post'], detail=False, url_path='create-ctpm')
@@ -764,183 +912,270 @@ class ChiTietPhieuMuonViewSet(viewsets.ModelViewSet):
         except ChiTietPhieuMuon.DoesNotExist:
             return Response({"error": "ChiTietPhieuMuon not found."}, status=status.HTTP_404_NOT_FOUND)
 
-class ThichViewSet(viewsets.ModelViewSet):
+    @action(methods=['post'], detail=True, url_path='return-book')
+    def return_book(self, request, pk=None):
+        chi_tiet_phieu_muon = self.get_object()
+        chi_tiet_phieu_muon.ngayTraThucTe = timezone.localdate()
+        chi_tiet_phieu_muon.save()
+        return Response({'message': 'Đã trả sách thành công.'}, status=status.HTTP_200_OK)
+
+class DatTruocViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    # Trạng thái chỉ đổi qua DatTruoc (đặt, hủy, trả sách, mượn, hết hạn) nên không mở update / destroy
+    serializer_class = DatTruocSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        user = self.request.user
+        queryset = DatTruoc.objects.with_related()
+        if user.is_superuser:
+            return queryset
+        return queryset.filter(docGia=user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            dat_truoc = DatTruoc.dat(request.user, serializer.validated_data['sach'].pk)
+        except ValidationError as e:
+            return Response({'error': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(self.get_queryset().get(pk=dat_truoc.pk)).data,
+                        status=status.HTTP_201_CREATED)
+
+    @action(methods=['post'], detail=True, url_path='cancel')
+    def cancel(self, request, pk=None):
+        dat_truoc = self.get_object()
+        if not dat_truoc.huy():
+            return Response({'error': 'Lượt đặt trước không còn hiệu lực.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'message': 'Đã hủy đặt trước.'}, status=status.HTTP_200_OK)
+
+
+class ThichViewSet(FeedMixin, viewsets.ModelViewSet):
     queryset = Thich.objects.all()
     serializer_class = ThichSerializer
+    feed_serializer_class = ThichFeedSerializer
     permission_classes = [IsAuthenticated]
 
     @action(methods=['post'], detail=True, url_path='toggle-like')
     def toggle_like(self, request, pk=None):
         user = request.user
-        sach = get_object_or_404(Sach, pk=pk)
         thich_status = 'like'
 
-        try:
-            # Kiểm tra xem người dùng đã thích sách này chưa
-            thich = Thich.objects.get(user=user, sach=sach)
-            thich.delete()  # Nếu đã thích, bỏ thích
-            return Response({'detail': 'Đã bỏ thích.'}, status=status.HTTP_204_NO_CONTENT)
-        except Thich.DoesNotExist:
-            # Nếu chưa thích, thêm tương tác "like"
+        # Khóa dòng sách để thích / bỏ thích và bộ đếm soLuotThich đổi cùng một transaction
+        with transaction.atomic():
+            sach = get_object_or_404(Sach.objects.select_for_update().only('id'), pk=pk)
+            # Nếu đã thích thì bỏ thích, chưa thì thêm tương tác "like"
+            if Thich.objects.filter(user=user, sach=sach).delete()[0]:
+                return Response({'detail': 'Đã bỏ thích.'}, status=status.HTTP_204_NO_CONTENT)
             Thich.objects.create(user=user, sach=sach, thich=thich_status)
             return Response({'detail': 'Đã thích.'}, status=status.HTTP_201_CREATED)
 
-class BinhLuanViewSet(viewsets.ModelViewSet):
+class BinhLuanViewSet(FeedMixin, viewsets.ModelViewSet):
     queryset = BinhLuan.objects.all()
     serializer_class = BinhLuanSerializer
+    feed_serializer_class = BinhLuanFeedSerializer
+    pagination_class = CreatedAtCursorPagination
     permission_classes = [AllowAny]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        sach_id = self.request.query_params.get('sach_id')  # Get sach_id from query params
+        if sach_id and self.action == 'list':
+            queryset = queryset.filter(sach__id=sach_id)  # Filter comments by book
+        return queryset
+
+    @conditional_response(_danh_sach_hien_tai)
     def list(self, request, *args, **kwargs):
-        sach_id = request.query_params.get('sach_id')  # Get sach_id from query params
-        if sach_id:
-            queryset = BinhLuan.objects.filter(sach__id=sach_id)  # Filter comments by book
-        else:
-            queryset = BinhLuan.objects.all()  # Default to all comments if no sach_id is provided
+        page = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    @conditional_response(_doi_tuong_hien_tai)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     # User creates a comment for a specific book
     @action(methods=['post'], detail=True, url_path='create-comment', permission_classes=[IsAuthenticated])
     def create_comment(self, request, pk=None):
-        try:
-            sach = Sach.objects.get(pk=pk)
-        except Sach.DoesNotExist:
-            return Response({"error": "Book not found."}, status=status.HTTP_404_NOT_FOUND)
-
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(user=request.user, sach=sach)
+
+        with transaction.atomic():
+            try:
+                sach = Sach.objects.select_for_update().get(pk=pk)
+            except Sach.DoesNotExist:
+                return Response({"error": "Book not found."}, status=status.HTTP_404_NOT_FOUND)
+            serializer.save(user=request.user, sach=sach)
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class ChiaSeViewSet(viewsets.ModelViewSet):
+class ChiaSeViewSet(FeedMixin, viewsets.ModelViewSet):
     queryset = ChiaSe.objects.all()
     serializer_class = ChiaSeSerializer
+    feed_serializer_class = ChiaSeFeedSerializer
     permission_classes = [IsAuthenticated]
 
     @action(methods=['post'], detail=True, url_path='share')
     def share(self, request, pk=None):
-        sach = Sach.objects.get(pk=pk)
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save(user=request.user, sach=sach)
+        with transaction.atomic():
+            sach = get_object_or_404(Sach.objects.select_for_update(), pk=pk)
+            serializer.save(user=request.user, sach=sach)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class ChiTietPhieuMuonViewSet(viewsets.ModelViewSet):
-    queryset = ChiTietPhieuMuon.objects.all()
-    serializer_class = ChiTietPhieuMuonSerializer
+class MetricsViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
 
-    @action(methods=['post'], detail=True, url_path='return-book')
-    def return_book(self, request, pk=None):
-        chi_tiet_phieu_muon = self.get_object()
-        chi_tiet_phieu_muon.ngayTraThucTe = timezone.now()
-        chi_tiet_phieu_muon.save()
-        return Response({'message': 'Đã trả sách thành công.'}, status=status.HTTP_200_OK)
+    # Số truy vấn / thời gian SQL / thời gian render JSON / kích thước phản hồi theo endpoint (p50, p95, p99) của
+    # tiến trình đang phục vụ; ?sort=<chỉ số> để xếp theo tổng chỉ số khác (mặc định sql_ms)
+    def list(self, request):
+        if not request.user.is_superuser:
+            return Response({'error': 'Chỉ nhân viên được xem số liệu.'}, status=status.HTTP_403_FORBIDDEN)
+        sort = request.query_params.get('sort', 'sql_ms')
+        if sort not in giamsat.CHI_SO:
+            return Response({'error': f"sort phải là một trong: {', '.join(giamsat.CHI_SO)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'window': giamsat.SAMPLES,
+            'n_plus_one_threshold': giamsat.nguong_n_cong_1(),
+            'endpoints': giamsat.tong_hop(sort),
+        }, status=status.HTTP_200_OK)
+
+    @action(methods=['post'], detail=False, url_path='reset')
+    def reset(self, request):
+        if not request.user.is_superuser:
+            return Response({'error': 'Chỉ nhân viên được xem số liệu.'}, status=status.HTTP_403_FORBIDDEN)
+        giamsat.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# Người gọi ẩn danh không được tự đặt Idempotency-Key: mọi người ẩn danh dùng chung một phạm vi nên đoán
+# được khóa là nhận lại đơn (và payUrl) của người khác
+def _khoa_an_danh(request, user):
+    return user is None and bool(request.headers.get('Idempotency-Key'))
+
+
+def _mo_don_thanh_toan(request, user, cong, so_tien, chi_tiet=None, khoa=None):
+    # Ghi đơn vào sổ trước khi gọi cổng (ngoài transaction, không giữ khóa trong lúc chờ mạng). Gửi lại
+    # cùng Idempotency-Key thì trả về phản hồi đã lưu; lần trước lỗi mạng thì gửi lại đúng mã đơn cũ.
+    # Khóa lưu trong sổ gắn với người trả, cổng và phiếu phạt nên cùng một khóa không trỏ sang đơn khác.
+    ma_don_hang = thanhtoan.ma_don_hang(cong)
+    khoa = (user and request.headers.get('Idempotency-Key')) or khoa or ma_don_hang
+    pham_vi = f"{user.pk if user else 'anon'}:{cong}:{chi_tiet.pk if chi_tiet else '-'}"
+    don, _ = ThanhToan.tao(cong, so_tien, f'{pham_vi}:{khoa}'[:150], ma_don_hang, doc_gia=user, chi_tiet=chi_tiet)
+    return don
+
+
+def _ghi_phan_hoi(don, cong, result):
+    # Các cột cần UPDATE (chỉ khi đơn còn pending) sau khi cổng trả lời
+    don.phanHoi = result
+    don.payUrl = thanhtoan.pay_url(cong, result) or ''
+    if not thanhtoan.thanh_cong(cong, result):
+        don.trangThai = 'failed'
+    return {'phanHoi': don.phanHoi, 'payUrl': don.payUrl, 'trangThai': don.trangThai, 'updated_at': timezone.now()}
+
+
+def _tao_don_thanh_toan(request, cong, so_tien, chi_tiet=None, khoa=None, **kwargs):
+    user = request.user if request.user.is_authenticated else None
+    don = _mo_don_thanh_toan(request, user, cong, so_tien, chi_tiet, khoa)
+    if don.phanHoi is not None:
+        return don, don.phanHoi
+
+    result = thanhtoan.tao_don(cong, int(don.soTien), don.maDonHang, **kwargs)
+    ThanhToan.objects.filter(pk=don.pk, trangThai='pending').update(**_ghi_phan_hoi(don, cong, result))
+    return don, result
+
+
+def _so_tien(value):
+    try:
+        so_tien = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return so_tien if so_tien > 0 and so_tien == so_tien.to_integral_value() else None
 
 
 @csrf_exempt
+@require_POST
 def payment_view(request: HttpRequest):
-    partnerCode = "MOMO"
-    accessKey = "F8BBA842ECF85"
-    secretKey = "K951B6PE1waDMi640xX08PD3vg6EkVlz"
-    requestId = f"{partnerCode}{int(time.time() * 1000)}"
-    orderId = 'MM' + str(int(time.time() * 1000))
-    orderInfo = "pay with MoMo"
-    redirectUrl = "https://momo.vn/return"
-    ipnUrl = "https://callback.url/notify"
-    amount = request.headers.get('amount', '')
-    requestType = "payWithATM"
-    extraData = ""
-
-    # Construct raw signature
-    rawSignature = f"accessKey={accessKey}&amount={amount}&extraData={extraData}&ipnUrl={ipnUrl}&orderId={orderId}&orderInfo={orderInfo}&partnerCode={partnerCode}&redirectUrl={redirectUrl}&requestId={requestId}&requestType={requestType}"
-
-    # Generate signature using HMAC-SHA256
-    signature = hmac.new(secretKey.encode(), rawSignature.encode(), hashlib.sha256).hexdigest()
-
-    # Create request body as JSON
-    data = {
-        "partnerCode": partnerCode,
-        "accessKey": accessKey,
-        "requestId": requestId,
-        "amount": amount,
-        "orderId": orderId,
-        "orderInfo": orderInfo,
-        "redirectUrl": redirectUrl,
-        "ipnUrl": ipnUrl,
-        "extraData": extraData,
-        "requestType": requestType,
-        "signature": signature,
-        "lang": "vi"
-    }
-
-    # Send request to MoMo endpoint
-    url = 'https://test-payment.momo.vn/v2/gateway/api/create'
-    headers = {'Content-Type': 'application/json'}
-    response = requests.post(url, json=data, headers=headers)
-
-    # Process response
-    if response.status_code == 200:
-        response_data = response.json()
-        pay_url = response_data.get('payUrl')
-        return JsonResponse(response_data)
-    else:
-        return JsonResponse({"error": f"Failed to create payment request. Status code: {response.status_code}"},
-                            status=500)
-
-config = {
-    "app_id": 2553,  # Thay bằng app_id của bạn
-    "key1": "PcY4iZIKFCIdgZvA6ueMcMHHUbRLYjPL",  # Thay bằng key1 của bạn
-    "key2": "kLtgPl8HHhfvMuDHPwKfgfsY4Ydm9eIz",  # Thay bằng key2 của bạn
-    "endpoint": "https://sb-openapi.zalopay.vn/v2/create"  # API endpoint của ZaloPay
-}
+    amount = _so_tien(request.headers.get('amount', ''))
+    if amount is None:
+        return JsonResponse({"error": "Invalid amount."}, status=400)
+    if _khoa_an_danh(request, request.user if request.user.is_authenticated else None):
+        return JsonResponse({"error": "Idempotency-Key requires authentication."}, status=400)
+    try:
+        _, response_data = _tao_don_thanh_toan(request, 'momo', amount)
+    except thanhtoan.PaymentGatewayError as e:
+        return JsonResponse({"error": f"Failed to create payment request. {e}"}, status=500)
+    return JsonResponse(response_data)
 
 class PaymentViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
 
     @action(methods=['post'], detail=False, url_path='zalopay/order')
     def zalopay_create_order(self, request):
+        amount = _so_tien(request.data.get('amount', 50000))
+        if amount is None:
+            return Response({"error": "Invalid amount."}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            transID = random.randrange(1000000)
-
-            # Create order info
-            order = {
-                "app_id": config["app_id"],
-                "app_trans_id": "{:%y%m%d}_{}".format(datetime.today(), transID),
-                "app_user": request.data.get('app_user', 'user123'),
-                "app_time": int(round(time.time() * 1000)),
-                "embed_data": json.dumps({}),
-                "item": json.dumps([{
-                    "itemid": "knb",
-                    "itemname": "Kim Nguyên Bảo",
-                    "itemprice": request.data.get('amount', 50000),
-                    "itemquantity": 1
-                }]),
-                "amount": request.data.get('amount', 50000),
-                "description": "ZaloPay - Thanh toán tiền phạt #{}".format(transID),
-                "bank_code": request.data.get('bank_code', 'zalopayapp')
-            }
-
-            # Create MAC (HMAC-SHA256)
-            data = "{}|{}|{}|{}|{}|{}|{}".format(
-                order["app_id"], order["app_trans_id"], order["app_user"],
-                order["amount"], order["app_time"], order["embed_data"], order["item"]
+            _, result = _tao_don_thanh_toan(
+                request, 'zalopay', amount,
+                app_user=request.data.get('app_user', 'user123'),
+                bank_code=request.data.get('bank_code', 'zalopayapp'),
             )
-
-            order["mac"] = hmac.new(config['key1'].encode(), data.encode(), hashlib.sha256).hexdigest()
-
-            # Send request to ZaloPay API
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            request_data = urllib.parse.urlencode(order).encode()
-
-            request_obj = urllib.request.Request(url=config["endpoint"], data=request_data, headers=headers)
-            response = urllib.request.urlopen(request_obj)
-            result = json.loads(response.read())
-
             return Response(result, status=status.HTTP_200_OK)
 
-        except urllib.error.URLError as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        except thanhtoan.PaymentGatewayError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Thanh toán tiền phạt của một phiếu trả trễ; mặc định mỗi phiếu một đơn cho mỗi cổng
+    @action(methods=['post'], detail=False, url_path='fine')
+    def fine(self, request):
+        cong = request.data.get('gateway', 'momo')
+        if cong not in dict(ThanhToan.CONG_CHOICES):
+            return Response({'error': 'gateway phải là momo hoặc zalopay.'}, status=status.HTTP_400_BAD_REQUEST)
+        chi_tiet = get_object_or_404(ChiTietPhieuMuon.objects.select_related('phieuMuon'),
+                                     pk=request.data.get('chi_tiet_id'))
+        if not request.user.is_superuser and chi_tiet.phieuMuon.docGia_id != request.user.pk:
+            return Response({'error': 'ChiTietPhieuMuon not found.'}, status=status.HTTP_404_NOT_FOUND)
+        if chi_tiet.tinhTrang != 'late' or not chi_tiet.tienPhat or chi_tiet.daThanhToan:
+            return Response({'error': 'Không có tiền phạt cần thanh toán.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            don, result = _tao_don_thanh_toan(request, cong, chi_tiet.tienPhat, chi_tiet=chi_tiet,
+                                              khoa='fine')
+        except thanhtoan.PaymentGatewayError as e:
+            return Response({'error': str(e)}, status=status.HTTP_502_BAD_GATEWAY)
+        return Response({**ThanhToanSerializer(don).data, 'gateway_response': result}, status=status.HTTP_200_OK)
+
+    # IPN của MoMo: kiểm tra chữ ký rồi ghi kết quả một lần (gửi lại nhiều lần không ghi thêm)
+    @action(methods=['post'], detail=False, url_path='momo/ipn', permission_classes=[AllowAny],
+            authentication_classes=[])
+    def momo_ipn(self, request):
+        data = request.data
+        if not thanhtoan.xac_thuc_momo_ipn(data):
+            return Response({'error': 'Invalid signature.'}, status=status.HTTP_400_BAD_REQUEST)
+        amount = _so_tien(data.get('amount'))
+        if amount is None:
+            return Response({'error': 'Invalid amount.'}, status=status.HTTP_400_BAD_REQUEST)
+        ThanhToan.xac_nhan(data.get('orderId'), amount, data.get('transId'), str(data.get('resultCode')) == '0')
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    # Callback của ZaloPay: return_code 1 = đã ghi nhận, 2 = đã xử lý trước đó, 0 = ZaloPay gửi lại sau
+    @action(methods=['post'], detail=False, url_path='zalopay/callback', permission_classes=[AllowAny],
+            authentication_classes=[])
+    def zalopay_callback(self, request):
+        data = request.data.get('data', '')
+        if not thanhtoan.xac_thuc_zalopay_callback(data, request.data.get('mac')):
+            return Response({'return_code': -1, 'return_message': 'mac not equal'})
+        try:
+            payload = json.loads(data)
+            if not isinstance(payload, dict):
+                return Response({'return_code': -1, 'return_message': 'data must be a JSON object'})
+            amount = _so_tien(payload['amount'])
+            ket_qua = ThanhToan.xac_nhan(payload['app_trans_id'], amount, payload.get('zp_trans_id'), True) \
+                if amount is not None else 'mismatch'
+        except (ValueError, KeyError) as e:
+            return Response({'return_code': 0, 'return_message': str(e)})
+        return_code = {'paid': 1, 'duplicate': 2}.get(ket_qua, 0)
+        return Response({'return_code': return_code, 'return_message': ket_qua})
@@ -0,0 +1,155 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework import exceptions, status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import thongke, thanhtoan
+from .models import NguoiDung, Sach, BinhLuan, ThanhToan
+from .paginators import CreatedAtCursorPagination
+from .serializers import BinhLuanFeedSerializer, FeedNguoiDungSerializer, FeedSachSerializer
+from .views import _khoa_an_danh, _mo_don_thanh_toan, _ghi_phan_hoi, _so_tien
+
+# View bất đồng bộ cho các endpoint chủ yếu chờ I/O (gọi cổng thanh toán, truy vấn thống kê, feed bình luận),
+# dùng khi chạy dưới ASGI (vd. uvicorn QuanLyThuVien.asgi:application). Trong lúc một request chờ cổng thanh
+# toán hay CSDL, event loop vẫn phục vụ request khác thay vì giữ cả một thread. Được gắn dưới /async/, song
+# song với các viewset đồng bộ (vẫn là đường phục vụ chính dưới WSGI); kết quả trả về giống hệt bản đồng bộ.
+
+
+def _json(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(JSONRenderer().render(data), status=status_code, content_type='application/json')
+
+
+def api_view_async(xac_thuc=True):
+    # Bọc request như DRF: cùng parser và các lớp xác thực (OAuth2 / session / token) với viewset. Xác thực
+    # truy vấn CSDL đồng bộ nên chạy qua sync_to_async; CSRF do SessionAuthentication tự kiểm tra như DRF.
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            api_request = Request(
+                request,
+                parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+                authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+            )
+            if xac_thuc:
+                try:
+                    user = await sync_to_async(lambda: api_request.user)()
+                except exceptions.APIException as e:
+                    return _json({'detail': e.detail}, e.status_code)
+                if not user.is_authenticated:
+                    return _json({'detail': exceptions.NotAuthenticated.default_detail},
+                                 status.HTTP_401_UNAUTHORIZED)
+            return await view(api_request, *args, **kwargs)
+        return csrf_exempt(wrapper)
+    return decorator
+
+
+async def _tao_don_thanh_toan(request, user, cong, so_tien, **kwargs):
+    don = await sync_to_async(_mo_don_thanh_toan)(request, user, cong, so_tien)
+    if don.phanHoi is not None:
+        return don.phanHoi
+
+    result = await thanhtoan.atao_don(cong, int(don.soTien), don.maDonHang, **kwargs)
+    await ThanhToan.objects.filter(pk=don.pk, trangThai='pending').aupdate(**_ghi_phan_hoi(don, cong, result))
+    return result
+
+
+@require_POST
+@api_view_async(xac_thuc=False)
+async def payment_view(request):
+    amount = _so_tien(request.headers.get('amount', ''))
+    if amount is None:
+        return _json({"error": "Invalid amount."}, status.HTTP_400_BAD_REQUEST)
+    user = await request._request.auser()
+    user = user if user.is_authenticated else None
+    if _khoa_an_danh(request, user):
+        return _json({"error": "Idempotency-Key requires authentication."}, status.HTTP_400_BAD_REQUEST)
+    try:
+        result = await _tao_don_thanh_toan(request, user, 'momo', amount)
+    except thanhtoan.PaymentGatewayError as e:
+        return _json({"error": f"Failed to create payment request. {e}"}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return _json(result)
+
+
+@require_POST
+@api_view_async()
+async def zalopay_create_order(request):
+    amount = _so_tien(request.data.get('amount', 50000))
+    if amount is None:
+        return _json({"error": "Invalid amount."}, status.HTTP_400_BAD_REQUEST)
+    try:
+        result = await _tao_don_thanh_toan(
+            request, request.user, 'zalopay', amount,
+            app_user=request.data.get('app_user', 'user123'),
+            bank_code=request.data.get('bank_code', 'zalopayapp'),
+        )
+    except thanhtoan.PaymentGatewayError as e:
+        return _json({"error": str(e)}, status.HTTP_400_BAD_REQUEST)
+    return _json(result)
+
+
+@require_GET
+@api_view_async()
+async def borrow_return_late_statistics(request):
+    granularity = request.query_params.get('granularity', 'month').strip('/')
+    window = request.query_params.get('window', '12').strip('/')
+
+    if granularity not in thongke.GRANULARITIES:
+        return _json({'error': 'Invalid granularity. Must be one of: day, week, month.'},
+                     status.HTTP_400_BAD_REQUEST)
+    if not window.isdigit() or not (1 <= int(window) <= thongke.MAX_WINDOW):
+        return _json({'error': f'Invalid window. Must be between 1 and {thongke.MAX_WINDOW}.'},
+                     status.HTTP_400_BAD_REQUEST)
+
+    try:
+        statistics = await thongke.acirculation_statistics(granularity, int(window))
+    except Exception as e:
+        return _json({'error': str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+    result = {'granularity': granularity, 'window': int(window), 'statistics': statistics}
+    if granularity == 'month':
+        result['monthly_statistics'] = statistics
+    return _json(result)
+
+
+@require_GET
+@api_view_async()
+async def dashboard(request):
+    try:
+        data = await thongke.adashboard(timeout=getattr(settings, 'THUVIEN_DASHBOARD_TTL', 30))
+    except Exception as e:
+        return _json({'error': str(e)}, status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return _json(data)
+
+
+@require_GET
+@api_view_async(xac_thuc=False)
+async def binh_luan_feed(request):
+    # Cùng định dạng với BinhLuanViewSet.feed: trang bình luận theo con trỏ kèm bảng phụ users / books
+    queryset = BinhLuan.objects.all()
+    sach_id = request.query_params.get('sach_id')
+    if sach_id:
+        queryset = queryset.filter(sach__id=sach_id)
+
+    paginator = CreatedAtCursorPagination()
+    page = await sync_to_async(paginator.paginate_queryset)(queryset, request)
+    data = paginator.get_paginated_response(BinhLuanFeedSerializer(page, many=True).data).data
+
+    context = {'request': request}
+    users = await NguoiDung.objects.only('id', 'username', 'first_name', 'last_name', 'avatar') \
+        .ain_bulk({row.user_id for row in page})
+    books = await Sach.objects.select_related('danhMuc') \
+        .only('id', 'tenSach', 'tenTacGia', 'anhSach', 'danhMuc__tenDanhMuc') \
+        .ain_bulk({row.sach_id for row in page})
+    data['users'] = {
+        user['id']: user for user in FeedNguoiDungSerializer(users.values(), many=True, context=context).data
+    }
+    data['books'] = {
+        book['id']: book for book in FeedSachSerializer(books.values(), many=True, context=context).data
+    }
+    return _json(data)